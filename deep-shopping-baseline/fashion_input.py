@@ -2,70 +2,89 @@
 This python file is responsible for the image processing
 '''
 
+from multiprocessing.pool import ThreadPool
+
 import cv2
 import numpy as np
 import pandas as pd
 from hyper_parameters import *
 
 shuffle = True
-localization = FLAGS.is_localization
 imageNet_mean_pixel = [103.939, 116.799, 123.68]
 global_std = 68.76
 
+mean_pixel = np.array(imageNet_mean_pixel, dtype=np.float32)
+
 IMG_ROWS = 64
 IMG_COLS = 64
 
+NUM_LOADER_THREADS = 8
+loader_pool = None
+
+
+def get_pool():
+    '''
+    :return: the thread pool shared by all batch loads. OpenCV releases the GIL while it decodes
+    and resizes, so the images of a batch are loaded in parallel
+    '''
+    global loader_pool
+    if loader_pool is None:
+        loader_pool = ThreadPool(NUM_LOADER_THREADS)
+    return loader_pool
+
 
-def get_image(path, x1, y1, x2, y2):
+def load_image_into(path, flip, out):
     '''
+    Read, resize, flip and normalize one image straight into its slot of the batch buffer.
     :param path: image path
-    :param x1: the upper left and lower right coordinates to localize the apparels
-    :param y1:
-    :param x2:
-    :param y2:
-    :return: a numpy array with dimensions [img_row, img_col, img_depth]
+    :param flip: mirror the image horizontally
+    :param out: a float32 numpy array with dimensions [img_row, img_col, img_depth]
     '''
     img = cv2.imread(path)
-    if localization is True:
-        if img is None or img.shape[0] == 0 or img.shape[1] == 0:
-            img = np.zeros((1, IMG_ROWS, IMG_COLS, 0))
-        img = cv2.resize(img, (IMG_ROWS, IMG_COLS))
-        assert img.shape == (IMG_ROWS, IMG_COLS, 3)
-    else:
-        img = cv2.resize(img, (IMG_ROWS, IMG_COLS))
+    if img is None or img.shape[0] == 0 or img.shape[1] == 0:
+        raise IOError('Cannot read the image %s' % path)
+    img = cv2.resize(img, (IMG_ROWS, IMG_COLS))
+    if flip:
+        img = cv2.flip(img, 1)
+    np.subtract(img, mean_pixel, out=out)
+    out *= 1.0 / global_std
 
-    img = img.reshape(1, IMG_ROWS, IMG_COLS, 3)
 
-    return img
+class BatchBuilder(object):
+    '''
+    Assembles image batches into one preallocated float32 buffer that is reused across steps.
+    The arrays it returns are views of the buffer, so they are only valid until the next load:
+    use one builder per batch that has to stay alive, e.g. one for training and one for
+    validation.
+    '''
+    def __init__(self, batch_size):
+        self.buffer = np.empty((batch_size, IMG_ROWS, IMG_COLS, 3), dtype=np.float32)
 
 
-def load_data_numpy(df):
+def load_data_numpy(df, builder=None):
     '''
     :param df: a pandas dataframe with the image paths and localization coordinates
+    :param builder: an optional BatchBuilder whose buffer receives the images. Without one, a
+    new buffer is allocated
     :return: the numpy representation of the images and the corresponding labels
     '''
 
     num_images = len(df)
-    image_path_array = df['image_path'].as_matrix()
-    label_array = df['category'].as_matrix()
-    x1 = df['x1_modified'].as_matrix().reshape(-1, 1)
-    y1 = df['y1_modified'].as_matrix().reshape(-1, 1)
-    x2 = df['x2_modified'].as_matrix().reshape(-1, 1)
-    y2 = df['y2_modified'].as_matrix().reshape(-1, 1)
-    bbox_array = np.concatenate((x1, y1, x2, y2), axis=1)
-
-    image_array = np.array([]).reshape(-1, IMG_ROWS, IMG_COLS, 3)
-    adjusted_std = 1.0/np.sqrt(IMG_COLS * IMG_ROWS * 3)
-
-    for i in range(num_images):
-        img = get_image(image_path_array[i], x1=x1[i, 0], y1=y1[i, 0], x2=x2[i, 0], y2=y2[i, 0])
-        flip_indicator = np.random.randint(low=0, high=2)
-        if flip_indicator == 0:
-            img[0, ...] = cv2.flip(img[0, ...], 1)
-
-        image_array = np.concatenate((image_array, img))
-
-    image_array = (image_array - imageNet_mean_pixel) / global_std
+    image_path_array = df['image_path'].values
+    label_array = df['category'].values
+    bbox_array = df[['x1_modified', 'y1_modified', 'x2_modified', 'y2_modified']].values
+
+    if builder is None or len(builder.buffer) < num_images:
+        image_array = np.empty((num_images, IMG_ROWS, IMG_COLS, 3), dtype=np.float32)
+        if builder is not None:
+            builder.buffer = image_array
+    else:
+        image_array = builder.buffer[:num_images]
+
+    # Draw the flips here, not in the loader threads, so they follow the numpy random seed
+    flips = np.random.randint(low=0, high=2, size=num_images) == 0
+    get_pool().map(lambda i: load_image_into(image_path_array[i], flips[i], image_array[i]),
+                   range(num_images))
 
     # Convert to BGR image for pre-train vgg16
     assert image_array.shape[1:] == (IMG_ROWS, IMG_COLS, 3)
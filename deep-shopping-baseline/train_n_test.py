@@ -24,15 +24,17 @@ STEP_TO_TRAIN = 45000
 DECAY_STEP0 = 25000
 DECAY_STEP1 = 35000
 
-def generate_validation_batch(df):
+def generate_validation_batch(df, builder=None):
     '''
     :param df: a pandas dataframe with validation image paths and the corresponding labels
+    :param builder: an optional BatchBuilder to load the images into
     :return: two random numpy arrays: validation_batch and validation_label
     '''
     offset = np.random.choice(len(df) - VALI_BATCH_SIZE, 1)[0]
     validation_df = df.iloc[offset:offset+VALI_BATCH_SIZE, :]
 
-    validation_batch, validation_label, validation_bbox_label = load_data_numpy(validation_df)
+    validation_batch, validation_label, validation_bbox_label = load_data_numpy(validation_df,
+                                                                                builder)
     return validation_batch, validation_label, validation_bbox_label
 
 
@@ -42,6 +44,11 @@ class Train:
     '''
     def __init__(self):
         self.placeholders()
+        # The train and validation batches of a step are alive at the same time, so each gets
+        # its own reused buffer
+        self.train_builder = BatchBuilder(TRAIN_BATCH_SIZE)
+        self.vali_builder = BatchBuilder(VALI_BATCH_SIZE)
+        self.full_vali_builder = BatchBuilder(VALI_BATCH_SIZE)
 
     def loss(self, logits, bbox, labels, bbox_labels):
 
@@ -115,7 +122,7 @@ class Train:
         for i in range(num_batches):
             offset = i * VALI_BATCH_SIZE
             vali_batch_df = validation_df.iloc[offset:offset+VALI_BATCH_SIZE, :]
-            validation_image_batch, validation_labels_batch, validation_bbox_batch = load_data_numpy(vali_batch_df)
+            validation_image_batch, validation_labels_batch, validation_bbox_batch = load_data_numpy(vali_batch_df, self.full_vali_builder)
 
             vali_error, vali_loss_value = sess.run([vali_top1_error, vali_loss],
                                               {self.image_placeholder: batch_data,
@@ -187,9 +194,9 @@ class Train:
             offset = np.random.choice(num_train - TRAIN_BATCH_SIZE, 1)[0]
 
             train_batch_df = train_df.iloc[offset:offset+TRAIN_BATCH_SIZE, :]
-            batch_data, batch_label, batch_bbox = load_data_numpy(train_batch_df)
+            batch_data, batch_label, batch_bbox = load_data_numpy(train_batch_df, self.train_builder)
 
-            vali_image_batch, vali_labels_batch, vali_bbox_batch = generate_validation_batch(vali_df)
+            vali_image_batch, vali_labels_batch, vali_bbox_batch = generate_validation_batch(vali_df, self.vali_builder)
 
             start_time = time.time()
 
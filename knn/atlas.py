@@ -0,0 +1,116 @@
+'''
+This python file builds the thumbnail atlas of the catalog and renders recommendation results
+from it. The offline job decodes every catalog image once and packs a fixed-size thumbnail of it
+into one memory-mapped uint8 array, so a result page is a few slices of the atlas instead of k
+full JPEG decodes.
+
+Example:
+    python atlas.py --csv demo/full_data_revised.csv --output demo/output/thumbnails.npy
+'''
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from exact import num_workers
+from feature_store import FeatureStore
+
+THUMB_SIZE = 96
+CHUNK_ROWS = 1024
+
+
+def load_thumbnail(path, size=THUMB_SIZE):
+    '''
+    :param path: image path
+    :param size: side length of the thumbnail
+    :return: a uint8 BGR numpy array with dimensions [size, size, 3]. Unreadable images give a
+    black thumbnail
+    '''
+    img = cv2.imread(path)
+    if img is None or img.shape[0] == 0 or img.shape[1] == 0:
+        return np.zeros((size, size, 3), dtype=np.uint8)
+    return cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA)
+
+
+def build_atlas(image_paths, atlas_path, size=THUMB_SIZE, n_jobs=-1, chunk_rows=CHUNK_ROWS):
+    '''
+    :param image_paths: the image path of every catalog row
+    :param atlas_path: the .npy file to write. It holds a uint8 array with dimensions
+    [num_rows, size, size, 3]
+    :param size: side length of the thumbnails
+    :param n_jobs: number of decoding threads. -1 uses all cores; OpenCV releases the GIL
+    :param chunk_rows: number of thumbnails decoded between two writes
+    :return: the atlas, opened through mmap
+    '''
+    atlas = np.lib.format.open_memmap(atlas_path, mode='w+', dtype=np.uint8,
+                                      shape=(len(image_paths), size, size, 3))
+    with ThreadPoolExecutor(max_workers=num_workers(n_jobs)) as pool:
+        for start in range(0, len(image_paths), chunk_rows):
+            paths = image_paths[start:start + chunk_rows]
+            thumbs = list(pool.map(lambda p: load_thumbnail(p, size), paths))
+            atlas[start:start + len(thumbs)] = np.stack(thumbs)
+            print('%d / %d thumbnails packed' % (start + len(thumbs), len(image_paths)))
+    atlas.flush()
+    del atlas
+    return load_atlas(atlas_path)
+
+
+def build_atlas_from_csv(csv_path, atlas_path, size=THUMB_SIZE, n_jobs=-1):
+    '''
+    :param csv_path: a csv with an image_path column, such as full_data_revised.csv
+    '''
+    image_paths = pd.read_csv(csv_path, usecols=['image_path'])['image_path'].tolist()
+    return build_atlas(image_paths, atlas_path, size=size, n_jobs=n_jobs)
+
+
+def load_atlas(atlas_path):
+    return np.load(atlas_path, mmap_mode='r')
+
+
+def render_grid(atlas, query_rows, neighbor_rows, out_path=None):
+    '''
+    Render one line per query: the query thumbnail followed by its neighbors. All thumbnails are
+    gathered with a single fancy-indexing copy.
+    :param atlas: the atlas array with dimensions [num_rows, size, size, 3]
+    :param query_rows: the atlas rows of the queries, or -1 for queries not in the catalog
+    :param neighbor_rows: the atlas rows of the neighbors with dimensions [num_queries, k].
+    Missing neighbors (-1) are drawn blank
+    :param out_path: optional image file to write the grid to
+    :return: a uint8 BGR image with dimensions [num_queries * size, (k + 1) * size, 3]
+    '''
+    rows = np.column_stack((np.atleast_1d(query_rows), np.atleast_2d(neighbor_rows)))
+    num_lines, num_tiles = rows.shape
+    size = atlas.shape[1]
+    tiles = np.asarray(atlas[np.maximum(rows, 0).ravel()])
+    tiles[rows.ravel() < 0] = 255
+    grid = tiles.reshape(num_lines, num_tiles, size, size, 3).transpose(0, 2, 1, 3, 4)
+    grid = np.ascontiguousarray(grid).reshape(num_lines * size, num_tiles * size, 3)
+    if out_path is not None:
+        cv2.imwrite(out_path, grid)
+    return grid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack the thumbnail atlas of the catalog')
+    parser.add_argument('--csv', default='demo/full_data_revised.csv',
+                        help='a csv with an image_path column, one row per catalog row')
+    parser.add_argument('--store_dir', default=None,
+                        help='read the image paths from this feature store instead of --csv')
+    parser.add_argument('--output', default='demo/output/thumbnails.npy')
+    parser.add_argument('--size', type=int, default=THUMB_SIZE)
+    parser.add_argument('--n_jobs', type=int, default=-1)
+    args = parser.parse_args()
+    if args.store_dir is not None:
+        store = FeatureStore(args.store_dir)
+        if store.image_paths is None:
+            raise ValueError('The feature store in %s has no image paths' % args.store_dir)
+        build_atlas(store.image_path(np.arange(len(store))), args.output, size=args.size,
+                    n_jobs=args.n_jobs)
+    else:
+        build_atlas_from_csv(args.csv, args.output, size=args.size, n_jobs=args.n_jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+'''
+This python file benchmarks every retrieval backend on the real features.npy or on synthetic
+Gaussian-mixture embeddings. For each backend it reports the build time, the index memory, the
+recall@k against exact search, and the queries per second and p50/p99 latency at several batch
+sizes.
+
+Example:
+    python benchmark.py --features demo/output/features.npy --output bench.json
+    python benchmark.py --synthetic 20000 --backends exact,ivf,hnsw
+    python benchmark.py --features demo/output/features.npy --backends exact,ivf --pca 16,32
+'''
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+from exact import ExactIndex, recall_at_k
+from hnsw import HNSWIndex
+from ivf import IVFIndex
+from lsh import BinaryHashIndex
+from pca import PCA, PCAIndex
+from pq import IVFPQIndex, PQIndex, ProductQuantizer
+
+BATCH_SIZES = [1, 8, 64]
+MIN_TIMED_QUERIES = 256
+
+
+class BallTreeIndex(object):
+    '''
+    The original sklearn ball tree of knn.py behind the common search() interface.
+    '''
+    index_type = 'ball_tree'
+
+    def fit(self, features, ids=None):
+        self.nbrs = NearestNeighbors(algorithm='ball_tree', n_jobs=-1).fit(features)
+        self.ntotal = len(features)
+        return self
+
+    def search(self, queries, k=6):
+        return self.nbrs.kneighbors(queries, n_neighbors=k)
+
+    def nbytes(self):
+        return sum(a.nbytes for a in self.nbrs._tree.get_arrays())
+
+
+# name -> (function building the index from the features, search arguments)
+BACKENDS = {
+    'ball_tree': (lambda x: BallTreeIndex().fit(x), {}),
+    'exact': (lambda x: ExactIndex().fit(x), {}),
+    'ivf': (lambda x: IVFIndex(n_lists=int(4 * np.sqrt(len(x)))).fit(x), {'nprobe': 8}),
+    'ivfpq': (lambda x: IVFPQIndex(n_lists=int(4 * np.sqrt(len(x))), m=16).fit(x),
+              {'nprobe': 8}),
+    'pq': (lambda x: PQIndex(x.shape[1], m=16).fit(x), {}),
+    'hnsw': (lambda x: HNSWIndex(x.shape[1]).fit(x), {'ef': 64}),
+    'lsh': (lambda x: BinaryHashIndex(x.shape[1]).fit(x), {'rerank': 256}),
+}
+# The HNSW graph is built one insertion at a time in Python, about 5ms per item at 64-d, i.e.
+# well over 10 minutes at the default size, so it only runs when asked for with --backends
+DEFAULT_BACKENDS = sorted(name for name in BACKENDS if name != 'hnsw')
+
+
+def with_pca(build, dim, whiten=False):
+    '''
+    :param build: a function building an index from the features
+    :param dim: number of PCA components to keep
+    :return: a function building the same index behind a PCA stage
+    '''
+    def build_reduced(x):
+        pca = PCA(dim, whiten=whiten).fit(x)
+        return PCAIndex(build(pca.transform(x)), pca)
+    return build_reduced
+
+
+def gaussian_mixture(num_points, dim=64, num_clusters=100, spread=0.3, seed=0):
+    '''
+    :param num_points: number of embeddings
+    :param dim: dimension of the embeddings
+    :param num_clusters: number of mixture components
+    :param spread: standard deviation of the points around their component mean
+    :return: a float32 numpy array with dimensions [num_points, dim]. Like global_pool
+    outputs the values are non-negative
+    '''
+    rng = np.random.RandomState(seed)
+    means = rng.rand(num_clusters, dim).astype(np.float32)
+    labels = rng.randint(0, num_clusters, num_points)
+    points = means[labels] + spread * rng.randn(num_points, dim).astype(np.float32) / np.sqrt(dim)
+    return np.maximum(points, 0).astype(np.float32)
+
+
+def split_queries(features, num_queries, seed=0):
+    '''
+    :return: the base rows and the held-out query rows
+    '''
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(len(features))
+    return features[np.sort(order[num_queries:])], features[order[:num_queries]]
+
+
+def index_nbytes(index):
+    '''
+    :return: the bytes held by the numpy arrays of an index, including its quantizers
+    '''
+    if hasattr(index, 'nbytes'):
+        return index.nbytes()
+    total = 0
+    for value in vars(index).values():
+        if isinstance(value, np.ndarray):
+            total += value.nbytes
+        elif isinstance(value, (ProductQuantizer, PCA)) or hasattr(value, 'index_type'):
+            total += index_nbytes(value)
+        elif isinstance(value, list) and value and isinstance(value[0], list):
+            # HNSW link lists: count 8 bytes per link
+            total += 8 * sum(len(l) for node in value for l in node)
+    return total
+
+
+def resident_memory():
+    '''
+    :return: the resident set size of this process in bytes, or 0 where /proc is missing
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def time_queries(index, queries, k, batch_size, search_kwargs):
+    '''
+    :return: the queries per second and the p50 / p99 latency of one batch in milliseconds
+    '''
+    num_batches = max(1, min(len(queries), MIN_TIMED_QUERIES) // batch_size)
+    latencies = []
+    start = time.time()
+    for b in range(num_batches):
+        batch = queries[(b * batch_size) % len(queries):][:batch_size]
+        t = time.time()
+        index.search(batch, k=k, **search_kwargs)
+        latencies.append(time.time() - t)
+    total = time.time() - start
+    latencies = 1000 * np.array(latencies)
+    return num_batches * batch_size / total, np.percentile(latencies, 50), \
+        np.percentile(latencies, 99)
+
+
+def run_benchmark(features, queries, backends, k=10, batch_sizes=BATCH_SIZES):
+    '''
+    :param features: the base embeddings with dimensions [n, dim]
+    :param queries: the query embeddings with dimensions [num_queries, dim]
+    :param backends: a dict name -> (build function, search arguments)
+    :return: a list with one dict of results per backend
+    '''
+    _, truth = ExactIndex().fit(features).search(queries, k=k)
+    results = []
+    for name, (build, search_kwargs) in backends.items():
+        rss = resident_memory()
+        start = time.time()
+        index = build(features)
+        build_time = time.time() - start
+        _, found = index.search(queries, k=k, **search_kwargs)
+        result = {'backend': name, 'ntotal': len(features), 'dim': features.shape[1], 'k': k,
+                  'build_sec': build_time, 'recall': recall_at_k(found, truth, k),
+                  'index_mb': index_nbytes(index) / 2.0 ** 20,
+                  'rss_delta_mb': (resident_memory() - rss) / 2.0 ** 20,
+                  'search_kwargs': search_kwargs}
+        if isinstance(index, PCAIndex):
+            result['explained_variance'] = index.pca.explained_variance
+        for batch_size in batch_sizes:
+            qps, p50, p99 = time_queries(index, queries, k, batch_size, search_kwargs)
+            result['qps@%d' % batch_size] = qps
+            result['p50_ms@%d' % batch_size] = p50
+            result['p99_ms@%d' % batch_size] = p99
+        results.append(result)
+        print_result(result, batch_sizes)
+    return results
+
+
+def print_result(result, batch_sizes=BATCH_SIZES):
+    line = '%-10s build %7.2fs  mem %8.1fMB  recall@%d %.4f' % (
+        result['backend'], result['build_sec'], result['index_mb'], result['k'], result['recall'])
+    for batch_size in batch_sizes:
+        line += '  | b%d %8.0f qps p50 %.2fms p99 %.2fms' % (
+            batch_size, result['qps@%d' % batch_size], result['p50_ms@%d' % batch_size],
+            result['p99_ms@%d' % batch_size])
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Retrieval backend benchmark')
+    parser.add_argument('--features', default=None, help='a features .npy file')
+    parser.add_argument('--synthetic', type=int, default=100000,
+                        help='number of synthetic embeddings when --features is not given')
+    parser.add_argument('--dim', type=int, default=64)
+    parser.add_argument('--clusters', type=int, default=100)
+    parser.add_argument('--num_queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--backends', default=','.join(DEFAULT_BACKENDS),
+                        help='comma separated backends among %s' % ','.join(sorted(BACKENDS)))
+    parser.add_argument('--pca', default=None,
+                        help='comma separated PCA dimensions to also run every backend at')
+    parser.add_argument('--whiten', action='store_true', help='whiten the PCA components')
+    parser.add_argument('--output', default=None, help='json file to write the results to')
+    args = parser.parse_args()
+
+    if args.features is not None:
+        features = np.load(args.features, mmap_mode='r').astype(np.float32)
+    else:
+        features = gaussian_mixture(args.synthetic, args.dim, args.clusters)
+    features, queries = split_queries(features, args.num_queries)
+    backends = dict((name, BACKENDS[name]) for name in args.backends.split(','))
+    if args.pca is not None:
+        for name in args.backends.split(','):
+            for dim in [int(d) for d in args.pca.split(',')]:
+                build, search_kwargs = BACKENDS[name]
+                backends['%s+pca%d' % (name, dim)] = (with_pca(build, dim, args.whiten),
+                                                      search_kwargs)
+    results = run_benchmark(features, queries, backends, k=args.k)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
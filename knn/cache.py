@@ -0,0 +1,132 @@
+'''
+This python file implements the result cache in front of the k-nearest neighbor search. Product
+page traffic follows a power law, so most queries are repeats of a few popular items. Results are
+kept in a bounded LRU cache keyed by item id or by a hash of the quantized query embedding, and
+the cache empties itself whenever the version of the index changes.
+'''
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+CACHE_SIZE = 100000
+QUANTIZATION_STEP = 1e-4
+
+
+def embedding_key(query, step=QUANTIZATION_STEP):
+    '''
+    :param query: a numpy array with dimensions [dim]
+    :param step: quantization step, so that embeddings equal up to float noise share a key
+    :return: a short digest of the quantized embedding
+    '''
+    quantized = np.round(np.asarray(query, dtype=np.float64) / step).astype(np.int64)
+    return hashlib.sha1(quantized.tobytes()).hexdigest()
+
+
+def index_version(index):
+    '''
+    :return: a value that changes whenever the contents of the index change
+    '''
+    return id(index), getattr(index, 'version', 0)
+
+
+class LRUCache(object):
+    '''
+    A thread-safe bounded LRU cache with hit / miss counters. Setting a new version empties it.
+    '''
+    def __init__(self, capacity=CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def check_version(self, version):
+        '''
+        :param version: the current version of the cached source. A change empties the cache
+        '''
+        with self.lock:
+            if version != self.version:
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.version = version
+
+    def get(self, key):
+        '''
+        :return: the cached value, or None on a miss
+        '''
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        '''
+        :return: a dict with the counters and the hit rate
+        '''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'capacity': self.capacity, 'hits': self.hits,
+                    'misses': self.misses, 'invalidations': self.invalidations,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class CachedSearcher(object):
+    '''
+    Wraps an index so that repeated queries are answered from an LRU cache. Only the missing
+    queries of a batch reach the index, as one batch.
+    '''
+    def __init__(self, index, capacity=CACHE_SIZE, step=QUANTIZATION_STEP):
+        self.index = index
+        self.cache = LRUCache(capacity)
+        self.step = step
+
+    def search(self, queries, k=6, mask_key=None, mask=None, **search_kwargs):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param k: number of neighbors to return
+        :param mask_key: a hashable name of the mask, e.g. the category. Masked searches without
+        a mask_key bypass the cache
+        :param mask: an optional boolean array indexed by catalog id
+        :return: distances and catalog ids with dimensions [num_queries, k]
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if mask is not None and mask_key is None:
+            return self.index.search(queries, k=k, mask=mask, **search_kwargs)
+        # Read once, before the search: keys carry the version they are computed on, so results
+        # of a search overtaken by an index update are never served for the new version
+        version = index_version(self.index)
+        self.cache.check_version(version)
+
+        params = (version, k, mask_key, tuple(sorted(search_kwargs.items())))
+        keys = [(embedding_key(query, self.step),) + params for query in queries]
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        missing = []
+        for i, key in enumerate(keys):
+            value = self.cache.get(key)
+            if value is None:
+                missing.append(i)
+            else:
+                distances[i], indices[i] = value
+        if missing:
+            dist, ids = self.index.search(queries[missing], k=k, mask=mask, **search_kwargs)
+            for j, i in enumerate(missing):
+                distances[i], indices[i] = dist[j], ids[j]
+                self.cache.put(keys[i], (dist[j], ids[j]))
+        return distances, indices
@@ -0,0 +1,129 @@
+'''
+This python file embeds query images on the fly, so new photos do not need an offline feature
+extraction job. The global_pool output of simple_resnet.inference is computed in one TF session
+that is restored and warmed up once, and embeddings are cached by a hash of the image bytes.
+
+TensorFlow is only imported when a QueryEmbedder is created, so the rest of knn keeps working
+without it.
+'''
+import hashlib
+import os
+import sys
+import threading
+
+import cv2
+import numpy as np
+
+from cache import CACHE_SIZE, LRUCache
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                            'deep-shopping-baseline')
+MAX_BATCH = 64
+
+
+def read_image_bytes(image):
+    '''
+    :param image: an image path, or the encoded image as bytes
+    :return: the encoded image bytes
+    '''
+    if isinstance(image, bytes):
+        return image
+    with open(image, 'rb') as f:
+        return f.read()
+
+
+def content_key(data):
+    '''
+    :param data: encoded image bytes
+    :return: the digest the embedding is cached under. The same photo uploaded twice, or sent
+    once as a path and once as bytes, shares one entry
+    '''
+    return hashlib.sha1(data).hexdigest()
+
+
+class QueryEmbedder(object):
+    '''
+    A resident simple_resnet graph and session. Images are decoded, resized to the training
+    resolution and normalized as in fashion_input, then embedded in batches of up to max_batch.
+    '''
+    def __init__(self, checkpoint, num_residual_blocks=2, max_batch=MAX_BATCH,
+                 cache_size=CACHE_SIZE):
+        '''
+        :param checkpoint: the simple_resnet checkpoint to restore, e.g. FLAGS.test_ckpt_path
+        :param num_residual_blocks: n of the trained model, FLAGS.num_residual_blocks
+        :param max_batch: maximum number of images per session run
+        :param cache_size: number of embeddings kept in the LRU cache. 0 disables it
+        '''
+        if BASELINE_DIR not in sys.path:
+            sys.path.insert(0, BASELINE_DIR)
+        import tensorflow as tf
+        from fashion_input import IMG_COLS, IMG_ROWS, global_std, imageNet_mean_pixel
+        from simple_resnet import inference
+
+        self.image_size = (IMG_ROWS, IMG_COLS)
+        self.mean_pixel = np.array(imageNet_mean_pixel, dtype=np.float32)
+        self.std = global_std
+        self.max_batch = max_batch
+        self.cache = LRUCache(cache_size) if cache_size > 0 else None
+        self.lock = threading.Lock()
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.image_placeholder = tf.placeholder(dtype=tf.float32,
+                                                    shape=[None, IMG_ROWS, IMG_COLS, 3])
+            keep_prob = tf.constant(1.0)
+            # Variables cannot be created inside the map_fn loop, so build them outside first
+            inference(self.image_placeholder, n=num_residual_blocks, reuse=False,
+                      keep_prob_placeholder=keep_prob)
+            # The batch norm layers of simple_resnet normalize with the statistics of the batch
+            # they see. Mapping inference over the images gives every image its own statistics,
+            # so an embedding does not depend on what it was batched with and can be cached
+            self.embeddings = tf.map_fn(
+                lambda img: inference(img[None], n=num_residual_blocks, reuse=True,
+                                      keep_prob_placeholder=keep_prob)[2][0],
+                self.image_placeholder, parallel_iterations=max_batch)
+            self.sess = tf.Session()
+            tf.train.Saver(tf.global_variables()).restore(self.sess, checkpoint)
+        # The first run allocates the buffers and picks the kernels, so do it before serving
+        self.run(np.zeros((1, IMG_ROWS, IMG_COLS, 3), dtype=np.float32))
+        print('Query embedder restored from %s' % checkpoint)
+
+    def preprocess(self, data):
+        '''
+        :param data: encoded image bytes
+        :return: a float32 numpy array with dimensions [img_row, img_col, 3]
+        '''
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError('Cannot decode the query image')
+        img = cv2.resize(img, self.image_size).astype(np.float32)
+        return (img - self.mean_pixel) / self.std
+
+    def run(self, images):
+        '''
+        :param images: preprocessed images with dimensions [n, img_row, img_col, 3]
+        :return: the global_pool embeddings with dimensions [n, 64]
+        '''
+        outputs = []
+        with self.lock:
+            for start in range(0, len(images), self.max_batch):
+                outputs.append(self.sess.run(self.embeddings, feed_dict={
+                    self.image_placeholder: images[start:start + self.max_batch]}))
+        return np.concatenate(outputs).astype(np.float32)
+
+    def embed(self, images):
+        '''
+        :param images: a list of image paths or encoded image bytes
+        :return: their embeddings with dimensions [len(images), 64]
+        '''
+        data = [read_image_bytes(image) for image in images]
+        keys = [content_key(d) for d in data]
+        embeddings = [None if self.cache is None else self.cache.get(key) for key in keys]
+        missing = [i for i, e in enumerate(embeddings) if e is None]
+        if missing:
+            computed = self.run(np.stack([self.preprocess(data[i]) for i in missing]))
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+                if self.cache is not None:
+                    self.cache.put(keys[i], embedding)
+        return np.stack(embeddings)
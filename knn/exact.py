@@ -0,0 +1,334 @@
+'''
+This python file implements the exact k-nearest neighbor search used as the reference backend.
+Distances are computed block by block as ||q||^2 - 2 q.x + ||x||^2, so every block is one GEMM,
+and only the top-k of every block is kept. The blocks run on a thread pool; numpy releases the GIL
+inside the matrix products, so all cores are used while the memory per block stays bounded.
+'''
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+META_FILE = 'meta.json'
+BASE_BLOCK = 16384
+QUERY_BLOCK = 256
+
+
+def squared_norms(x):
+    '''
+    :param x: a numpy array with dimensions [n, dim]
+    :return: a float32 numpy array with the squared l2 norm of every row
+    '''
+    x = np.asarray(x, dtype=np.float32)
+    return np.einsum('ij,ij->i', x, x)
+
+
+def squared_distances(queries, base, base_norms=None):
+    '''
+    :param queries: a numpy array with dimensions [num_queries, dim]
+    :param base: a numpy array with dimensions [n, dim]
+    :param base_norms: optional precomputed squared norms of the base rows
+    :return: the squared euclidean distances with dimensions [num_queries, n]
+    '''
+    queries = np.asarray(queries, dtype=np.float32)
+    base = np.asarray(base, dtype=np.float32)
+    if base_norms is None:
+        base_norms = squared_norms(base)
+    dist = np.dot(queries, base.T)
+    dist *= -2
+    dist += squared_norms(queries)[:, None]
+    dist += base_norms[None, :]
+    np.maximum(dist, 0, out=dist)
+    return dist
+
+
+def inner_product_distances(queries, base):
+    '''
+    :param queries: a numpy array with dimensions [num_queries, dim]
+    :param base: a numpy array with dimensions [n, dim]
+    :return: 1 - q.x with dimensions [num_queries, n], i.e. the cosine distance when both sides
+    are l2-normalized. It is a single GEMM, without the norm terms of the euclidean distance
+    '''
+    dist = np.dot(np.asarray(queries, dtype=np.float32), np.asarray(base, dtype=np.float32).T)
+    dist *= -1
+    dist += 1
+    return dist
+
+
+def top_k(dist, k):
+    '''
+    :param dist: a numpy array of distances with dimensions [num_queries, n]
+    :param k: how many of the smallest distances to keep per row
+    :return: the positions and the distances of the k smallest entries per row, sorted ascending
+    '''
+    k = min(k, dist.shape[1])
+    if k < dist.shape[1]:
+        part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    else:
+        part = np.tile(np.arange(dist.shape[1]), (dist.shape[0], 1))
+    part_dist = np.take_along_axis(dist, part, axis=1)
+    order = np.argsort(part_dist, axis=1)
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_dist, order, axis=1)
+
+
+def merge_top_k(dist_list, ids_list, k):
+    '''
+    :param dist_list: a list of distance arrays with dimensions [num_queries, k_i]
+    :param ids_list: the matching list of id arrays
+    :param k: number of neighbors to keep
+    :return: the merged distances and ids with dimensions [num_queries, k], sorted ascending and
+    padded with inf and -1
+    '''
+    dist = np.concatenate(dist_list, axis=1)
+    ids = np.concatenate(ids_list, axis=1)
+    if dist.shape[1] < k:
+        pad = k - dist.shape[1]
+        dist = np.pad(dist, ((0, 0), (0, pad)), constant_values=np.inf)
+        ids = np.pad(ids, ((0, 0), (0, pad)), constant_values=-1)
+    pos, dist = top_k(dist, k)
+    return dist, np.take_along_axis(ids, pos, axis=1)
+
+
+def num_workers(n_jobs):
+    if n_jobs is None or n_jobs < 0:
+        return os.cpu_count() or 1
+    return n_jobs
+
+
+def exact_search(queries, base, k=6, base_norms=None, base_block=BASE_BLOCK,
+                 query_block=QUERY_BLOCK, n_jobs=-1, allowed=None, metric='l2'):
+    '''
+    :param queries: a numpy array with dimensions [num_queries, dim]
+    :param base: a numpy array (or memmap) with dimensions [n, dim]
+    :param k: number of neighbors to return
+    :param base_norms: optional precomputed squared norms of the base rows
+    :param base_block: number of base rows per distance block
+    :param query_block: number of queries per distance block
+    :param n_jobs: number of threads. -1 uses all cores
+    :param allowed: an optional boolean array over the base rows. Only the allowed rows of a
+    block are gathered, so filtered-out rows cost neither distances nor memory
+    :param metric: 'l2' for squared euclidean distances, 'ip' for 1 - inner product
+    :return: squared distances and base row positions with dimensions [num_queries, k]
+    '''
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    n = len(base)
+
+    def search_block(start):
+        if allowed is None:
+            rows = np.arange(start, min(start + base_block, n))
+            block = np.asarray(base[start:start + base_block], dtype=np.float32)
+        else:
+            rows = start + np.flatnonzero(allowed[start:start + base_block])
+            block = np.asarray(base[rows], dtype=np.float32)
+        norms = None if base_norms is None else np.asarray(base_norms)[rows]
+        block_dist = []
+        block_pos = []
+        for q in range(0, len(queries), query_block):
+            if metric == 'ip':
+                dist = inner_product_distances(queries[q:q + query_block], block)
+            else:
+                dist = squared_distances(queries[q:q + query_block], block, norms)
+            pos, dist = top_k(dist, k)
+            block_dist.append(dist)
+            block_pos.append(rows[pos])
+        return np.concatenate(block_dist), np.concatenate(block_pos)
+
+    starts = range(0, n, base_block)
+    workers = num_workers(n_jobs)
+    if workers == 1 or len(starts) == 1:
+        results = [search_block(start) for start in starts]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(search_block, starts))
+    if not results:
+        return np.full((len(queries), k), np.inf, dtype=np.float32), \
+            np.full((len(queries), k), -1, dtype=np.int64)
+    return merge_top_k([r[0] for r in results], [r[1] for r in results], k)
+
+
+def range_search(queries, base, radius, base_norms=None, base_block=BASE_BLOCK,
+                 query_block=QUERY_BLOCK, n_jobs=-1, allowed=None, max_results=None, metric='l2'):
+    '''
+    :param queries: a numpy array with dimensions [num_queries, dim]
+    :param base: a numpy array (or memmap) with dimensions [n, dim]
+    :param radius: the distance threshold, euclidean for 'l2' and 1 - q.x for 'ip'
+    :param base_norms: optional precomputed squared norms of the base rows
+    :param allowed: an optional boolean array over the base rows
+    :param max_results: keep at most this many of the closest matches per query
+    :param metric: 'l2' or 'ip'
+    :return: two lists with, for every query, the distances (squared for 'l2') and the base row
+    positions of the rows within radius, closest first
+    '''
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    n = len(base)
+    threshold = radius ** 2 if metric == 'l2' else radius
+    query_norms = np.sqrt(squared_norms(queries))
+
+    def search_block(start):
+        if allowed is None:
+            rows = np.arange(start, min(start + base_block, n))
+            block = np.asarray(base[start:start + base_block], dtype=np.float32)
+        else:
+            rows = start + np.flatnonzero(allowed[start:start + base_block])
+            block = np.asarray(base[rows], dtype=np.float32)
+        if len(rows) == 0:
+            return None
+        norms = squared_norms(block) if base_norms is None else np.asarray(base_norms)[rows]
+        active = np.arange(len(queries))
+        if metric == 'l2':
+            # | ||q|| - ||x|| | <= ||q - x||, so queries whose norm is too far from every norm of
+            # the block are skipped without computing their distances
+            block_norms = np.sqrt(norms)
+            lower = np.maximum(query_norms - block_norms.max(), block_norms.min() - query_norms)
+            active = np.flatnonzero(lower <= radius)
+        matches = []
+        for q in range(0, len(active), query_block):
+            chunk = active[q:q + query_block]
+            if metric == 'ip':
+                dist = inner_product_distances(queries[chunk], block)
+            else:
+                dist = squared_distances(queries[chunk], block, norms)
+            hit_query, hit_pos = np.nonzero(dist <= threshold)
+            matches.append((chunk[hit_query], dist[hit_query, hit_pos], rows[hit_pos]))
+        return matches
+
+    starts = range(0, n, base_block)
+    workers = num_workers(n_jobs)
+    if workers == 1 or len(starts) <= 1:
+        results = [search_block(start) for start in starts]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(search_block, starts))
+    matches = [m for block in results if block is not None for m in block]
+    hit_query = np.concatenate([m[0] for m in matches] + [np.zeros(0, dtype=np.int64)])
+    hit_dist = np.concatenate([m[1] for m in matches] + [np.zeros(0, dtype=np.float32)])
+    hit_pos = np.concatenate([m[2] for m in matches] + [np.zeros(0, dtype=np.int64)])
+    order = np.lexsort((hit_dist, hit_query))
+    bounds = np.searchsorted(hit_query[order], np.arange(len(queries) + 1))
+    distances = []
+    positions = []
+    for i in range(len(queries)):
+        rows = order[bounds[i]:bounds[i + 1]][:max_results]
+        distances.append(hit_dist[rows])
+        positions.append(hit_pos[rows])
+    return distances, positions
+
+
+def recall_at_k(found, truth, k=None):
+    '''
+    :param found: the ids returned by an approximate index with dimensions [num_queries, >= k]
+    :param truth: the exact ids with dimensions [num_queries, >= k]
+    :param k: the cut-off. Defaults to the width of truth
+    :return: the mean fraction of the true top-k found in the top-k
+    '''
+    k = truth.shape[1] if k is None else k
+    hits = [len(np.intersect1d(f[:k], t[:k])) for f, t in zip(found, truth)]
+    return float(np.sum(hits)) / (len(truth) * k)
+
+
+class ExactIndex(object):
+    '''
+    Brute-force index over the catalog. It is the ground truth for measuring the recall of the
+    approximate indexes.
+    '''
+    index_type = 'exact'
+
+    def __init__(self, base_block=BASE_BLOCK, query_block=QUERY_BLOCK, n_jobs=-1, metric='l2'):
+        '''
+        :param metric: 'l2' ranks by euclidean distance, 'ip' by inner product. With 'ip' the
+        distances returned are 1 - q.x, which is the cosine distance for normalized embeddings
+        '''
+        if metric not in ('l2', 'ip'):
+            raise ValueError('Unknown metric %s' % metric)
+        self.base_block = base_block
+        self.query_block = query_block
+        self.n_jobs = n_jobs
+        self.metric = metric
+        self.vectors = None
+        self.norms = None
+        self.ids = None
+
+    @property
+    def ntotal(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    def add(self, features, ids=None):
+        '''
+        :param features: a numpy array or memmap with dimensions [n, dim]. It is not copied
+        when the index is empty, so a feature store can be searched in place
+        :param ids: the catalog row ids. Defaults to the running row number
+        :return: self
+        '''
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + len(features))
+        ids = np.asarray(ids, dtype=np.int64)
+        norms = np.concatenate([squared_norms(features[start:start + self.base_block])
+                                for start in range(0, len(features), self.base_block)] +
+                               [np.zeros(0, dtype=np.float32)])
+        if self.ntotal > 0:
+            features = np.concatenate((np.asarray(self.vectors), features))
+            norms = np.concatenate((self.norms, norms))
+            ids = np.concatenate((self.ids, ids))
+        self.vectors, self.norms, self.ids = features, norms, ids
+        return self
+
+    def fit(self, features, ids=None):
+        return self.add(features, ids)
+
+    def search(self, queries, k=6, mask=None):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param k: number of neighbors to return
+        :param mask: an optional boolean array indexed by catalog id. Only the ids set in it are
+        scanned and returned
+        :return: distances and catalog ids with dimensions [num_queries, k], in the same layout
+        as NearestNeighbors.kneighbors
+        '''
+        allowed = None if mask is None else np.asarray(mask)[np.asarray(self.ids)]
+        dist, pos = exact_search(queries, self.vectors, k=k, base_norms=self.norms,
+                                 base_block=self.base_block, query_block=self.query_block,
+                                 n_jobs=self.n_jobs, allowed=allowed, metric=self.metric)
+        ids = np.where(pos >= 0, np.asarray(self.ids)[np.maximum(pos, 0)], -1)
+        return (dist if self.metric == 'ip' else np.sqrt(dist)), ids
+
+    def range_search(self, queries, radius, max_results=None, mask=None):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param radius: return every item within this distance of the query
+        :param max_results: keep at most this many of the closest items per query
+        :param mask: an optional boolean array indexed by catalog id
+        :return: two lists with the distances and the catalog ids of every query, closest first
+        '''
+        allowed = None if mask is None else np.asarray(mask)[np.asarray(self.ids)]
+        dist, pos = range_search(queries, self.vectors, radius, base_norms=self.norms,
+                                 base_block=self.base_block, query_block=self.query_block,
+                                 n_jobs=self.n_jobs, allowed=allowed, max_results=max_results,
+                                 metric=self.metric)
+        if self.metric == 'l2':
+            dist = [np.sqrt(d) for d in dist]
+        return dist, [np.asarray(self.ids)[p] for p in pos]
+
+    def save(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'vectors.npy'), np.asarray(self.vectors, dtype=np.float32))
+        np.save(os.path.join(path, 'norms.npy'), self.norms)
+        np.save(os.path.join(path, 'ids.npy'), self.ids)
+        meta = {'type': self.index_type, 'ntotal': self.ntotal,
+                'dim': int(self.vectors.shape[1]), 'base_block': self.base_block,
+                'query_block': self.query_block, 'metric': self.metric}
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap=True, n_jobs=-1):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        index = cls(base_block=meta['base_block'], query_block=meta['query_block'], n_jobs=n_jobs,
+                    metric=meta.get('metric', 'l2'))
+        index.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode=mmap_mode)
+        index.norms = np.load(os.path.join(path, 'norms.npy'), mmap_mode=mmap_mode)
+        index.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode=mmap_mode)
+        return index
@@ -0,0 +1,204 @@
+'''
+This python file implements the on-disk feature store of the catalog embeddings. The rows are
+kept in one binary file with a small header and opened through mmap, so query processes start
+instantly and share the pages through the OS cache instead of each holding a copy of
+features.npy in memory.
+
+Layout of a store directory:
+    rows.bin        the header followed by fixed-width float32 or float16 rows
+    ids.npy         the catalog id of every row
+    id_order.npy    the rows sorted by id, used to map ids back to rows
+    sorted_ids.npy  the ids in that order
+    image_paths.npy the image_path of every row as fixed-width bytes (optional)
+'''
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b'FSTORE01'
+VERSION = 1
+HEADER_FORMAT = '<8sIIQI'
+HEADER_SIZE = 64
+DTYPES = {1: np.float32, 2: np.float16}
+DTYPE_CODES = {np.dtype(np.float32): 1, np.dtype(np.float16): 2}
+CHUNK_ROWS = 65536
+
+
+def write_header(f, dtype, num_rows, dim):
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, DTYPE_CODES[np.dtype(dtype)], num_rows,
+                         dim)
+    f.seek(0)
+    f.write(header.ljust(HEADER_SIZE, b'\0'))
+
+
+def read_header(f):
+    '''
+    :param f: a binary file object positioned anywhere
+    :return: the row dtype, the number of rows and the row dimension
+    '''
+    f.seek(0)
+    magic, version, dtype_code, num_rows, dim = struct.unpack(
+        HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT)))
+    if magic != MAGIC:
+        raise ValueError('Not a feature store file!!!')
+    if version != VERSION:
+        raise ValueError('Unsupported feature store version %d' % version)
+    return DTYPES[dtype_code], num_rows, dim
+
+
+class FeatureStoreWriter(object):
+    '''
+    Writes a feature store chunk by chunk, so the full matrix never has to be in memory.
+    '''
+    def __init__(self, path, dim, dtype=np.float32):
+        '''
+        :param path: the store directory to create
+        :param dim: dimension of the embeddings
+        :param dtype: np.float32 or np.float16
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.num_rows = 0
+        self.ids = []
+        self.image_paths = []
+        self.f = open(os.path.join(path, 'rows.bin'), 'wb')
+        write_header(self.f, self.dtype, 0, dim)
+
+    def append(self, features, ids=None, image_paths=None):
+        '''
+        :param features: a numpy array with dimensions [n, dim]
+        :param ids: the catalog ids of the rows. Defaults to the running row number
+        :param image_paths: the image path of every row
+        '''
+        features = np.ascontiguousarray(features, dtype=self.dtype)
+        assert features.ndim == 2 and features.shape[1] == self.dim
+        if ids is None:
+            ids = np.arange(self.num_rows, self.num_rows + len(features))
+        self.f.seek(0, os.SEEK_END)
+        self.f.write(features.tobytes())
+        self.ids.append(np.asarray(ids, dtype=np.int64))
+        if image_paths is not None:
+            self.image_paths.extend(image_paths)
+        self.num_rows += len(features)
+
+    def close(self):
+        write_header(self.f, self.dtype, self.num_rows, self.dim)
+        self.f.close()
+        ids = np.concatenate(self.ids) if self.ids else np.zeros(0, dtype=np.int64)
+        np.save(os.path.join(self.path, 'ids.npy'), ids)
+        id_order = np.argsort(ids, kind='stable')
+        np.save(os.path.join(self.path, 'id_order.npy'), id_order)
+        np.save(os.path.join(self.path, 'sorted_ids.npy'), ids[id_order])
+        if self.image_paths:
+            assert len(self.image_paths) == self.num_rows
+            paths = np.array([p.encode('utf-8') for p in self.image_paths])
+            np.save(os.path.join(self.path, 'image_paths.npy'), paths)
+
+
+class FeatureStore(object):
+    '''
+    A read-only view of a feature store. store.features is a numpy memmap with dimensions
+    [num_rows, dim]; nothing is read from disk until it is touched.
+    '''
+    def __init__(self, path):
+        '''
+        :param path: a store directory written by FeatureStoreWriter
+        '''
+        self.path = path
+        rows_path = os.path.join(path, 'rows.bin')
+        with open(rows_path, 'rb') as f:
+            self.dtype, num_rows, self.dim = read_header(f)
+        self.features = np.memmap(rows_path, dtype=self.dtype, mode='r', offset=HEADER_SIZE,
+                                  shape=(num_rows, self.dim))
+        self.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+        self.id_order = np.load(os.path.join(path, 'id_order.npy'), mmap_mode='r')
+        self.sorted_ids = np.load(os.path.join(path, 'sorted_ids.npy'), mmap_mode='r')
+        paths_file = os.path.join(path, 'image_paths.npy')
+        self.image_paths = np.load(paths_file, mmap_mode='r') if os.path.exists(paths_file) \
+            else None
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    def rows_for(self, ids, strict=True):
+        '''
+        :param ids: catalog ids
+        :param strict: raise KeyError for unknown ids. Otherwise their row is -1
+        :return: the rows holding them
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        pos = np.searchsorted(self.sorted_ids, ids)
+        pos = np.minimum(pos, len(self.id_order) - 1)
+        rows = np.asarray(self.id_order[pos])
+        unknown = self.ids[rows] != ids
+        if len(rows) and np.any(unknown):
+            if strict:
+                raise KeyError('Unknown ids: %s' % ids[unknown])
+            rows = np.where(unknown, -1, rows)
+        return rows
+
+    def get(self, ids, dtype=np.float32):
+        '''
+        :param ids: catalog ids
+        :return: their embeddings, converted to dtype
+        '''
+        return np.asarray(self.features[self.rows_for(ids)], dtype=dtype)
+
+    def image_path(self, rows):
+        '''
+        :param rows: row numbers
+        :return: a list with the image path of every row
+        '''
+        return [p.decode('utf-8') for p in self.image_paths[np.asarray(rows)]]
+
+    def chunks(self, chunk_rows=CHUNK_ROWS, dtype=np.float32):
+        '''
+        :param chunk_rows: number of rows per chunk
+        :return: a generator of (start_row, float32 chunk) pairs over the whole store
+        '''
+        for start in range(0, len(self), chunk_rows):
+            yield start, np.asarray(self.features[start:start + chunk_rows], dtype=dtype)
+
+
+def build_feature_store(features_path, path, csv_path=None, dtype=np.float32,
+                        chunk_rows=CHUNK_ROWS):
+    '''
+    Convert a features .npy file, and optionally the image_path column of a csv, into a store.
+    :param features_path: path of a .npy file with dimensions [n, dim]
+    :param path: the store directory to create
+    :param csv_path: a csv with an image_path column, aligned with the features rows
+    :param dtype: np.float32 or np.float16
+    :param chunk_rows: number of rows copied at a time
+    :return: the opened FeatureStore
+    '''
+    features = np.load(features_path, mmap_mode='r')
+    image_paths = None
+    if csv_path is not None:
+        image_paths = pd.read_csv(csv_path, usecols=['image_path'])['image_path'].tolist()
+        image_paths = image_paths[:len(features)]
+
+    writer = FeatureStoreWriter(path, features.shape[1], dtype=dtype)
+    for start in range(0, len(features), chunk_rows):
+        writer.append(features[start:start + chunk_rows],
+                      image_paths=None if image_paths is None else
+                      image_paths[start:start + chunk_rows])
+    writer.close()
+    return FeatureStore(path)
+
+
+def open_feature_store(path, features_path=None, csv_path=None, dtype=np.float32):
+    '''
+    :param path: the store directory
+    :param features_path: the .npy file to build the store from if it does not exist yet
+    :param csv_path: the csv with the image_path column, used when building
+    :return: the opened FeatureStore
+    '''
+    if not os.path.exists(os.path.join(path, 'rows.bin')):
+        print('Building feature store ', path)
+        return build_feature_store(features_path, path, csv_path=csv_path, dtype=dtype)
+    return FeatureStore(path)
@@ -0,0 +1,93 @@
+'''
+This python file builds the metadata bitmaps used to filter the k-nearest neighbor search, e.g.
+to keep recommendations within the garment category of the query. A bitmap is a boolean array
+indexed by catalog id; every index takes it as the mask argument of search() and only scans the
+ids set in it, so the top-k stays full without over-fetching.
+'''
+import numpy as np
+import pandas as pd
+
+
+def column_bitmaps(df, column):
+    '''
+    :param df: a pandas dataframe whose rows are the catalog ids
+    :param column: the metadata column, e.g. 'category' or 'split'
+    :return: a dict from every value of the column to its bitmap
+    '''
+    values = df[column].values
+    return dict((value, values == value) for value in np.unique(values))
+
+
+def category_bitmaps(csv_path):
+    '''
+    :param csv_path: a csv with a category column, such as vali_modified.csv
+    :return: a dict from every category to its bitmap
+    '''
+    return column_bitmaps(pd.read_csv(csv_path, usecols=['category']), 'category')
+
+
+def load_attribute_bitmaps(attr_path, image_paths):
+    '''
+    Read the DeepFashion attribute annotations (list_attr_img.txt: the number of images, a header
+    line, then one line per image with its path followed by one 1/-1 flag per attribute).
+    :param attr_path: path of the annotation file
+    :param image_paths: the image_path of every catalog id
+    :return: a boolean array with dimensions [num_ids, num_attributes]. Images without
+    annotations have no attribute set
+    '''
+    row_of = dict((path, i) for i, path in enumerate(image_paths))
+    attributes = None
+    with open(attr_path) as f:
+        f.readline()
+        f.readline()
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            flags = np.array(fields[1:], dtype=np.int8) > 0
+            if attributes is None:
+                attributes = np.zeros((len(image_paths), len(flags)), dtype=bool)
+            row = row_of.get(fields[0])
+            if row is not None:
+                attributes[row] = flags
+    return attributes
+
+
+def attribute_mask(attributes, columns):
+    '''
+    :param attributes: the boolean array of load_attribute_bitmaps, [num_ids, num_attributes]
+    :param columns: the attribute columns an item must all have
+    :return: the bitmap of the ids having every one of them
+    '''
+    return np.all(attributes[:, list(columns)], axis=1)
+
+
+def combine(*bitmaps):
+    '''
+    :return: the bitmap of the ids set in all the given bitmaps. None entries are ignored
+    '''
+    bitmaps = [b for b in bitmaps if b is not None]
+    if not bitmaps:
+        return None
+    return np.logical_and.reduce(bitmaps)
+
+
+def filtered_search(index, queries, query_keys, bitmaps, k=6, **search_kwargs):
+    '''
+    Search every query within its own bitmap. Queries sharing a key are searched as one batch.
+    :param index: any index with a search(queries, k, mask=...) method
+    :param queries: a numpy array with dimensions [num_queries, dim]
+    :param query_keys: the bitmap key of every query, e.g. its category
+    :param bitmaps: a dict from key to bitmap. Keys missing from it are searched unfiltered
+    :param k: number of neighbors to return
+    :return: distances and catalog ids with dimensions [num_queries, k]
+    '''
+    queries = np.atleast_2d(queries)
+    query_keys = np.asarray(query_keys)
+    distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+    indices = np.full((len(queries), k), -1, dtype=np.int64)
+    for key in np.unique(query_keys):
+        rows = np.flatnonzero(query_keys == key)
+        dist, ids = index.search(queries[rows], k=k, mask=bitmaps.get(key), **search_kwargs)
+        distances[rows], indices[rows] = dist, ids
+    return distances, indices
@@ -0,0 +1,253 @@
+'''
+This python file implements a hierarchical navigable small world (HNSW) graph index for the
+k-nearest neighbor search. Items can be inserted one at a time, so new catalog products are added
+to the graph without rebuilding it. More details in Malkov & Yashunin, "Efficient and robust
+approximate nearest neighbor search using Hierarchical Navigable Small World graphs".
+'''
+import heapq
+import json
+import os
+
+import numpy as np
+
+META_FILE = 'meta.json'
+
+
+class HNSWIndex(object):
+    '''
+    The HNSW graph. Vectors live in one growable float32 array, and links[node][level] is the
+    neighbor list of a node on a level.
+    '''
+    index_type = 'hnsw'
+
+    def __init__(self, dim, M=16, ef_construction=200, ef=50, seed=0):
+        '''
+        :param dim: dimension of the embeddings
+        :param M: number of links per node on the upper levels. Level 0 keeps 2 * M
+        :param ef_construction: size of the candidate list while inserting
+        :param ef: default size of the candidate list while searching
+        :param seed: random seed for drawing the node levels
+        '''
+        self.dim = dim
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.level_mult = 1.0 / np.log(M)
+        self.rng = np.random.RandomState(seed)
+
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.levels = []
+        self.links = []
+        self.entry_point = -1
+        self.max_level = -1
+
+    @property
+    def ntotal(self):
+        return len(self.levels)
+
+    def max_links(self, level):
+        return 2 * self.M if level == 0 else self.M
+
+    def distances(self, query, nodes):
+        '''
+        :param query: a numpy array with dimensions [dim]
+        :param nodes: a list of node numbers
+        :return: the squared euclidean distances from the query to the nodes
+        '''
+        diff = self.vectors[nodes] - query
+        return np.einsum('ij,ij->i', diff, diff)
+
+    def search_layer(self, query, entry_points, ef, level, allowed=None):
+        '''
+        Greedy beam search on one level of the graph.
+        :param query: a numpy array with dimensions [dim]
+        :param entry_points: a list of (distance, node) pairs to start from
+        :param ef: size of the candidate list
+        :param level: the level to search on
+        :param allowed: an optional boolean array over the nodes. Filtered-out nodes are still
+        walked through but never enter the results
+        :return: up to ef (distance, node) pairs, closest first
+        '''
+        visited = set(node for _, node in entry_points)
+        candidates = list(entry_points)
+        heapq.heapify(candidates)
+        results = [(-dist, node) for dist, node in entry_points
+                   if allowed is None or allowed[node]]
+        heapq.heapify(results)
+
+        while candidates:
+            dist, node = heapq.heappop(candidates)
+            if len(results) >= ef and dist > -results[0][0]:
+                break
+            neighbors = [n for n in self.links[node][level] if n not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            for n_dist, n in zip(self.distances(query, neighbors), neighbors):
+                if len(results) < ef or n_dist < -results[0][0]:
+                    heapq.heappush(candidates, (n_dist, n))
+                    if allowed is not None and not allowed[n]:
+                        continue
+                    heapq.heappush(results, (-n_dist, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted((-dist, node) for dist, node in results)
+
+    def select_neighbors(self, candidates, m):
+        '''
+        The neighbor selection heuristic: a candidate is kept only if it is closer to the base
+        node than to every neighbor kept so far, which spreads links in different directions.
+        :param candidates: (distance, node) pairs sorted closest first
+        :param m: maximum number of neighbors to keep
+        :return: the selected node numbers
+        '''
+        selected = []
+        for dist, node in candidates:
+            if len(selected) >= m:
+                break
+            if not selected or np.all(self.distances(self.vectors[node], selected) > dist):
+                selected.append(node)
+        return selected
+
+    def grow(self, num_new):
+        capacity = len(self.vectors)
+        if self.ntotal + num_new <= capacity:
+            return
+        capacity = max(self.ntotal + num_new, 2 * capacity, 1024)
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:self.ntotal] = self.vectors[:self.ntotal]
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[:self.ntotal] = self.ids[:self.ntotal]
+        self.vectors, self.ids = vectors, ids
+
+    def insert(self, vector, item_id=None):
+        '''
+        :param vector: a numpy array with dimensions [dim]
+        :param item_id: the catalog row id. Defaults to the running row number
+        :return: the node number of the inserted item
+        '''
+        self.grow(1)
+        node = self.ntotal
+        level = int(-np.log(1.0 - self.rng.random_sample()) * self.level_mult)
+        self.vectors[node] = vector
+        self.ids[node] = node if item_id is None else item_id
+        self.levels.append(level)
+        self.links.append([[] for _ in range(level + 1)])
+
+        if self.entry_point < 0:
+            self.entry_point, self.max_level = node, level
+            return node
+
+        query = self.vectors[node]
+        ep = [(self.distances(query, [self.entry_point])[0], self.entry_point)]
+        for lc in range(self.max_level, level, -1):
+            ep = self.search_layer(query, ep, 1, lc)[:1]
+
+        for lc in range(min(level, self.max_level), -1, -1):
+            ep = self.search_layer(query, ep, self.ef_construction, lc)
+            neighbors = self.select_neighbors(ep, self.M)
+            self.links[node][lc] = neighbors
+            for n in neighbors:
+                n_links = self.links[n][lc]
+                n_links.append(node)
+                if len(n_links) > self.max_links(lc):
+                    n_dist = self.distances(self.vectors[n], n_links)
+                    pairs = sorted(zip(n_dist, n_links))
+                    self.links[n][lc] = self.select_neighbors(pairs, self.max_links(lc))
+
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+        return node
+
+    def add(self, features, ids=None):
+        '''
+        :param features: a numpy array with dimensions [n, dim], inserted one row at a time
+        :param ids: the catalog row ids. Defaults to the running row number
+        :return: self
+        '''
+        features = np.asarray(features, dtype=np.float32)
+        self.grow(len(features))
+        for i in range(len(features)):
+            self.insert(features[i], None if ids is None else ids[i])
+        return self
+
+    def fit(self, features, ids=None):
+        return self.add(features, ids)
+
+    def search(self, queries, k=6, ef=None, mask=None):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param k: number of neighbors to return
+        :param ef: size of the candidate list. Defaults to self.ef, never below k
+        :param mask: an optional boolean array indexed by catalog id. Only the ids set in it are
+        returned
+        :return: distances and catalog ids with dimensions [num_queries, k], in the same layout
+        as NearestNeighbors.kneighbors. Missing neighbors are padded with inf and -1
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        ef = max(self.ef if ef is None else ef, k)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        if self.entry_point < 0:
+            return distances, indices
+
+        allowed = None if mask is None else np.asarray(mask)[self.ids[:self.ntotal]]
+        for i, query in enumerate(queries):
+            ep = [(self.distances(query, [self.entry_point])[0], self.entry_point)]
+            for lc in range(self.max_level, 0, -1):
+                ep = self.search_layer(query, ep, 1, lc)[:1]
+            found = self.search_layer(query, ep, ef, 0, allowed)[:k]
+            distances[i, :len(found)] = np.sqrt([dist for dist, _ in found])
+            indices[i, :len(found)] = self.ids[[node for _, node in found]]
+        return distances, indices
+
+    def save(self, path):
+        '''
+        The links are saved in CSR layout: link_offsets has one entry per (node, level) pair, in
+        node order and then level order.
+        :param path: a directory to write the index into
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        flat = [level_links for node_links in self.links for level_links in node_links]
+        link_offsets = np.concatenate(([0], np.cumsum([len(l) for l in flat]))).astype(np.int64)
+        link_targets = np.array([n for l in flat for n in l], dtype=np.int32)
+        np.save(os.path.join(path, 'vectors.npy'), self.vectors[:self.ntotal])
+        np.save(os.path.join(path, 'ids.npy'), self.ids[:self.ntotal])
+        np.save(os.path.join(path, 'levels.npy'), np.array(self.levels, dtype=np.int32))
+        np.save(os.path.join(path, 'link_offsets.npy'), link_offsets)
+        np.save(os.path.join(path, 'link_targets.npy'), link_targets)
+        meta = {'type': self.index_type, 'dim': self.dim, 'M': self.M,
+                'ef_construction': self.ef_construction, 'ef': self.ef, 'ntotal': self.ntotal,
+                'entry_point': self.entry_point, 'max_level': self.max_level}
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        :param path: a directory written by save()
+        :return: the loaded index, ready for more insertions
+        '''
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        index = cls(meta['dim'], M=meta['M'], ef_construction=meta['ef_construction'],
+                    ef=meta['ef'])
+        index.vectors = np.load(os.path.join(path, 'vectors.npy'))
+        index.ids = np.load(os.path.join(path, 'ids.npy'))
+        index.levels = np.load(os.path.join(path, 'levels.npy')).tolist()
+        link_offsets = np.load(os.path.join(path, 'link_offsets.npy'))
+        link_targets = np.load(os.path.join(path, 'link_targets.npy')).tolist()
+
+        pos = 0
+        for level in index.levels:
+            node_links = []
+            for _ in range(level + 1):
+                node_links.append(link_targets[link_offsets[pos]:link_offsets[pos + 1]])
+                pos += 1
+            index.links.append(node_links)
+        index.entry_point = meta['entry_point']
+        index.max_level = meta['max_level']
+        return index
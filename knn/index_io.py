@@ -0,0 +1,70 @@
+'''
+This python file loads any saved index directory. Every index writes its type into meta.json, so
+the right class can be picked without the caller knowing how the index was built.
+'''
+import importlib
+import json
+import os
+
+from ivf import META_FILE
+
+# index type -> the module and the class that load it. A module is only imported when an index
+# of its type is first loaded, so the indexes wrapping other indexes can import load_index
+# without an import cycle
+INDEX_MODULES = {
+    'exact': ('exact', 'ExactIndex'),
+    'ivf': ('ivf', 'IVFIndex'),
+    'ivfpq': ('pq', 'IVFPQIndex'),
+    'pq': ('pq', 'PQIndex'),
+    'hnsw': ('hnsw', 'HNSWIndex'),
+    'lsh': ('lsh', 'BinaryHashIndex'),
+    'sharded': ('sharded', 'ShardedIndex'),
+    'inner_product': ('metric', 'InnerProductIndex'),
+    'pca': ('pca', 'PCAIndex'),
+    'segmented': ('segments', 'SegmentedIndex'),
+}
+# index type -> class, filled as the types are loaded
+INDEX_CLASSES = {}
+
+
+def read_meta(path):
+    '''
+    :param path: a saved index directory
+    :return: the dict stored in its meta.json
+    '''
+    with open(os.path.join(path, META_FILE)) as f:
+        return json.load(f)
+
+
+def write_meta(path, meta):
+    '''
+    Write meta.json through a temporary file, so a crash never leaves a half-written file.
+    :param path: a saved index directory
+    :param meta: the dict to store
+    '''
+    tmp = os.path.join(path, META_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, os.path.join(path, META_FILE))
+
+
+def index_class(index_type):
+    '''
+    :param index_type: the type written in meta.json, e.g. 'ivf'
+    :return: the index class of that type
+    '''
+    if index_type not in INDEX_CLASSES:
+        module, name = INDEX_MODULES[index_type]
+        INDEX_CLASSES[index_type] = getattr(importlib.import_module(module), name)
+    return INDEX_CLASSES[index_type]
+
+
+def load_index(path):
+    '''
+    :param path: a saved index directory
+    :return: the loaded index
+    '''
+    index_type = read_meta(path)['type']
+    if index_type not in INDEX_MODULES:
+        raise ValueError('Unknown index type %s in %s' % (index_type, path))
+    return index_class(index_type).load(path)
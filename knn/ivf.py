@@ -0,0 +1,281 @@
+'''
+This python file implements a persistent inverted-file (IVF) index for the k-nearest neighbor
+search. A k-means coarse quantizer splits the catalog into cells, and every cell keeps a posting
+list of the rows assigned to it. A query only scans the nprobe cells closest to it.
+'''
+import json
+import os
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+from exact import squared_distances, squared_norms, top_k
+
+META_FILE = 'meta.json'
+TRAIN_POINTS_PER_LIST = 256
+
+
+class IVFIndex(object):
+    '''
+    The inverted-file index. Rows are stored grouped by cell so that every posting list is a
+    contiguous slice of the vector array, which keeps the saved index loadable through mmap.
+    '''
+    index_type = 'ivf'
+
+    def __init__(self, n_lists=256, nprobe=8):
+        '''
+        :param n_lists: number of k-means cells of the coarse quantizer
+        :param nprobe: default number of cells to scan per query
+        '''
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.centroids = None
+        self.offsets = None
+        self.ids = None
+        self.vectors = None
+        self.norms = None
+        # Distance from every centroid to its farthest row, for pruning range searches
+        self.radii = None
+
+    @property
+    def ntotal(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    def train(self, features, seed=0):
+        '''
+        :param features: a numpy array with dimensions [n, dim] to learn the coarse quantizer from
+        :param seed: random seed for the sampling and for k-means
+        :return: self
+        '''
+        features = np.asarray(features, dtype=np.float32)
+        n_lists = min(self.n_lists, len(features))
+        num_train = min(len(features), n_lists * TRAIN_POINTS_PER_LIST)
+        rng = np.random.RandomState(seed)
+        sample = features[rng.choice(len(features), num_train, replace=False)]
+        kmeans = KMeans(n_clusters=n_lists, n_init=1, random_state=seed).fit(sample)
+        self.n_lists = n_lists
+        self.centroids = kmeans.cluster_centers_.astype(np.float32)
+        return self
+
+    def assign(self, features):
+        '''
+        :param features: a numpy array with dimensions [n, dim]
+        :return: the cell of every row
+        '''
+        return np.argmin(squared_distances(features, self.centroids), axis=1)
+
+    def add(self, features, ids=None):
+        '''
+        Fill the posting lists. Any rows already in the index are kept.
+        :param features: a numpy array with dimensions [n, dim]
+        :param ids: the catalog row ids. Defaults to the running row number
+        :return: self
+        '''
+        features = np.asarray(features, dtype=np.float32)
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + len(features))
+        ids = np.asarray(ids, dtype=np.int64)
+        lists = self.assign(features)
+        if self.ntotal > 0:
+            old_lists = np.repeat(np.arange(self.n_lists), np.diff(self.offsets))
+            lists = np.concatenate((old_lists, lists))
+            features = np.concatenate((np.asarray(self.vectors), features))
+            ids = np.concatenate((np.asarray(self.ids), ids))
+
+        order = np.argsort(lists, kind='stable')
+        counts = np.bincount(lists, minlength=self.n_lists)
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.vectors = features[order]
+        self.ids = ids[order]
+        self.norms = squared_norms(self.vectors)
+        self.set_radii(lists, features - self.centroids[lists])
+        return self
+
+    def set_radii(self, lists, residuals):
+        '''
+        :param lists: the cell of every row
+        :param residuals: every row minus its cell centroid
+        '''
+        self.radii = np.zeros(self.n_lists, dtype=np.float32)
+        np.maximum.at(self.radii, lists, np.sqrt(squared_norms(residuals)))
+
+    def fit(self, features, ids=None):
+        '''
+        :param features: a numpy array with dimensions [n, dim]
+        :param ids: the catalog row ids. Defaults to 0..n-1
+        :return: self
+        '''
+        return self.train(features).add(features, ids)
+
+    def allowed_rows(self, mask):
+        '''
+        :param mask: a boolean array indexed by catalog id, or None
+        :return: the same filter indexed by row position, or None
+        '''
+        return None if mask is None else np.asarray(mask)[np.asarray(self.ids)]
+
+    def probe(self, queries, nprobe, allowed=None, k=0):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param nprobe: number of cells to scan per query
+        :param allowed: an optional boolean array over the rows. When it is given, cells are
+        added beyond nprobe until they hold at least k allowed rows, so a filtered top-k stays full
+        :param k: number of neighbors the scan has to find
+        :return: a list with the cells to scan for every query, closest first
+        '''
+        nprobe = min(nprobe, self.n_lists)
+        centroid_dist = squared_distances(queries, self.centroids)
+        if allowed is None:
+            cells, _ = top_k(centroid_dist, nprobe)
+            return list(cells)
+
+        cum_allowed = np.concatenate(([0], np.cumsum(allowed)))
+        counts = cum_allowed[self.offsets[1:]] - cum_allowed[self.offsets[:-1]]
+        probes = []
+        for order in np.argsort(centroid_dist, axis=1):
+            enough = np.cumsum(counts[order]) >= k
+            num_cells = np.argmax(enough) + 1 if enough[-1] else self.n_lists
+            probes.append(order[:max(nprobe, num_cells)])
+        return probes
+
+    def candidates(self, cells, allowed=None):
+        '''
+        :param cells: the cells to scan for one query
+        :param allowed: an optional boolean array over the rows
+        :return: the row positions held by those cells that pass the filter
+        '''
+        rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in cells])
+        return rows if allowed is None else rows[allowed[rows]]
+
+    def scan(self, query, cells, k, allowed=None):
+        '''
+        :param query: a numpy array with dimensions [dim]
+        :param cells: the cells to scan
+        :param k: number of neighbors to return
+        :param allowed: an optional boolean array over the rows
+        :return: the squared distances and the catalog ids of up to k neighbors, closest first
+        '''
+        rows = self.candidates(cells, allowed)
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        dist = squared_distances(query[None, :], self.vectors[rows], self.norms[rows])
+        pos, dist = top_k(dist, k)
+        return dist[0], np.asarray(self.ids)[rows[pos[0]]]
+
+    def search(self, queries, k=6, nprobe=None, mask=None):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param k: number of neighbors to return
+        :param nprobe: number of cells to scan per query. Defaults to self.nprobe
+        :param mask: an optional boolean array indexed by catalog id. Only the ids set in it are
+        scanned and returned
+        :return: distances and catalog ids with dimensions [num_queries, k], in the same layout
+        as NearestNeighbors.kneighbors. Missing neighbors are padded with inf and -1
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = self.nprobe if nprobe is None else nprobe
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+
+        allowed = self.allowed_rows(mask)
+        for i, cells in enumerate(self.probe(queries, nprobe, allowed, k)):
+            dist, ids = self.scan(queries[i], cells, k, allowed)
+            distances[i, :len(ids)] = np.sqrt(dist)
+            indices[i, :len(ids)] = ids
+        return distances, indices
+
+    def range_scan(self, query, cells, radius, allowed=None):
+        '''
+        :param query: a numpy array with dimensions [dim]
+        :param cells: the cells to scan
+        :param radius: the euclidean distance threshold
+        :param allowed: an optional boolean array over the rows
+        :return: the squared distances and the catalog ids of the rows within radius
+        '''
+        rows = self.candidates(cells, allowed)
+        dist = squared_distances(query[None, :], self.vectors[rows], self.norms[rows])[0]
+        within = dist <= radius ** 2
+        return dist[within], np.asarray(self.ids)[rows[within]]
+
+    def range_search(self, queries, radius, nprobe=None, max_results=None, mask=None):
+        '''
+        Cells are visited by increasing lower bound ||q - c|| - radius_c of their distance to the
+        query, and the visit stops at the first cell that cannot hold a match. With max_results,
+        the threshold shrinks to the distance of the last kept match once the cap is reached.
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param radius: return every item within this distance of the query
+        :param nprobe: maximum number of cells per query. Defaults to no limit, which keeps the
+        search exact
+        :param max_results: keep at most this many of the closest items per query
+        :param mask: an optional boolean array indexed by catalog id
+        :return: two lists with the distances and the catalog ids of every query, closest first
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        allowed = self.allowed_rows(mask)
+        radii = np.full(self.n_lists, np.inf, dtype=np.float32) if self.radii is None \
+            else self.radii
+        lower = np.sqrt(squared_distances(queries, self.centroids)) - radii
+        distances = []
+        indices = []
+        for i in range(len(queries)):
+            limit = radius
+            found_dist = np.zeros(0, dtype=np.float32)
+            found_ids = np.zeros(0, dtype=np.int64)
+            for c in np.argsort(lower[i])[:nprobe]:
+                if lower[i, c] > limit:
+                    break
+                dist, ids = self.range_scan(queries[i], [c], limit, allowed)
+                found_dist = np.concatenate((found_dist, dist))
+                found_ids = np.concatenate((found_ids, ids))
+                if max_results is not None and len(found_ids) >= max_results:
+                    keep = np.argsort(found_dist)[:max_results]
+                    found_dist, found_ids = found_dist[keep], found_ids[keep]
+                    limit = np.sqrt(found_dist[-1])
+            order = np.argsort(found_dist)
+            distances.append(np.sqrt(found_dist[order]))
+            indices.append(found_ids[order])
+        return distances, indices
+
+    def save(self, path):
+        '''
+        :param path: a directory to write the index into
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(path, 'ids.npy'), np.asarray(self.ids))
+        np.save(os.path.join(path, 'vectors.npy'), np.asarray(self.vectors))
+        np.save(os.path.join(path, 'norms.npy'), np.asarray(self.norms))
+        np.save(os.path.join(path, 'radii.npy'), self.radii)
+        meta = {'type': self.index_type, 'n_lists': self.n_lists, 'nprobe': self.nprobe,
+                'ntotal': self.ntotal, 'dim': int(self.centroids.shape[1])}
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        :param path: a directory written by save()
+        :param mmap: map the posting lists instead of reading them into memory
+        :return: the loaded index
+        '''
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        index = cls(n_lists=meta['n_lists'], nprobe=meta['nprobe'])
+        index.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        index.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        index.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode=mmap_mode)
+        index.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode=mmap_mode)
+        index.norms = np.load(os.path.join(path, 'norms.npy'), mmap_mode=mmap_mode)
+        index.radii = load_radii(path)
+        return index
+
+
+def load_radii(path):
+    '''
+    :return: the cell radii saved in path, or None for indexes saved before they were added
+    '''
+    radii_path = os.path.join(path, 'radii.npy')
+    return np.load(radii_path) if os.path.exists(radii_path) else None
@@ -1,19 +1,142 @@
 from sklearn.neighbors import NearestNeighbors
+import os
 import numpy as np
 import pandas as pd
-import cv2
+from ivf import IVFIndex
+from hnsw import HNSWIndex
+from feature_store import open_feature_store
+from pq import IVFPQIndex
+from exact import ExactIndex
+from metric import InnerProductIndex, cosine_index
+from mmr import diversified_search
+from filters import (attribute_mask, category_bitmaps, combine, filtered_search,
+                     load_attribute_bitmaps)
+from atlas import build_atlas, load_atlas, render_grid
 
-features = np.load('demo/output/features.npy')
+IVF_INDEX_DIR = 'demo/output/ivf_index'
+HNSW_INDEX_DIR = 'demo/output/hnsw_index'
+IVFPQ_INDEX_DIR = 'demo/output/ivfpq_index'
+COSINE_INDEX_DIR = 'demo/output/cosine_%s_index'
+CATALOG_CSV = 'demo/full_data_revised.csv'
+ATTRIBUTES_FILE = 'demo/list_attr_img.txt'
+ATLAS_PATH = 'demo/output/thumbnails.npy'
+
+# The feature stores are built once from the .npy files and then opened through mmap
+store = open_feature_store('demo/output/feature_store', features_path='demo/output/features.npy',
+                           csv_path=CATALOG_CSV)
+features = store.features
 print('num of images = ', len(features))
 print('features loaded!')
 
-feature_wenxin = np.load('demo/output/features_wenxin.npy')
+feature_wenxin = open_feature_store('demo/output/feature_store_wenxin',
+                                    features_path='demo/output/features_wenxin.npy').features
+
+def load_ivf_index(path=IVF_INDEX_DIR, n_lists=256, index_class=IVFIndex):
+    '''
+    :param path: the directory of a saved IVF index
+    :param n_lists: number of cells to use if the index has to be built
+    :param index_class: IVFIndex, or IVFPQIndex to keep PQ codes in the posting lists
+    :return: the IVF index over all features. It is built and saved once, then reloaded
+    '''
+    if os.path.isdir(path):
+        return index_class.load(path)
+    index = index_class(n_lists=n_lists).fit(features[:, :])
+    index.save(path)
+    print('IVF index saved to ', path)
+    return index
+
+
+def load_hnsw_index(path=HNSW_INDEX_DIR, new_features=None):
+    '''
+    :param path: the directory of a saved HNSW index
+    :param new_features: catalog rows added since the index was saved. They are inserted one at
+    a time and the index is saved again
+    :return: the HNSW index over all features
+    '''
+    if os.path.isdir(path):
+        index = HNSWIndex.load(path)
+        if new_features is None:
+            return index
+        index.add(new_features)
+    else:
+        index = HNSWIndex(dim=features.shape[1]).add(features[:, :])
+    index.save(path)
+    return index
+
+
+def load_cosine_index(backend='exact'):
+    '''
+    :param backend: 'exact', 'ivf' or 'hnsw', the index searching the normalized embeddings
+    :return: an index ranking by cosine similarity. It stores the embeddings normalized, so they
+    are normalized once when it is built and not on every search
+    '''
+    path = COSINE_INDEX_DIR % backend
+    if os.path.isdir(path):
+        return InnerProductIndex.load(path)
+    if backend == 'ivf':
+        index = cosine_index(IVFIndex(n_lists=256))
+    elif backend == 'hnsw':
+        index = cosine_index(HNSWIndex(dim=features.shape[1]))
+    else:
+        index = cosine_index()
+    index.fit(features[:, :])
+    index.save(path)
+    return index
+
+
+def find_knn(k = 6, backend='ivf', nprobe=8, ef=50, same_category=False, metric='euclidean',
+             mmr_lambda=None, attributes=None):
+    '''
+    :param attributes: DeepFashion attribute columns every recommendation must have, read from
+    ATTRIBUTES_FILE. They are searched as a bitmap, combined with the category bitmaps
+    '''
+    search_kwargs = {}
+    if metric == 'cosine':
+        if backend not in ('exact', 'ivf', 'hnsw'):
+            raise ValueError('The %s backend has no cosine mode!!!' % backend)
+        index = load_cosine_index(backend)
+        search_kwargs = {'ivf': {'nprobe': nprobe}, 'hnsw': {'ef': ef}}.get(backend, {})
+    elif backend == 'ivf':
+        index = load_ivf_index()
+        search_kwargs['nprobe'] = nprobe
+    elif backend == 'ivfpq':
+        index = load_ivf_index(IVFPQ_INDEX_DIR, index_class=IVFPQIndex)
+        search_kwargs['nprobe'] = nprobe
+    elif backend == 'exact':
+        index = ExactIndex().fit(features)
+    elif backend == 'hnsw':
+        index = load_hnsw_index()
+        search_kwargs['ef'] = ef
+    else:
+        if same_category is True or attributes is not None:
+            raise ValueError('The ball tree cannot filter by category or attributes!!!')
+        nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree', n_jobs=-1).fit(features[:, :])
+        index = None
+    attribute_bitmap = None
+    if attributes is not None:
+        attribute_bitmap = attribute_mask(load_attribute_bitmaps(
+            ATTRIBUTES_FILE, store.image_path(np.arange(len(store)))), attributes)
+        search_kwargs['mask'] = attribute_bitmap
+    kneighbors = nbrs.kneighbors if index is None else \
+        lambda x: index.search(x, k=k, **search_kwargs)
+    if mmr_lambda is not None and index is not None:
+        # Re-rank a wider candidate list so the top-k is not near-identical shots of one product
+        kneighbors = lambda x: diversified_search(index, x, store.get, k=k, lambda_=mmr_lambda,
+                                                  **search_kwargs)
 
-def find_knn(k = 6):
-    nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree', n_jobs=-1).fit(features[:, :])
-    distances, indices = nbrs.kneighbors(feature_wenxin)
+    distances, indices = kneighbors(feature_wenxin)
     print('First half done...')
-    distances, a = nbrs.kneighbors(features[60000:61000, 1:])
+    if same_category is True:
+        # Keep the recommendations of every catalog query within its own category
+        categories = pd.read_csv(CATALOG_CSV, usecols=['category'])['category'].values
+        bitmaps = dict((category, combine(bitmap, attribute_bitmap))
+                       for category, bitmap in category_bitmaps(CATALOG_CSV).items())
+        category_kwargs = dict((key, value) for key, value in search_kwargs.items()
+                               if key != 'mask')
+        distances, a = filtered_search(index, features[60000:61000, 1:], categories[60000:61000],
+                                       bitmaps, k=k, **category_kwargs)
+    else:
+        distances, a = kneighbors(features[60000:61000, 1:])
     indices = np.concatenate((indices, a))
     print(indices[0:5])
     np.save('demo/output/indices_wenxin.npy', indices)
@@ -21,12 +144,16 @@ def find_knn(k = 6):
 
 find_knn()
 
-imgs = pd.read_csv('demo/full_data_revised.csv', usecols=['image_path']).values
 idx = np.load('demo/output/indices_wenxin.npy')
 
-for i in range(1910, 1915):
-    for j in idx[i, :]:
-        img = cv2.imread(imgs[j, 0])
-        cv2.imshow('image', img)
-        cv2.waitKey(0)
+# Render the results from the thumbnail atlas instead of decoding every full-size JPEG
+if os.path.exists(ATLAS_PATH):
+    atlas = load_atlas(ATLAS_PATH)
+else:
+    atlas = build_atlas(store.image_path(np.arange(len(store))), ATLAS_PATH)
+query_rows = np.arange(1910, 1915)
+# The first rows of idx belong to the wenxin queries, which have no catalog thumbnail
+query_rows = np.where(query_rows >= len(feature_wenxin),
+                      query_rows - len(feature_wenxin) + 60000, -1)
+render_grid(atlas, query_rows, idx[1910:1915, :], out_path='demo/output/recommendations.jpg')
 
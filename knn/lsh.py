@@ -0,0 +1,158 @@
+'''
+This python file implements the binary hash prefilter: every embedding gets a sign random
+projection code packed into uint64 words. A query first ranks the whole catalog by Hamming
+distance with vectorized XOR + popcount, then only the top few hundred candidates are re-ranked
+with exact float distances.
+'''
+import json
+import os
+
+import numpy as np
+
+from exact import squared_distances, squared_norms, top_k
+from ivf import META_FILE
+
+SCAN_BLOCK = 262144
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(x):
+    '''
+    :param x: a uint64 numpy array
+    :return: the number of set bits of every element, as uint8
+    '''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    return POPCOUNT_TABLE[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def hamming_distances(query_code, codes):
+    '''
+    :param query_code: the uint64 code of one query with dimensions [words]
+    :param codes: uint64 codes with dimensions [n, words]
+    :return: the Hamming distances with dimensions [n]
+    '''
+    return popcount(np.bitwise_xor(codes, query_code)).sum(axis=1, dtype=np.int32)
+
+
+class BinaryHashIndex(object):
+    '''
+    Sign random projection codes with an exact re-rank. The float vectors are only touched for
+    the re-ranked candidates, so they can stay memory-mapped.
+    '''
+    index_type = 'lsh'
+
+    def __init__(self, dim, n_bits=256, rerank=256, seed=0):
+        '''
+        :param dim: dimension of the embeddings
+        :param n_bits: code length, a multiple of 64
+        :param rerank: default number of Hamming candidates re-ranked exactly
+        '''
+        if n_bits % 64 != 0:
+            raise ValueError('n_bits must be a multiple of 64')
+        self.dim = dim
+        self.n_bits = n_bits
+        self.rerank = rerank
+        rng = np.random.RandomState(seed)
+        self.projections = rng.randn(dim, n_bits).astype(np.float32)
+        self.mean = np.zeros(dim, dtype=np.float32)
+        self.codes = np.zeros((0, n_bits // 64), dtype=np.uint64)
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+
+    @property
+    def ntotal(self):
+        return len(self.ids)
+
+    def train(self, features):
+        '''
+        Center the projections on the catalog mean. global_pool outputs are non-negative, so
+        uncentered hyperplanes would put almost every embedding on the same side.
+        '''
+        self.mean = np.asarray(features, dtype=np.float32).mean(axis=0)
+        return self
+
+    def encode(self, x):
+        '''
+        :param x: a numpy array with dimensions [n, dim]
+        :return: the uint64 codes with dimensions [n, n_bits / 64]
+        '''
+        x = np.atleast_2d(np.asarray(x, dtype=np.float32))
+        bits = np.dot(x - self.mean, self.projections) > 0
+        packed = np.packbits(bits, axis=1)
+        return np.ascontiguousarray(packed).view(np.uint64)
+
+    def add(self, features, ids=None):
+        features = np.asarray(features, dtype=np.float32)
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + len(features))
+        self.codes = np.concatenate((np.asarray(self.codes), self.encode(features)))
+        self.vectors = np.concatenate((np.asarray(self.vectors), features))
+        self.norms = np.concatenate((np.asarray(self.norms), squared_norms(features)))
+        self.ids = np.concatenate((np.asarray(self.ids), np.asarray(ids, dtype=np.int64)))
+        return self
+
+    def fit(self, features, ids=None):
+        return self.train(features).add(features, ids)
+
+    def search(self, queries, k=6, rerank=None, mask=None):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param k: number of neighbors to return
+        :param rerank: number of Hamming candidates re-ranked exactly. Defaults to self.rerank
+        :param mask: an optional boolean array indexed by catalog id
+        :return: distances and catalog ids with dimensions [num_queries, k], in the same layout
+        as NearestNeighbors.kneighbors
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        rerank = max(self.rerank if rerank is None else rerank, k)
+        query_codes = self.encode(queries)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        rows = np.arange(self.ntotal) if mask is None else \
+            np.flatnonzero(np.asarray(mask)[np.asarray(self.ids)])
+        if len(rows) == 0:
+            return distances, indices
+        codes = self.codes if mask is None else self.codes[rows]
+
+        for i in range(len(queries)):
+            hamming = np.concatenate([
+                hamming_distances(query_codes[i], codes[start:start + SCAN_BLOCK])
+                for start in range(0, len(rows), SCAN_BLOCK)])
+            candidates, _ = top_k(hamming[None, :], rerank)
+            candidates = rows[candidates[0]]
+            dist = squared_distances(queries[i:i + 1], self.vectors[candidates],
+                                     self.norms[candidates])
+            pos, dist = top_k(dist, k)
+            distances[i, :pos.shape[1]] = np.sqrt(dist[0])
+            indices[i, :pos.shape[1]] = self.ids[candidates[pos[0]]]
+        return distances, indices
+
+    def save(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'projections.npy'), self.projections)
+        np.save(os.path.join(path, 'mean.npy'), self.mean)
+        np.save(os.path.join(path, 'codes.npy'), np.asarray(self.codes))
+        np.save(os.path.join(path, 'vectors.npy'), np.asarray(self.vectors))
+        np.save(os.path.join(path, 'norms.npy'), np.asarray(self.norms))
+        np.save(os.path.join(path, 'ids.npy'), np.asarray(self.ids))
+        meta = {'type': self.index_type, 'dim': self.dim, 'n_bits': self.n_bits,
+                'rerank': self.rerank, 'ntotal': self.ntotal}
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        index = cls(meta['dim'], n_bits=meta['n_bits'], rerank=meta['rerank'])
+        index.projections = np.load(os.path.join(path, 'projections.npy'))
+        index.mean = np.load(os.path.join(path, 'mean.npy'))
+        index.codes = np.load(os.path.join(path, 'codes.npy'), mmap_mode=mmap_mode)
+        index.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode=mmap_mode)
+        index.norms = np.load(os.path.join(path, 'norms.npy'), mmap_mode=mmap_mode)
+        index.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode=mmap_mode)
+        return index
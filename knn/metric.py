@@ -0,0 +1,153 @@
+'''
+This python file adds cosine and maximum inner product (MIPS) search on top of the euclidean
+indexes. Cosine embeddings are l2-normalized once at ingest and stored normalized, so ranking by
+cosine is ranking by inner product. Unnormalized inner products are reduced to euclidean search by
+appending one coordinate sqrt(M^2 - ||x||^2) to every catalog embedding and 0 to every query:
+||q' - x'||^2 = ||q||^2 + M^2 - 2 q.x, so the nearest neighbors are the largest inner products.
+
+Both modes return distances as 1 - q.x, ascending, so results merge like any other index.
+'''
+import json
+import os
+
+import numpy as np
+
+from exact import ExactIndex, squared_norms
+from index_io import load_index
+from ivf import META_FILE
+
+METRICS = ('cosine', 'ip')
+EPSILON = 1e-12
+
+
+def normalize(x):
+    '''
+    :param x: a numpy array with dimensions [n, dim]
+    :return: a float32 copy with every row scaled to unit l2 norm. Zero rows stay zero
+    '''
+    x = np.atleast_2d(np.asarray(x, dtype=np.float32))
+    return x / np.maximum(np.sqrt(squared_norms(x)), EPSILON)[:, None]
+
+
+def mips_augment(features, max_norm):
+    '''
+    :param features: a numpy array with dimensions [n, dim]
+    :param max_norm: an upper bound of the l2 norm of every catalog embedding
+    :return: the embeddings with the extra coordinate sqrt(max_norm^2 - ||x||^2), [n, dim + 1]
+    '''
+    features = np.atleast_2d(np.asarray(features, dtype=np.float32))
+    extra = np.sqrt(np.maximum(max_norm ** 2 - squared_norms(features), 0))
+    return np.hstack((features, extra[:, None]))
+
+
+def mips_query(queries):
+    '''
+    :param queries: a numpy array with dimensions [num_queries, dim]
+    :return: the queries with a zero coordinate appended, [num_queries, dim + 1]
+    '''
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    return np.hstack((queries, np.zeros((len(queries), 1), dtype=np.float32)))
+
+
+class InnerProductIndex(object):
+    '''
+    Wraps any index to rank by cosine similarity or by inner product. An ExactIndex built with
+    metric='ip' is searched directly with one GEMM per block; every other index searches the
+    normalized or MIPS-augmented embeddings by euclidean distance, and the distances are mapped
+    back to 1 - q.x.
+    '''
+    index_type = 'inner_product'
+
+    def __init__(self, index, metric='cosine'):
+        '''
+        :param index: an unfilled index, e.g. ExactIndex(metric='ip') or IVFIndex(). Indexes
+        that take a dim need dim + 1 for 'ip', as the MIPS reduction adds one coordinate
+        :param metric: 'cosine' or 'ip'
+        '''
+        if metric not in METRICS:
+            raise ValueError('Unknown metric %s' % metric)
+        self.index = index
+        self.metric = metric
+        self.max_norm = None
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    @property
+    def ids(self):
+        return self.index.ids
+
+    @property
+    def native(self):
+        # True when the wrapped index ranks by inner product itself
+        return getattr(self.index, 'metric', 'l2') == 'ip'
+
+    def prepare(self, features):
+        '''
+        :return: the embeddings as stored in the wrapped index
+        '''
+        if self.metric == 'cosine':
+            return normalize(features)
+        if self.native:
+            return np.asarray(features, dtype=np.float32)
+        if self.max_norm is None:
+            self.max_norm = float(np.sqrt(squared_norms(features).max()))
+        norms = np.sqrt(squared_norms(features))
+        if norms.max() > self.max_norm * (1 + 1e-6):
+            raise ValueError('Embedding norm %f is above the max_norm %f of the index' %
+                             (norms.max(), self.max_norm))
+        return mips_augment(features, self.max_norm)
+
+    def fit(self, features, ids=None):
+        self.index.fit(self.prepare(features), ids)
+        return self
+
+    def add(self, features, ids=None):
+        self.index.add(self.prepare(features), ids)
+        return self
+
+    def search(self, queries, k=6, **search_kwargs):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param k: number of neighbors to return
+        :param search_kwargs: arguments of the wrapped search, e.g. mask, nprobe or ef
+        :return: the distances 1 - q.x and the catalog ids with dimensions [num_queries, k]. For
+        cosine this is the cosine distance
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.metric == 'cosine':
+            queries = normalize(queries)
+        if self.native:
+            return self.index.search(queries, k=k, **search_kwargs)
+        if self.metric == 'cosine':
+            dist, ids = self.index.search(queries, k=k, **search_kwargs)
+            # ||q - x||^2 = 2 - 2 q.x for unit vectors
+            return np.where(ids >= 0, dist ** 2 / 2, np.inf).astype(np.float32), ids
+        dist, ids = self.index.search(mips_query(queries), k=k, **search_kwargs)
+        inner = (squared_norms(queries)[:, None] + self.max_norm ** 2 - dist ** 2) / 2
+        return np.where(ids >= 0, 1 - inner, np.inf).astype(np.float32), ids
+
+    def save(self, path):
+        self.index.save(os.path.join(path, 'base'))
+        meta = {'type': self.index_type, 'metric': self.metric, 'max_norm': self.max_norm,
+                'ntotal': self.ntotal}
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        index = cls(load_index(os.path.join(path, 'base')), metric=meta['metric'])
+        index.max_norm = meta['max_norm']
+        return index
+
+
+def cosine_index(index=None):
+    '''
+    :param index: the unfilled index to search the normalized embeddings with. Defaults to an
+    exact inner product scan
+    :return: an InnerProductIndex ranking by cosine similarity
+    '''
+    return InnerProductIndex(ExactIndex(metric='ip') if index is None else index, 'cosine')
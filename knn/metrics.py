@@ -0,0 +1,203 @@
+'''
+This python file keeps the latency and throughput metrics of the retrieval path: one latency
+histogram per stage (query embedding, candidate search, re-ranking, id to row join, image path
+lookup), request counters and the hit rates of the caches. Histograms are HDR-style: log-linear
+buckets with 64 linear sub-buckets per power of two, so recording is a few integer operations
+and every percentile is exact to within 1/64 from 1 microsecond to hours, in a fixed 2k counters
+per stage.
+
+Example:
+    metrics = Metrics()
+    with metrics.time('search'):
+        index.search(queries, k=6)
+    metrics.snapshot()['stages']['search']['p99_ms']
+'''
+import json
+import os
+import threading
+import time
+
+SUB_BUCKET_BITS = 7
+MAX_MICROSECONDS = 2 ** 36
+PERCENTILES = (50, 90, 99, 99.9)
+DUMP_SECONDS = 60.0
+
+
+def bucket_index(value):
+    '''
+    :param value: a latency in whole microseconds
+    :return: its bucket. Values below 2^SUB_BUCKET_BITS get one bucket each; above that, every
+    power of two is split into 2^(SUB_BUCKET_BITS - 1) equal buckets
+    '''
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    if shift <= 0:
+        return value
+    half = 1 << (SUB_BUCKET_BITS - 1)
+    return shift * half + (value >> shift)
+
+
+def bucket_value(index):
+    '''
+    :return: the highest latency in microseconds falling into the bucket
+    '''
+    half = 1 << (SUB_BUCKET_BITS - 1)
+    if index < 2 * half:
+        return index
+    shift = index // half - 1
+    return (((index % half) + half + 1) << shift) - 1
+
+
+class LatencyHistogram(object):
+    '''
+    A thread-safe latency histogram with HDR-style buckets.
+    '''
+    def __init__(self):
+        self.counts = [0] * (bucket_index(MAX_MICROSECONDS) + 1)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        value = min(int(seconds * 1e6), MAX_MICROSECONDS)
+        index = bucket_index(value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentiles(self, percentiles=PERCENTILES):
+        '''
+        :return: the latency in microseconds at every percentile, in the same order
+        '''
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        ranks = [max(1, int(round(count * p / 100.0))) for p in percentiles]
+        results = [0] * len(ranks)
+        # One pass over the buckets answers every percentile, from the lowest rank up
+        order = sorted(range(len(ranks)), key=lambda i: ranks[i])
+        seen = 0
+        next_rank = 0
+        for index, c in enumerate(counts):
+            seen += c
+            while next_rank < len(order) and seen >= ranks[order[next_rank]]:
+                results[order[next_rank]] = bucket_value(index)
+                next_rank += 1
+            if next_rank == len(order):
+                break
+        return results
+
+    def snapshot(self, uptime):
+        '''
+        :param uptime: seconds since the metrics started, to compute the QPS
+        :return: a dict with the count, QPS, mean, max and percentiles in milliseconds
+        '''
+        result = {'count': self.count, 'qps': self.count / uptime if uptime > 0 else 0.0,
+                  'mean_ms': self.total / 1e3 / self.count if self.count else 0.0,
+                  'max_ms': self.max / 1e3}
+        for p, value in zip(PERCENTILES, self.percentiles()):
+            # A bucket is reported by its upper end, which may lie above the largest sample
+            result['p%s_ms' % ('%g' % p).replace('.', '')] = min(value, self.max) / 1e3
+        return result
+
+
+class StageTimer(object):
+    '''
+    Records the time spent in a with block into a histogram, even when the block raises.
+    '''
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.record(time.perf_counter() - self.start)
+        return False
+
+
+class Metrics(object):
+    '''
+    A registry of stage histograms, counters and cache statistics.
+    '''
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.caches = {}
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage, LatencyHistogram())
+        return histogram
+
+    def time(self, stage):
+        '''
+        :return: a context manager recording the duration of its block as a sample of stage
+        '''
+        return StageTimer(self.histogram(stage))
+
+    def record(self, stage, seconds):
+        self.histogram(stage).record(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def watch_cache(self, name, cache):
+        '''
+        :param cache: an LRUCache, or None. Its hit rate is reported with the metrics
+        '''
+        if cache is not None:
+            self.caches[name] = cache
+
+    def snapshot(self):
+        '''
+        :return: a JSON-serializable dict of every stage, counter and cache
+        '''
+        uptime = time.time() - self.started
+        with self.lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+        return {'time': time.time(), 'uptime_s': uptime,
+                'stages': dict((stage, histogram.snapshot(uptime))
+                               for stage, histogram in sorted(histograms.items())),
+                'counters': dict((name, {'count': n, 'qps': n / uptime if uptime > 0 else 0.0})
+                                 for name, n in sorted(counters.items())),
+                'caches': dict((name, cache.stats()) for name, cache in self.caches.items())}
+
+
+class MetricsDumper(object):
+    '''
+    Writes a snapshot of the metrics to a JSON file every interval seconds. The file is replaced
+    in one rename, so a reader never sees a partial dump.
+    '''
+    def __init__(self, metrics, path, interval=DUMP_SECONDS):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def dump(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.metrics.snapshot(), f, indent=2)
+        os.replace(tmp, self.path)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.dump()
+            except (IOError, OSError) as e:
+                print('Could not write the metrics to %s: %s' % (self.path, e))
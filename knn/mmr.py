@@ -0,0 +1,94 @@
+'''
+This python file re-ranks retrieved candidates with maximal marginal relevance (MMR), so the top-k
+is not filled with near-identical shots of one product. Items are picked one at a time by
+    lambda * sim(q, x) - (1 - lambda) * max_{s picked} sim(x, s)
+using cosine similarities. The max over the picked items is kept per candidate and only updated
+with the similarities to the newest pick, so choosing k of N candidates costs O(N * k) dot
+products instead of recomputing the whole redundancy term at every step.
+'''
+import numpy as np
+
+from metric import normalize
+
+MMR_LAMBDA = 0.7
+CANDIDATES_PER_RESULT = 5
+
+
+def mmr(queries, candidates, candidate_ids, k, lambda_=MMR_LAMBDA):
+    '''
+    :param queries: a numpy array with dimensions [num_queries, dim]
+    :param candidates: the candidate embeddings with dimensions [num_queries, n, dim]
+    :param candidate_ids: their catalog ids with dimensions [num_queries, n]. -1 marks padding
+    :param k: number of items to pick
+    :param lambda_: 1 ranks by relevance only, 0 by diversity only
+    :return: the picked catalog ids with dimensions [num_queries, k], in pick order and padded
+    with -1, and their positions among the candidates
+    '''
+    num_queries, n, dim = candidates.shape
+    queries = normalize(queries)
+    candidates = normalize(candidates.reshape(-1, dim)).reshape(num_queries, n, dim)
+    relevance = np.einsum('qnd,qd->qn', candidates, queries)
+    redundancy = np.zeros((num_queries, n), dtype=np.float32)
+    available = np.asarray(candidate_ids) >= 0
+    rows = np.arange(num_queries)
+    picks = np.full((num_queries, k), -1, dtype=np.int64)
+
+    for step in range(min(k, n)):
+        # The first pick has no redundancy term, so it is the most relevant candidate
+        scores = relevance if step == 0 else lambda_ * relevance - (1 - lambda_) * redundancy
+        scores = np.where(available, scores, -np.inf)
+        pick = np.argmax(scores, axis=1)
+        valid = available[rows, pick]
+        picks[valid, step] = pick[valid]
+        available[rows, pick] = False
+        similarity = np.einsum('qnd,qd->qn', candidates, candidates[rows, pick])
+        np.maximum(redundancy, similarity, out=redundancy)
+
+    ids = np.where(picks >= 0, np.take_along_axis(np.asarray(candidate_ids),
+                                                  np.maximum(picks, 0), axis=1), -1)
+    return ids, picks
+
+
+def mmr_rerank(queries, dist, ids, get_vectors, k, lambda_=MMR_LAMBDA):
+    '''
+    :param queries: a numpy array with dimensions [num_queries, dim]
+    :param dist: the distances of the retrieved candidates with dimensions [num_queries, n]
+    :param ids: their catalog ids with dimensions [num_queries, n], padded with -1
+    :param get_vectors: a function from catalog ids to their embeddings, e.g. FeatureStore.get
+    :param k: number of items to keep
+    :param lambda_: the MMR trade-off between relevance and diversity
+    :return: the distances and catalog ids of the picked items with dimensions [num_queries, k]
+    '''
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    found = ids >= 0
+    vectors = np.zeros(ids.shape + (queries.shape[1],), dtype=np.float32)
+    vectors[found] = get_vectors(ids[found])
+    picked_ids, picks = mmr(queries, vectors, ids, k, lambda_)
+    picked_dist = np.where(picks >= 0, np.take_along_axis(dist, np.maximum(picks, 0), axis=1),
+                           np.inf)
+    return picked_dist.astype(np.float32), picked_ids
+
+
+def diversified_search(index, queries, get_vectors, k=6, lambda_=MMR_LAMBDA,
+                       num_candidates=None, **search_kwargs):
+    '''
+    :param index: any index with a search(queries, k, ...) method
+    :param queries: a numpy array with dimensions [num_queries, dim]
+    :param get_vectors: a function from catalog ids to their embeddings, e.g. FeatureStore.get
+    :param k: number of items to return
+    :param lambda_: the MMR trade-off between relevance and diversity
+    :param num_candidates: number of neighbors re-ranked per query. Defaults to
+    CANDIDATES_PER_RESULT * k
+    :param search_kwargs: extra arguments of index.search, e.g. mask, nprobe or ef
+    :return: the index distances and catalog ids of the picked items, [num_queries, k]
+    '''
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    dist, ids = index.search(queries, k=num_mmr_candidates(k, num_candidates), **search_kwargs)
+    return mmr_rerank(queries, dist, ids, get_vectors, k, lambda_)
+
+
+def num_mmr_candidates(k, num_candidates=None):
+    '''
+    :return: the number of neighbors to retrieve for an MMR re-ranking to k items
+    '''
+    return max(k, CANDIDATES_PER_RESULT * k if num_candidates is None else int(num_candidates))
@@ -0,0 +1,85 @@
+'''
+This python file answers "outfit" queries: one request carries several query embeddings, e.g. the
+top and the bottom detected in one photo, with a weight each, and gets back one fused ranking.
+All garments go to the index as one batch, so the catalog is scanned once for the whole outfit.
+
+Two fusions are supported:
+    min: an item scores its best weighted match, min_j d_j(x) / w_j. The fused top-k is always
+         inside the union of the per-garment top-k, so those lists are the only candidates.
+         Dividing by the weight only favors heavy garments for non-negative distances, so it
+         needs euclidean or cosine distances
+    sum: an item scores sum_j w_j ||q_j - x||^2, which is W ||c - x||^2 + sum_j w_j ||q_j - c||^2
+         for W = sum_j w_j and c the weighted mean of the queries, so a single query does it
+'''
+import numpy as np
+
+from exact import squared_norms
+
+FUSIONS = ('min', 'sum')
+# The index metrics whose distances are never negative
+MIN_FUSION_METRICS = ('l2', 'cosine')
+
+
+def fuse_min(dist, ids, weights, k):
+    '''
+    :param dist: the non-negative distances of every garment with dimensions [num_garments, k]
+    :param ids: the matching catalog ids
+    :param weights: the weight of every garment
+    :param k: number of items to keep
+    :return: the fused scores and catalog ids with dimensions [k], padded with inf and -1
+    '''
+    scores = (dist / weights[:, None]).ravel()
+    ids = ids.ravel()
+    found = ids >= 0
+    scores, ids = scores[found], ids[found]
+    # An item found by several garments keeps its best score
+    order = np.lexsort((scores, ids))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = ids[order][1:] != ids[order][:-1]
+    scores, ids = scores[order][first], ids[order][first]
+    best = np.argsort(scores, kind='stable')[:k]
+    fused_scores = np.full(k, np.inf, dtype=np.float32)
+    fused_ids = np.full(k, -1, dtype=np.int64)
+    fused_scores[:len(best)], fused_ids[:len(best)] = scores[best], ids[best]
+    return fused_scores, fused_ids
+
+
+def outfit_search(index, queries, weights=None, k=6, fusion='min', mask=None, **search_kwargs):
+    '''
+    :param index: any index with a search(queries, k, mask=...) method
+    :param queries: the garment embeddings with dimensions [num_garments, dim]
+    :param weights: a positive weight per garment. Defaults to equal weights
+    :param k: number of items to return
+    :param fusion: 'min' or 'sum', see the top of this file. 'min' needs euclidean or cosine
+    distances, 'sum' euclidean ones
+    :param mask: an optional boolean array indexed by catalog id
+    :param search_kwargs: extra arguments of index.search, e.g. nprobe or ef
+    :return: the fused scores and catalog ids with dimensions [k], best first
+    '''
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    weights = np.ones(len(queries), dtype=np.float32) if weights is None else \
+        np.asarray(weights, dtype=np.float32)
+    if len(weights) != len(queries):
+        raise ValueError('Got %d weights for %d garments' % (len(weights), len(queries)))
+    if np.any(weights <= 0):
+        raise ValueError('Garment weights must be positive')
+    if fusion not in FUSIONS:
+        raise ValueError('Unknown fusion %s' % fusion)
+
+    if fusion == 'min':
+        if getattr(index, 'metric', 'l2') not in MIN_FUSION_METRICS:
+            # 1 - q.x is negative for large inner products, and dividing it by the weight would
+            # push the matches of heavy garments down instead of up
+            raise ValueError('The min fusion needs an index ranking by euclidean or cosine '
+                             'distance')
+        dist, ids = index.search(queries, k=k, mask=mask, **search_kwargs)
+        return fuse_min(dist, ids, weights, k)
+
+    if getattr(index, 'metric', 'l2') != 'l2':
+        raise ValueError('The sum fusion needs an index ranking by euclidean distance')
+    total = weights.sum()
+    center = np.dot(weights, queries) / total
+    spread = np.dot(weights, squared_norms(queries - center))
+    dist, ids = index.search(center[None, :], k=k, mask=mask, **search_kwargs)
+    scores = np.where(ids[0] >= 0, total * dist[0] ** 2 + spread, np.inf)
+    return scores.astype(np.float32), ids[0]
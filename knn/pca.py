@@ -0,0 +1,154 @@
+'''
+This python file adds a PCA stage in front of any index. The global_pool features of simple_resnet
+are strongly correlated, so most of their variance fits in far fewer dimensions, and search time
+and index memory shrink linearly with the dimension. The projection is fitted once, applied to the
+catalog at ingest and to every query, and saved next to the index it feeds.
+
+Example:
+    index = PCAIndex(IVFIndex(), PCA(32)).fit(features)
+'''
+import json
+import os
+
+import numpy as np
+
+from index_io import load_index
+from ivf import META_FILE
+
+CHUNK_ROWS = 65536
+EPSILON = 1e-12
+
+
+class PCA(object):
+    '''
+    A principal component projection, optionally whitened so that every kept component has unit
+    variance. Whitening ranks by the Mahalanobis distance of the catalog, not the euclidean one.
+    '''
+    def __init__(self, dim, whiten=False):
+        '''
+        :param dim: number of components to keep, e.g. 32 for the 64-d global_pool features
+        :param whiten: scale every component to unit variance
+        '''
+        self.dim = dim
+        self.whiten = whiten
+        self.mean = None
+        self.components = None
+        self.variances = None
+        self.explained_variance = None
+
+    @property
+    def fitted(self):
+        return self.components is not None
+
+    def fit(self, features, chunk_rows=CHUNK_ROWS):
+        '''
+        :param features: a numpy array or memmap with dimensions [n, input_dim]. It is read in
+        chunks, so the whole catalog never has to be in memory
+        :return: self
+        '''
+        n, input_dim = features.shape
+        if self.dim > input_dim:
+            raise ValueError('Cannot keep %d of %d dimensions' % (self.dim, input_dim))
+        total = np.zeros(input_dim)
+        scatter = np.zeros((input_dim, input_dim))
+        for start in range(0, n, chunk_rows):
+            chunk = np.asarray(features[start:start + chunk_rows], dtype=np.float64)
+            total += chunk.sum(axis=0)
+            scatter += np.dot(chunk.T, chunk)
+        mean = total / n
+        covariance = scatter / n - np.outer(mean, mean)
+        variances, vectors = np.linalg.eigh(covariance)
+        order = np.argsort(variances)[::-1][:self.dim]
+        self.mean = mean.astype(np.float32)
+        self.components = vectors[:, order].T.astype(np.float32)
+        self.variances = np.maximum(variances[order], 0).astype(np.float32)
+        self.explained_variance = float(self.variances.sum() / max(variances.sum(), EPSILON))
+        return self
+
+    def transform(self, x):
+        '''
+        :param x: a numpy array with dimensions [n, input_dim]
+        :return: the projected float32 array with dimensions [n, dim]
+        '''
+        x = np.atleast_2d(np.asarray(x, dtype=np.float32))
+        projected = np.dot(x - self.mean, self.components.T)
+        if self.whiten:
+            projected /= np.sqrt(self.variances + EPSILON)
+        return projected
+
+    def save(self, path):
+        np.save(os.path.join(path, 'pca_mean.npy'), self.mean)
+        np.save(os.path.join(path, 'pca_components.npy'), self.components)
+        np.save(os.path.join(path, 'pca_variances.npy'), self.variances)
+
+    @classmethod
+    def load(cls, path, meta):
+        pca = cls(meta['dim'], whiten=meta['whiten'])
+        pca.mean = np.load(os.path.join(path, 'pca_mean.npy'))
+        pca.components = np.load(os.path.join(path, 'pca_components.npy'))
+        pca.variances = np.load(os.path.join(path, 'pca_variances.npy'))
+        pca.explained_variance = meta['explained_variance']
+        return pca
+
+
+class PCAIndex(object):
+    '''
+    Projects the catalog and the queries with a PCA before the wrapped index sees them. Returned
+    distances are measured in the reduced space.
+    '''
+    index_type = 'pca'
+
+    def __init__(self, index, pca):
+        '''
+        :param index: the index searching the projected embeddings. Indexes that take a dim need
+        pca.dim
+        :param pca: a PCA. It is fitted on the first fit() call unless it is already fitted
+        '''
+        self.index = index
+        self.pca = pca
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    @property
+    def ids(self):
+        return self.index.ids
+
+    def fit(self, features, ids=None):
+        if not self.pca.fitted:
+            self.pca.fit(features)
+        self.index.fit(self.pca.transform(features), ids)
+        return self
+
+    def add(self, features, ids=None):
+        self.index.add(self.pca.transform(features), ids)
+        return self
+
+    def search(self, queries, k=6, **search_kwargs):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, input_dim]
+        :param search_kwargs: arguments of the wrapped search, e.g. mask, nprobe or ef
+        :return: distances in the reduced space and catalog ids with dimensions [num_queries, k]
+        '''
+        return self.index.search(self.pca.transform(queries), k=k, **search_kwargs)
+
+    def range_search(self, queries, radius, **search_kwargs):
+        if not hasattr(self.index, 'range_search'):
+            raise ValueError('The %s index has no range search' % self.index.index_type)
+        return self.index.range_search(self.pca.transform(queries), radius, **search_kwargs)
+
+    def save(self, path):
+        self.index.save(os.path.join(path, 'base'))
+        self.pca.save(path)
+        meta = {'type': self.index_type, 'dim': self.pca.dim, 'whiten': self.pca.whiten,
+                'input_dim': int(self.pca.components.shape[1]),
+                'explained_variance': self.pca.explained_variance, 'ntotal': self.ntotal}
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        return cls(load_index(os.path.join(path, 'base')), PCA.load(path, meta))
@@ -0,0 +1,304 @@
+'''
+This python file implements product quantization (PQ) of the 64-d global_pool embeddings. Every
+embedding is split into m sub-vectors and each sub-vector is replaced by the id of its closest
+centroid in a per-subspace codebook, so an item is stored in m bytes. Queries are compared to the
+codes through asymmetric distance tables. More details in Jegou et al., "Product quantization for
+nearest neighbor search".
+'''
+import json
+import os
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+from exact import squared_distances, top_k
+from ivf import IVFIndex, META_FILE, load_radii
+
+TRAIN_POINTS = 65536
+SCAN_BLOCK = 65536
+
+
+class ProductQuantizer(object):
+    '''
+    The per-subspace codebooks. With 8 bits per sub-vector, m = 8 gives 8-byte codes and m = 16
+    gives 16-byte codes for the 64-d embeddings.
+    '''
+    def __init__(self, dim, m=8, nbits=8):
+        '''
+        :param dim: dimension of the embeddings. Must be a multiple of m
+        :param m: number of subspaces, which is the code size in bytes
+        :param nbits: bits per sub-vector code, at most 8
+        '''
+        if dim % m != 0:
+            raise ValueError('The dimension %d is not a multiple of m = %d' % (dim, m))
+        assert nbits <= 8
+        self.dim = dim
+        self.m = m
+        self.nbits = nbits
+        self.ksub = 2 ** nbits
+        self.dsub = dim // m
+        self.codebooks = None
+
+    def split(self, x):
+        '''
+        :param x: a numpy array with dimensions [n, dim]
+        :return: a float32 view with dimensions [n, m, dsub]
+        '''
+        return np.asarray(x, dtype=np.float32).reshape(-1, self.m, self.dsub)
+
+    def train(self, features, seed=0):
+        '''
+        :param features: a numpy array with dimensions [n, dim]
+        :param seed: random seed for the sampling and for k-means
+        :return: self
+        '''
+        features = np.asarray(features, dtype=np.float32)
+        rng = np.random.RandomState(seed)
+        if len(features) > TRAIN_POINTS:
+            features = features[rng.choice(len(features), TRAIN_POINTS, replace=False)]
+        ksub = min(self.ksub, len(features))
+        sub = self.split(features)
+        self.codebooks = np.zeros((self.m, self.ksub, self.dsub), dtype=np.float32)
+        for j in range(self.m):
+            kmeans = KMeans(n_clusters=ksub, n_init=1, random_state=seed).fit(sub[:, j, :])
+            self.codebooks[j, :ksub] = kmeans.cluster_centers_
+            # A tiny training set leaves codewords unused; duplicates of the first one are harmless
+            self.codebooks[j, ksub:] = kmeans.cluster_centers_[0]
+        return self
+
+    def encode(self, x):
+        '''
+        :param x: a numpy array with dimensions [n, dim]
+        :return: the uint8 codes with dimensions [n, m]
+        '''
+        sub = self.split(x)
+        codes = np.zeros((len(sub), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = np.argmin(squared_distances(sub[:, j, :], self.codebooks[j]), axis=1)
+        return codes
+
+    def decode(self, codes):
+        '''
+        :param codes: uint8 codes with dimensions [n, m]
+        :return: the reconstructed embeddings with dimensions [n, dim]
+        '''
+        return self.codebooks[np.arange(self.m), codes].reshape(-1, self.dim)
+
+    def distance_tables(self, queries):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :return: the squared distances from every query sub-vector to every codeword, with
+        dimensions [num_queries, m, ksub]
+        '''
+        sub = self.split(queries)
+        diff = sub[:, :, None, :] - self.codebooks[None, :, :, :]
+        return np.einsum('qmkd,qmkd->qmk', diff, diff)
+
+    def adc(self, table, codes):
+        '''
+        Asymmetric distance computation.
+        :param table: the distance table of one query with dimensions [m, ksub]
+        :param codes: uint8 codes with dimensions [n, m]
+        :return: the approximate squared distances from the query to the n codes
+        '''
+        return table[np.arange(self.m), codes].sum(axis=1)
+
+    def save(self, path):
+        np.save(os.path.join(path, 'codebooks.npy'), self.codebooks)
+
+    @classmethod
+    def load(cls, path, meta):
+        pq = cls(meta['dim'], m=meta['m'], nbits=meta['nbits'])
+        pq.codebooks = np.load(os.path.join(path, 'codebooks.npy'))
+        return pq
+
+
+class PQIndex(object):
+    '''
+    A flat PQ index: the query is compared to every code of the catalog.
+    '''
+    index_type = 'pq'
+
+    def __init__(self, dim, m=8, nbits=8):
+        self.pq = ProductQuantizer(dim, m=m, nbits=nbits)
+        self.codes = np.zeros((0, m), dtype=np.uint8)
+        self.ids = np.zeros(0, dtype=np.int64)
+
+    @property
+    def ntotal(self):
+        return len(self.ids)
+
+    def add(self, features, ids=None):
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + len(features))
+        self.codes = np.concatenate((np.asarray(self.codes), self.pq.encode(features)))
+        self.ids = np.concatenate((np.asarray(self.ids), np.asarray(ids, dtype=np.int64)))
+        return self
+
+    def fit(self, features, ids=None):
+        self.pq.train(features)
+        return self.add(features, ids)
+
+    def search(self, queries, k=6, mask=None):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param k: number of neighbors to return
+        :param mask: an optional boolean array indexed by catalog id. Only the ids set in it are
+        scanned and returned
+        :return: approximate distances and catalog ids with dimensions [num_queries, k], in the
+        same layout as NearestNeighbors.kneighbors
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        tables = self.pq.distance_tables(queries)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        rows = np.arange(self.ntotal) if mask is None else \
+            np.flatnonzero(np.asarray(mask)[np.asarray(self.ids)])
+        if len(rows) == 0:
+            return distances, indices
+        for i in range(len(queries)):
+            dist = np.concatenate([
+                self.pq.adc(tables[i], self.codes[rows[start:start + SCAN_BLOCK]])
+                for start in range(0, len(rows), SCAN_BLOCK)])
+            pos, dist = top_k(dist[None, :], k)
+            distances[i, :pos.shape[1]] = np.sqrt(dist[0])
+            indices[i, :pos.shape[1]] = self.ids[rows[pos[0]]]
+        return distances, indices
+
+    def save(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.pq.save(path)
+        np.save(os.path.join(path, 'codes.npy'), np.asarray(self.codes))
+        np.save(os.path.join(path, 'ids.npy'), np.asarray(self.ids))
+        meta = {'type': self.index_type, 'dim': self.pq.dim, 'm': self.pq.m,
+                'nbits': self.pq.nbits, 'ntotal': self.ntotal}
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        index = cls(meta['dim'], m=meta['m'], nbits=meta['nbits'])
+        index.pq = ProductQuantizer.load(path, meta)
+        index.codes = np.load(os.path.join(path, 'codes.npy'), mmap_mode=mmap_mode)
+        index.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode=mmap_mode)
+        return index
+
+
+class IVFPQIndex(IVFIndex):
+    '''
+    An IVF index whose posting lists hold the PQ codes of the residuals (embedding minus its cell
+    centroid) instead of the raw embeddings.
+    '''
+    index_type = 'ivfpq'
+
+    def __init__(self, n_lists=256, nprobe=8, m=8, nbits=8):
+        super(IVFPQIndex, self).__init__(n_lists=n_lists, nprobe=nprobe)
+        self.m = m
+        self.nbits = nbits
+        self.pq = None
+        self.codes = None
+
+    def train(self, features, seed=0):
+        super(IVFPQIndex, self).train(features, seed=seed)
+        features = np.asarray(features, dtype=np.float32)
+        residuals = features - self.centroids[self.assign(features)]
+        self.pq = ProductQuantizer(features.shape[1], m=self.m, nbits=self.nbits)
+        self.pq.train(residuals, seed=seed)
+        return self
+
+    def add(self, features, ids=None):
+        '''
+        :param features: a numpy array with dimensions [n, dim]
+        :param ids: the catalog row ids. Defaults to the running row number
+        :return: self
+        '''
+        features = np.asarray(features, dtype=np.float32)
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + len(features))
+        ids = np.asarray(ids, dtype=np.int64)
+        lists = self.assign(features)
+        codes = self.pq.encode(features - self.centroids[lists])
+        if self.ntotal > 0:
+            old_lists = np.repeat(np.arange(self.n_lists), np.diff(self.offsets))
+            lists = np.concatenate((old_lists, lists))
+            codes = np.concatenate((np.asarray(self.codes), codes))
+            ids = np.concatenate((np.asarray(self.ids), ids))
+
+        order = np.argsort(lists, kind='stable')
+        counts = np.bincount(lists, minlength=self.n_lists)
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.codes = codes[order]
+        self.ids = ids[order]
+        self.set_radii(lists, self.pq.decode(codes))
+        return self
+
+    def scan(self, query, cells, k, allowed=None):
+        '''
+        :param query: a numpy array with dimensions [dim]
+        :param cells: the cells to scan
+        :param k: number of neighbors to return
+        :param allowed: an optional boolean array over the rows
+        :return: the approximate squared distances and the catalog ids of up to k neighbors
+        '''
+        tables = self.pq.distance_tables(query[None, :] - self.centroids[cells])
+        cell_dist = []
+        cell_rows = []
+        for table, c in zip(tables, cells):
+            rows = self.candidates([c], allowed)
+            cell_dist.append(self.pq.adc(table, self.codes[rows]))
+            cell_rows.append(rows)
+        rows = np.concatenate(cell_rows)
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        pos, dist = top_k(np.concatenate(cell_dist)[None, :], k)
+        return dist[0], np.asarray(self.ids)[rows[pos[0]]]
+
+    def range_scan(self, query, cells, radius, allowed=None):
+        '''
+        :return: the approximate squared distances and the catalog ids of the rows of the cells
+        within radius
+        '''
+        tables = self.pq.distance_tables(query[None, :] - self.centroids[cells])
+        cell_dist = []
+        cell_rows = []
+        for table, c in zip(tables, cells):
+            rows = self.candidates([c], allowed)
+            cell_dist.append(self.pq.adc(table, self.codes[rows]))
+            cell_rows.append(rows)
+        dist = np.concatenate(cell_dist)
+        rows = np.concatenate(cell_rows)
+        within = dist <= radius ** 2
+        return dist[within], np.asarray(self.ids)[rows[within]]
+
+    def save(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(path, 'ids.npy'), np.asarray(self.ids))
+        np.save(os.path.join(path, 'codes.npy'), np.asarray(self.codes))
+        np.save(os.path.join(path, 'radii.npy'), self.radii)
+        self.pq.save(path)
+        meta = {'type': self.index_type, 'n_lists': self.n_lists, 'nprobe': self.nprobe,
+                'ntotal': self.ntotal, 'dim': self.pq.dim, 'm': self.m, 'nbits': self.nbits}
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        index = cls(n_lists=meta['n_lists'], nprobe=meta['nprobe'], m=meta['m'],
+                    nbits=meta['nbits'])
+        index.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        index.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        index.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode=mmap_mode)
+        index.codes = np.load(os.path.join(path, 'codes.npy'), mmap_mode=mmap_mode)
+        index.pq = ProductQuantizer.load(path, meta)
+        index.radii = load_radii(path)
+        return index
@@ -0,0 +1,201 @@
+'''
+This python file adds a second retrieval stage on garment-region descriptors of the Faster R-CNN
+detector. The cheap 64-d global_pool index fetches a few hundred candidates; they are re-ranked
+by the cosine distance of region descriptors: the detector head feature map
+(Network.extract_head, conv5_3 for vgg16) max-pooled over the garment box and l2-normalized.
+The descriptors are computed offline for the whole catalog into a feature store, so a query
+reads only the rows of its own candidates from the mmap.
+
+TensorFlow and tf-faster-rcnn are only imported when a RegionExtractor is created, so the
+re-ranking works without them.
+
+Example:
+    python regions.py --checkpoint vgg16_faster_rcnn_iter_70000.ckpt \
+        --csv demo/full_data_revised.csv --output_dir demo/output/region_store
+'''
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from feature_store import FeatureStore, FeatureStoreWriter
+from metric import normalize
+
+FASTER_RCNN_LIB = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                               'tf-faster-rcnn', 'lib')
+# The six garment categories of deep_fashion_to_coco.py plus the background
+NUM_CLASSES = 7
+FEAT_STRIDE = 16
+NUM_CANDIDATES = 200
+CHUNK_ROWS = 1024
+
+
+def pool_box(feature_map, box, scale, stride=FEAT_STRIDE):
+    '''
+    :param feature_map: the head feature map of one image with dimensions [height, width, c]
+    :param box: the garment box (x1, y1, x2, y2) in pixels of the original image
+    :param scale: the factor the image was resized by before the network
+    :param stride: the pixels of the network input per feature map cell
+    :return: the l2-normalized float32 descriptor of the box, max-pooled over its cells
+    '''
+    height, width = feature_map.shape[:2]
+    x1, y1, x2, y2 = np.asarray(box, dtype=np.float64) * scale / stride
+    col1 = int(np.clip(np.floor(x1), 0, width - 1))
+    row1 = int(np.clip(np.floor(y1), 0, height - 1))
+    # Boxes smaller than one cell still cover the cell they fall in
+    col2 = int(np.clip(np.ceil(x2), col1 + 1, width))
+    row2 = int(np.clip(np.ceil(y2), row1 + 1, height))
+    descriptor = feature_map[row1:row2, col1:col2].max(axis=(0, 1))
+    return normalize(descriptor[None].astype(np.float32))[0]
+
+
+def region_distances(region_queries, candidate_ids, get_regions):
+    '''
+    :param region_queries: the region descriptors of the queries, [num_queries, region_dim]
+    :param candidate_ids: catalog ids with dimensions [num_queries, n], padded with -1
+    :param get_regions: a function from catalog ids to their region descriptors
+    :return: the cosine distances with dimensions [num_queries, n], inf for the padding
+    '''
+    found = candidate_ids >= 0
+    regions = np.zeros(candidate_ids.shape + (region_queries.shape[1],), dtype=np.float32)
+    # One sorted gather from the store for all queries: ids repeated across queries are read once
+    unique, inverse = np.unique(candidate_ids[found], return_inverse=True)
+    regions[found] = get_regions(unique)[inverse]
+    similarity = np.einsum('qnd,qd->qn', regions, normalize(region_queries))
+    return np.where(found, 1 - similarity, np.inf).astype(np.float32)
+
+
+def region_rerank(region_queries, ids, get_regions, k):
+    '''
+    :param region_queries: the region descriptors of the queries, [num_queries, region_dim]
+    :param ids: the catalog ids of the coarse candidates, [num_queries, n], padded with -1
+    :param get_regions: a function from catalog ids to their region descriptors, e.g. the get
+    method of the region FeatureStore
+    :param k: number of items to keep
+    :return: the region distances and catalog ids of the k best candidates, [num_queries, k]
+    '''
+    region_queries = np.atleast_2d(np.asarray(region_queries, dtype=np.float32))
+    distances = region_distances(region_queries, ids, get_regions)
+    order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+    distances = np.take_along_axis(distances, order, axis=1)
+    ids = np.where(np.isfinite(distances), np.take_along_axis(ids, order, axis=1), -1)
+    return distances, ids
+
+
+def two_stage_search(index, queries, region_queries, get_regions, k=6,
+                     num_candidates=NUM_CANDIDATES, **search_kwargs):
+    '''
+    :param index: any index over the global_pool embeddings
+    :param queries: the global_pool embeddings of the queries, [num_queries, dim]
+    :param region_queries: their region descriptors, [num_queries, region_dim]
+    :param get_regions: a function from catalog ids to their region descriptors
+    :param k: number of items to return
+    :param num_candidates: number of coarse candidates re-ranked per query
+    :param search_kwargs: extra arguments of index.search, e.g. mask, nprobe or ef
+    :return: the region distances and catalog ids of the k best candidates, [num_queries, k]
+    '''
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    _, ids = index.search(queries, k=max(k, int(num_candidates)), **search_kwargs)
+    return region_rerank(region_queries, ids, get_regions, k)
+
+
+class RegionExtractor(object):
+    '''
+    A resident Faster R-CNN graph and session computing the region descriptors of images.
+    '''
+    def __init__(self, checkpoint, net='vgg16', num_classes=NUM_CLASSES):
+        '''
+        :param checkpoint: the Faster R-CNN checkpoint trained by cs231_trigger.sh
+        :param net: 'vgg16' or 'res101', the backbone of the checkpoint
+        :param num_classes: number of detector classes, the background included
+        '''
+        if FASTER_RCNN_LIB not in sys.path:
+            sys.path.insert(0, FASTER_RCNN_LIB)
+        import tensorflow as tf
+        from model.config import cfg
+        from model.test import _get_image_blob, im_detect
+        from nets.resnet_v1 import resnetv1
+        from nets.vgg16 import vgg16
+
+        cfg.TEST.HAS_RPN = True
+        self.get_image_blob = _get_image_blob
+        self.im_detect = im_detect
+        self.net = vgg16() if net == 'vgg16' else resnetv1(num_layers=101)
+        self.net.create_architecture('TEST', num_classes, tag='default')
+        self.sess = tf.Session()
+        tf.train.Saver().restore(self.sess, checkpoint)
+        print('Region extractor restored from %s' % checkpoint)
+
+    def detect(self, img):
+        '''
+        :param img: a BGR image
+        :return: the box (x1, y1, x2, y2) of the most confident garment detection
+        '''
+        scores, boxes = self.im_detect(self.sess, self.net, img)
+        row, cls = np.unravel_index(np.argmax(scores[:, 1:]), scores[:, 1:].shape)
+        return boxes[row, 4 * (cls + 1):4 * (cls + 2)]
+
+    def describe(self, path, box=None):
+        '''
+        :param path: image path
+        :param box: the garment box (x1, y1, x2, y2) in pixels. Detected when None
+        :return: the region descriptor, or None when the image cannot be read
+        '''
+        img = cv2.imread(path)
+        if img is None or img.shape[0] == 0 or img.shape[1] == 0:
+            return None
+        if box is None:
+            box = self.detect(img)
+        blob, scales = self.get_image_blob(img)
+        feature_map = self.net.extract_head(self.sess, blob)[0]
+        return pool_box(feature_map, box, scales[0])
+
+
+def build_region_store(extractor, csv_path, path, chunk_rows=CHUNK_ROWS):
+    '''
+    :param extractor: a RegionExtractor
+    :param csv_path: the catalog csv, e.g. full_data_revised.csv, whose rows are the catalog ids.
+    Its x1, y1, x2, y2 columns are used as the garment boxes when present, otherwise the
+    detector finds them
+    :param path: the region store directory to create
+    :param chunk_rows: number of rows written at a time
+    :return: the opened region FeatureStore
+    '''
+    df = pd.read_csv(csv_path)
+    has_boxes = all(c in df.columns for c in ('x1', 'y1', 'x2', 'y2'))
+    writer = None
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        descriptors = [extractor.describe(row.image_path, (row.x1, row.y1, row.x2, row.y2)
+                                          if has_boxes else None)
+                       for row in chunk.itertuples()]
+        if writer is None:
+            dim = next(len(d) for d in descriptors if d is not None)
+            # float16 halves the store; the descriptors are l2-normalized, so nothing overflows
+            writer = FeatureStoreWriter(path, dim, dtype=np.float16)
+        # Unreadable images get a zero descriptor, i.e. the largest distance to every query
+        writer.append(np.stack([np.zeros(dim, dtype=np.float32) if d is None else d
+                                for d in descriptors]),
+                      ids=np.arange(start, start + len(chunk)))
+        print('%d / %d region descriptors done' % (start + len(chunk), len(df)))
+    writer.close()
+    return FeatureStore(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the region descriptor store')
+    parser.add_argument('--checkpoint', required=True, help='a Faster R-CNN checkpoint')
+    parser.add_argument('--net', default='vgg16', choices=['vgg16', 'res101'])
+    parser.add_argument('--num_classes', type=int, default=NUM_CLASSES)
+    parser.add_argument('--csv', default='demo/full_data_revised.csv')
+    parser.add_argument('--output_dir', default='demo/output/region_store')
+    args = parser.parse_args()
+    build_region_store(RegionExtractor(args.checkpoint, args.net, args.num_classes), args.csv,
+                       args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
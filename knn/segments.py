@@ -0,0 +1,369 @@
+'''
+This python file lets the recommendation index change without a full rebuild. New items go to a
+small delta segment that is searched exactly next to the main index, deleted items are hidden by
+a tombstone bitmap, and a background compaction merges everything into a new main index while
+queries keep being served from the old one. The delta and the tombstones are saved next to the
+main index, so updates survive a restart.
+'''
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from exact import ExactIndex, merge_top_k, squared_norms
+from filters import combine
+from hnsw import HNSWIndex
+from index_io import load_index, read_meta, write_meta
+from ivf import IVFIndex
+from lsh import BinaryHashIndex
+from metric import InnerProductIndex
+from pca import PCAIndex
+from pq import IVFPQIndex, PQIndex
+
+MAX_DELTA = 50000
+DELTA_CAPACITY = 1024
+
+
+def base_index(index):
+    '''
+    :return: the index a cosine, inner product or PCA wrapper searches with
+    '''
+    while isinstance(index, (InnerProductIndex, PCAIndex)):
+        index = index.index
+    return index
+
+
+def wrap_like(index, base):
+    '''
+    :param index: an index, possibly wrapped
+    :param base: an index over embeddings in the form the base index of index stores them
+    :return: base in the same wrappers, with the same settings, as index
+    '''
+    if isinstance(index, InnerProductIndex):
+        wrapped = InnerProductIndex(wrap_like(index.index, base), index.metric)
+        # The MIPS coordinate is computed from the bound of the catalog the index was built on
+        wrapped.max_norm = index.max_norm
+        return wrapped
+    if isinstance(index, PCAIndex):
+        return PCAIndex(wrap_like(index.index, base), index.pca)
+    return base
+
+
+def prepare(index, features):
+    '''
+    :param index: an index, possibly wrapped
+    :param features: a numpy array with dimensions [n, dim]
+    :return: the embeddings in the form the base index stores them: projected, normalized or
+    MIPS-augmented by the wrappers, outermost first
+    '''
+    if isinstance(index, InnerProductIndex):
+        return prepare(index.index, index.prepare(features))
+    if isinstance(index, PCAIndex):
+        return prepare(index.index, index.pca.transform(features))
+    return np.atleast_2d(np.asarray(features, dtype=np.float32))
+
+
+def index_vectors(index):
+    '''
+    :param index: a built index
+    :return: the embeddings and the catalog ids it holds. PQ indexes return their reconstruction,
+    wrapped indexes the embeddings as their base index stores them, i.e. what rebuild takes
+    '''
+    index = base_index(index)
+    ids = np.asarray(index.ids[:index.ntotal])
+    if isinstance(index, IVFPQIndex):
+        lists = np.repeat(np.arange(index.n_lists), np.diff(index.offsets))
+        return index.centroids[lists] + index.pq.decode(np.asarray(index.codes)), ids
+    if isinstance(index, PQIndex):
+        return index.pq.decode(np.asarray(index.codes)), ids
+    return np.asarray(index.vectors[:index.ntotal], dtype=np.float32), ids
+
+
+def rebuild(index, features, ids):
+    '''
+    Build an index of the same kind and with the same settings over new contents. Trained
+    quantizers are kept, so IVF and PQ indexes are refilled without running k-means again.
+    Wrapped indexes keep their wrappers, PCA and max_norm; only the base index is rebuilt.
+    :param index: the index to copy the settings from
+    :param features: a numpy array with dimensions [n, dim], as index_vectors returns them
+    :param ids: the catalog ids of the rows
+    :return: the new index
+    '''
+    if base_index(index) is not index:
+        return wrap_like(index, rebuild(base_index(index), features, ids))
+    if isinstance(index, IVFPQIndex):
+        new_index = IVFPQIndex(n_lists=index.n_lists, nprobe=index.nprobe, m=index.m,
+                               nbits=index.nbits)
+        new_index.centroids, new_index.pq = index.centroids, index.pq
+    elif isinstance(index, IVFIndex):
+        new_index = IVFIndex(n_lists=index.n_lists, nprobe=index.nprobe)
+        new_index.centroids = index.centroids
+    elif isinstance(index, PQIndex):
+        new_index = PQIndex(index.pq.dim, m=index.pq.m, nbits=index.pq.nbits)
+        new_index.pq = index.pq
+    elif isinstance(index, BinaryHashIndex):
+        new_index = BinaryHashIndex(index.dim, n_bits=index.n_bits, rerank=index.rerank)
+        new_index.projections, new_index.mean = index.projections, index.mean
+    elif isinstance(index, HNSWIndex):
+        new_index = HNSWIndex(index.dim, M=index.M, ef_construction=index.ef_construction,
+                              ef=index.ef)
+    else:
+        new_index = ExactIndex(base_block=index.base_block, query_block=index.query_block,
+                               n_jobs=index.n_jobs, metric=index.metric)
+    return new_index.add(features, ids)
+
+
+class SegmentedIndex(object):
+    '''
+    A main index plus a delta segment and tombstones. The (main, delta) pair is replaced as a
+    whole under a lock, so a search always sees a consistent pair of segments.
+    '''
+    index_type = 'segmented'
+
+    def __init__(self, main, max_delta=MAX_DELTA):
+        '''
+        :param main: the built main index
+        :param max_delta: a background compaction is started once the delta holds this many items
+        '''
+        self.main = main
+        self.metric = getattr(main, 'metric', 'l2')
+        # The delta has to rank like the main index for the merged results to be comparable: it
+        # stores the embeddings as the base index of main does, behind the same wrappers
+        self.delta_metric = getattr(base_index(main), 'metric', 'l2')
+        self.max_delta = max_delta
+        # The delta rows live in buffers that grow by doubling, so an append only writes the new
+        # rows. Searches read the delta through views of the first delta_size rows
+        self.delta_vectors = None
+        self.delta_norms = None
+        self.delta_ids = None
+        self.delta_size = 0
+        self.delta = self.new_delta()
+        main_ids = np.asarray(main.ids[:main.ntotal])
+        size = int(main_ids.max()) + 1 if len(main_ids) else 0
+        self.known = np.zeros(size, dtype=bool)
+        self.known[main_ids] = True
+        self.tombstones = np.zeros(size, dtype=bool)
+        self.live = self.known.copy()
+        self.lock = threading.Lock()
+        self.compaction = None
+        # The directory the index was loaded from or last saved to, and the main index saved there
+        self.path = None
+        self.saved_main = None
+        # Bumped on every change, so result caches know when to invalidate
+        self.version = 0
+
+    @property
+    def ntotal(self):
+        return int(self.live.sum())
+
+    @property
+    def ids(self):
+        return np.flatnonzero(self.live)
+
+    def new_delta(self):
+        '''
+        :return: an exact index over the first delta_size rows of the delta buffers, in the
+        wrappers of the main index
+        '''
+        delta = ExactIndex(metric=self.delta_metric)
+        if self.delta_size > 0:
+            delta.vectors = self.delta_vectors[:self.delta_size]
+            delta.norms = self.delta_norms[:self.delta_size]
+            delta.ids = self.delta_ids[:self.delta_size]
+        return wrap_like(self.main, delta)
+
+    def grow(self, size):
+        if size > len(self.known):
+            pad = max(size, 2 * len(self.known)) - len(self.known)
+            self.known = np.concatenate((self.known, np.zeros(pad, dtype=bool)))
+            self.tombstones = np.concatenate((self.tombstones, np.zeros(pad, dtype=bool)))
+            self.live = np.concatenate((self.live, np.zeros(pad, dtype=bool)))
+
+    def grow_delta(self, num_new, dim):
+        capacity = 0 if self.delta_vectors is None else len(self.delta_vectors)
+        if self.delta_size + num_new <= capacity:
+            return
+        capacity = max(self.delta_size + num_new, 2 * capacity, DELTA_CAPACITY)
+        # New buffers rather than a resize: running searches still read the old ones
+        vectors = np.zeros((capacity, dim), dtype=np.float32)
+        norms = np.zeros(capacity, dtype=np.float32)
+        ids = np.zeros(capacity, dtype=np.int64)
+        if self.delta_size > 0:
+            vectors[:self.delta_size] = self.delta_vectors[:self.delta_size]
+            norms[:self.delta_size] = self.delta_norms[:self.delta_size]
+            ids[:self.delta_size] = self.delta_ids[:self.delta_size]
+        self.delta_vectors, self.delta_norms, self.delta_ids = vectors, norms, ids
+
+    def add(self, features, ids):
+        '''
+        Append items to the delta segment. They are searchable as soon as this returns.
+        :param features: a numpy array with dimensions [n, dim]
+        :param ids: new catalog ids. Ids that were ever added, even if deleted since, are refused
+        '''
+        features = np.atleast_2d(np.asarray(features, dtype=np.float32))
+        with self.lock:
+            delta = self.delta
+        self.append(prepare(delta, features), ids)
+
+    def append(self, features, ids):
+        '''
+        :param features: embeddings as the base index of main stores them, [n, dim]
+        :param ids: new catalog ids
+        '''
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        if len(ids) != len(features) or len(np.unique(ids)) != len(ids) or np.any(ids < 0):
+            raise ValueError('Adding needs one distinct, non-negative id per embedding')
+        with self.lock:
+            self.grow(int(ids.max()) + 1)
+            if np.any(self.known[ids]):
+                raise ValueError('Ids already in the index: %s' % ids[self.known[ids]])
+            self.grow_delta(len(ids), features.shape[1])
+            end = self.delta_size + len(ids)
+            self.delta_vectors[self.delta_size:end] = features
+            self.delta_norms[self.delta_size:end] = squared_norms(features)
+            self.delta_ids[self.delta_size:end] = ids
+            self.delta_size = end
+            self.delta = self.new_delta()
+            self.known[ids] = True
+            # Updated in place: only the new ids change, and no segment held them before
+            self.live[ids] = True
+            self.version += 1
+            start_compaction = self.delta_size >= self.max_delta
+        if start_compaction:
+            self.compact(background=True)
+
+    def remove(self, ids):
+        '''
+        :param ids: catalog ids to delete. They stop being returned immediately
+        '''
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        with self.lock:
+            ids = ids[(ids >= 0) & (ids < len(self.known))]
+            ids = ids[self.known[ids]]
+            self.tombstones[ids] = True
+            self.live[ids] = False
+            self.version += 1
+
+    def search(self, queries, k=6, mask=None, **search_kwargs):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param k: number of neighbors to return
+        :param mask: an optional boolean array indexed by catalog id
+        :param search_kwargs: extra arguments of the main index search, e.g. nprobe or ef
+        :return: distances and catalog ids with dimensions [num_queries, k]
+        '''
+        with self.lock:
+            main, delta, live = self.main, self.delta, self.live
+        if mask is not None:
+            mask = np.asarray(mask)
+            size = max(len(mask), len(live))
+            mask = combine(np.pad(mask, (0, size - len(mask))),
+                           np.pad(live, (0, size - len(live))))
+        else:
+            mask = live
+        dist, ids = main.search(queries, k=k, mask=mask, **search_kwargs)
+        if delta.ntotal == 0:
+            return dist, ids
+        delta_dist, delta_ids = delta.search(queries, k=k, mask=mask)
+        return merge_top_k([dist, delta_dist], [ids, delta_ids], k)
+
+    def merge(self):
+        '''
+        Build a new main index from the live items of the current main index and delta.
+        '''
+        with self.lock:
+            main, delta = self.main, self.delta
+            tombstones = self.tombstones.copy()
+        vectors, ids = index_vectors(main)
+        if delta.ntotal > 0:
+            delta_vectors, delta_ids = index_vectors(delta)
+            vectors = np.concatenate((vectors, delta_vectors))
+            ids = np.concatenate((ids, delta_ids))
+        live = ~tombstones[ids]
+        new_main = rebuild(main, vectors[live], ids[live])
+
+        with self.lock:
+            # Items appended while merging stay in the delta, moved to new buffers
+            merged = delta.ntotal
+            vectors, norms, ids = self.delta_vectors, self.delta_norms, self.delta_ids
+            remaining = self.delta_size - merged
+            self.delta_vectors = self.delta_norms = self.delta_ids = None
+            self.delta_size = 0
+            if remaining > 0:
+                self.grow_delta(remaining, vectors.shape[1])
+                self.delta_vectors[:remaining] = vectors[merged:merged + remaining]
+                self.delta_norms[:remaining] = norms[merged:merged + remaining]
+                self.delta_ids[:remaining] = ids[merged:merged + remaining]
+                self.delta_size = remaining
+            self.main = new_main
+            self.delta = self.new_delta()
+            self.version += 1
+        print('Compaction done: %d items in the main index' % new_main.ntotal)
+
+    def compact(self, background=True):
+        '''
+        :param background: run the merge on a background thread
+        :return: the compaction thread, or None when it ran in the foreground
+        '''
+        if not background:
+            self.merge()
+            return None
+        with self.lock:
+            if self.compaction is not None and self.compaction.is_alive():
+                return self.compaction
+            self.compaction = threading.Thread(target=self.merge)
+            self.compaction.daemon = True
+            self.compaction.start()
+            return self.compaction
+
+    def save(self, path=None):
+        '''
+        Save the delta segment and the tombstones, and the main index when it changed since it was
+        last saved there, so adds and deletes survive a restart.
+        :param path: the directory to save to. Defaults to the one the index was loaded from
+        '''
+        path = self.path if path is None else path
+        if path is None:
+            raise ValueError('The segmented index has no directory to save to')
+        with self.lock:
+            main, delta = self.main, self.delta
+            known, tombstones = self.known.copy(), self.tombstones.copy()
+            version = self.version
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if path != self.path or main is not self.saved_main:
+            main.save(os.path.join(path, 'main'))
+        delta_dir = os.path.join(path, 'delta')
+        if os.path.isdir(delta_dir):
+            shutil.rmtree(delta_dir)
+        if delta.ntotal > 0:
+            base_index(delta).save(delta_dir)
+        np.save(os.path.join(path, 'known.npy'), known)
+        np.save(os.path.join(path, 'tombstones.npy'), tombstones)
+        write_meta(path, {'type': self.index_type, 'max_delta': self.max_delta,
+                          'ntotal': int((known & ~tombstones).sum()),
+                          'delta_ntotal': delta.ntotal, 'version': version})
+        self.path, self.saved_main = path, main
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        meta = read_meta(path)
+        index = cls(load_index(os.path.join(path, 'main')), max_delta=meta['max_delta'])
+        if meta['delta_ntotal'] > 0:
+            vectors, ids = index_vectors(load_index(os.path.join(path, 'delta')))
+            index.append(vectors, ids)
+        known = np.load(os.path.join(path, 'known.npy'))
+        tombstones = np.load(os.path.join(path, 'tombstones.npy'))
+        index.grow(len(known))
+        # Deleted ids stay known even after a compaction dropped them, so they are not re-added
+        index.known[:len(known)] |= known
+        index.tombstones[:len(tombstones)] |= tombstones
+        index.live = index.known & ~index.tombstones
+        # A version above 0 tells the server the index differs from the catalog it was built
+        # on, e.g. that the similar table may hold deleted items. It has to survive a restart,
+        # also when only tombstones or a compacted main index were saved
+        changed = index.delta_size > 0 or bool(index.tombstones.any())
+        index.version = max(index.version, meta.get('version', 0), int(changed))
+        index.path, index.saved_main = path, index.main
+        return index
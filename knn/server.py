@@ -0,0 +1,796 @@
+'''
+This python file runs the recommendation query server. It loads the index and the feature store
+once and keeps them resident, then answers JSON queries over HTTP on a local port or a Unix socket.
+Concurrent single-item queries are coalesced into one batched index search within a small
+latency window.
+
+Example:
+    python server.py --index_dir demo/output/ivf_index --store_dir demo/output/feature_store
+    curl -d '{"id": 60000, "k": 6}' http://127.0.0.1:8080/search
+
+With --checkpoint, new photos are embedded on the fly, sent as a path on the server or as
+base64-encoded bytes:
+    curl -d '{"image_path": "photo.jpg", "k": 6}' http://127.0.0.1:8080/search
+
+An outfit query fuses several garments into one ranking:
+    curl -d '{"outfit": [{"id": 60000}, {"id": 60001}], "weights": [2, 1]}' \
+        http://127.0.0.1:8080/search
+
+With --region_dir, id queries can re-rank their candidates by Faster R-CNN region descriptors:
+    curl -d '{"id": 60000, "k": 6, "regions": true}' http://127.0.0.1:8080/search
+
+With --catalog_csv and --attributes_file, results can be kept within a category and to the items
+having a list of DeepFashion attribute columns:
+    curl -d '{"id": 60000, "category": 3, "attributes": [12, 40]}' http://127.0.0.1:8080/search
+
+With --versions_dir, the server serves the version named in its CURRENT file and swaps to a new
+one without downtime when it is published (see versions.py), or on POST /reload, which also
+publishes the version it swaps to:
+    python server.py --versions_dir demo/output/versions
+    curl -d '{"version": "v0002"}' http://127.0.0.1:8080/reload
+
+With --segmented_dir, items can be added and deleted while serving (see segments.py), and the
+updated index is saved to that directory on POST /save:
+    curl -d '{"ids": [90000], "embeddings": [[0.1, ...]]}' http://127.0.0.1:8080/add
+    curl -d '{"ids": [60001]}' http://127.0.0.1:8080/remove
+Added items are searchable right away. They are only returned by queries without a category,
+and queries by their id need them in the feature store, i.e. the next version.
+
+GET /metrics returns the latency histogram of every stage of the retrieval path, the request
+counters and the cache hit rates; --metrics_file also dumps them periodically:
+    curl http://127.0.0.1:8080/metrics
+'''
+import argparse
+import base64
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+
+from cache import CACHE_SIZE, LRUCache, embedding_key, index_version
+from feature_store import FeatureStore
+from filters import attribute_mask, category_bitmaps, combine, load_attribute_bitmaps
+from index_io import load_index
+from ivf import META_FILE
+from metrics import DUMP_SECONDS, Metrics, MetricsDumper
+from mmr import mmr_rerank, num_mmr_candidates
+from outfit import outfit_search
+from regions import NUM_CANDIDATES, region_rerank
+from segments import SegmentedIndex
+from similar import SimilarItems, exclude_self
+from versions import ServingState, current_version, load_state, publish
+
+MAX_BATCH = 64
+BATCH_WINDOW = 0.002
+# Seconds an old version stays open after a swap, for the queries still running on it
+RETIRE_DELAY = 60.0
+POLL_SECONDS = 10.0
+INTEGER_FIELDS = ('id', 'k', 'max_results', 'mmr_candidates', 'region_candidates')
+POSITIVE_FIELDS = ('k', 'max_results', 'mmr_candidates', 'region_candidates')
+NUMBER_FIELDS = ('radius', 'mmr')
+
+
+def check_request(request):
+    '''
+    Check the shape of a request body before it is answered, so a malformed one is refused with
+    a clear message instead of failing deep in the search.
+    :param request: the decoded JSON body
+    :raise ValueError: when the body is not an object, or a field has the wrong type
+    '''
+    if not isinstance(request, dict):
+        raise ValueError('The request body must be a JSON object')
+    queries = request.get('outfit', [])
+    if not isinstance(queries, list) or not all(isinstance(q, dict) for q in queries):
+        raise ValueError('outfit must be a list of JSON objects')
+    for query in [request] + queries:
+        for field in INTEGER_FIELDS + NUMBER_FIELDS:
+            value = query.get(field)
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError('%s must be a number' % field)
+            if field in INTEGER_FIELDS and not isinstance(value, int):
+                raise ValueError('%s must be an integer' % field)
+            if field in POSITIVE_FIELDS and value <= 0:
+                raise ValueError('%s must be positive' % field)
+        for field in ('embedding', 'weights', 'ids', 'embeddings', 'attributes'):
+            if field in query and not isinstance(query[field], list):
+                raise ValueError('%s must be a list' % field)
+    attributes = request.get('attributes') or []
+    if any(isinstance(a, bool) or not isinstance(a, int) for a in attributes):
+        raise ValueError('attributes must be a list of attribute columns')
+    for field in ('version', 'image_path', 'image', 'fusion'):
+        if request.get(field) is not None and not isinstance(request[field], str):
+            raise ValueError('%s must be a string' % field)
+    category = request.get('category')
+    # Categories of an integer csv column are numbers, other columns give strings
+    if category is not None and (isinstance(category, bool) or
+                                 not isinstance(category, (str, int))):
+        raise ValueError('category must be a string or an integer')
+
+
+def attribute_key(attributes, columns):
+    '''
+    :param attributes: the boolean attribute matrix of the catalog, [num_ids, num_attributes], or
+    None when the server has none
+    :param columns: the attribute columns of a request, or None
+    :return: the sorted tuple of the columns, to key the batcher and the cache with
+    '''
+    if not columns:
+        return None
+    if attributes is None:
+        raise ValueError('Attribute filters need the server to run with --attributes_file')
+    columns = tuple(sorted(set(columns)))
+    if columns[0] < 0 or columns[-1] >= attributes.shape[1]:
+        raise KeyError('Unknown attributes, there are %d' % attributes.shape[1])
+    return columns
+
+
+def category_key(bitmaps, category):
+    '''
+    :param bitmaps: a dict from category to bitmap, as built by filters.category_bitmaps
+    :param category: the category of a request, e.g. 3 or "3"
+    :return: the key of its bitmap. Raises KeyError for unknown categories
+    '''
+    if category is None or category in bitmaps:
+        return category
+    # JSON gives "3" where the csv column had the integer 3, and the other way round
+    for key in bitmaps:
+        if str(key) == str(category):
+            return key
+    raise KeyError('Unknown category %s' % category)
+
+
+class PendingQuery(object):
+    def __init__(self, query, k, key):
+        self.query = query
+        self.k = k
+        self.key = key
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    '''
+    Collects queries from many request threads and runs them as batches on one worker thread.
+    A batch is closed when it holds max_batch queries or when window seconds have passed since
+    its first query arrived.
+    '''
+    def __init__(self, search_fn, max_batch=MAX_BATCH, window=BATCH_WINDOW):
+        '''
+        :param search_fn: a function (queries, k, key) -> (distances, ids). Queries of one call
+        share the same key, e.g. the same category filter
+        :param max_batch: maximum number of queries per batch
+        :param window: seconds to wait for more queries after the first one of a batch
+        '''
+        self.search_fn = search_fn
+        self.max_batch = max_batch
+        self.window = window
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, query, k, key=None):
+        '''
+        :param query: a numpy array with dimensions [dim]
+        :param k: number of neighbors to return
+        :param key: the search key of the query, e.g. its category
+        :return: the distances and the ids of the k neighbors. Blocks until the batch is done
+        '''
+        return self.wait(PendingQuery(np.asarray(query, dtype=np.float32), k, key))
+
+    def wait(self, item):
+        '''
+        :param item: a PendingQuery
+        :return: its result, once the worker thread processed its batch
+        '''
+        self.queue.put(item)
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.process(batch)
+
+    def process(self, batch):
+        groups = {}
+        for item in batch:
+            groups.setdefault(item.key, []).append(item)
+        for key, items in groups.items():
+            try:
+                k = max(item.k for item in items)
+                distances, ids = self.search_fn(np.stack([item.query for item in items]), k, key)
+                for i, item in enumerate(items):
+                    item.result = distances[i, :item.k], ids[i, :item.k]
+            except Exception as e:
+                for item in items:
+                    item.error = e
+            finally:
+                for item in items:
+                    item.done.set()
+
+
+class EmbeddingBatcher(MicroBatcher):
+    '''
+    Collects the query images of concurrent requests, so they are embedded in one session run
+    instead of one run per request.
+    '''
+    def __init__(self, embedder, max_batch=MAX_BATCH, window=BATCH_WINDOW):
+        '''
+        :param embedder: a QueryEmbedder
+        :param max_batch: maximum number of images per batch
+        :param window: seconds to wait for more images after the first one of a batch
+        '''
+        self.embedder = embedder
+        MicroBatcher.__init__(self, None, max_batch=max_batch, window=window)
+
+    def submit(self, image):
+        '''
+        :param image: an image path or the encoded image bytes
+        :return: its embedding. Blocks until the batch is done
+        '''
+        return self.wait(PendingQuery(image, None, None))
+
+    def process(self, batch):
+        try:
+            embeddings = self.embedder.embed([item.query for item in batch])
+            for item, embedding in zip(batch, embeddings):
+                item.result = embedding
+        except Exception:
+            # One unreadable image must not fail the others, so each gets its own answer
+            for item in batch:
+                try:
+                    item.result = self.embedder.embed([item.query])[0]
+                except Exception as e:
+                    item.error = e
+        finally:
+            for item in batch:
+                item.done.set()
+
+
+class RecommendationService(object):
+    '''
+    The resident state of the server: the serving state of the index version, i.e. the index,
+    the feature store and the category bitmaps, plus the batcher and the result cache. Every
+    request reads self.state once and uses that reference to the end, so swap() can replace the
+    version while queries run: the running ones finish on the old version, new ones see the new.
+    '''
+    def __init__(self, index, store, bitmaps=None, search_kwargs=None, max_batch=MAX_BATCH,
+                 window=BATCH_WINDOW, cache_size=CACHE_SIZE, similar=None, embedder=None,
+                 version=None, metrics=None, regions=None, attributes=None):
+        '''
+        :param index: any index with a search(queries, k, mask=...) method
+        :param store: the FeatureStore holding the catalog embeddings and image paths
+        :param bitmaps: an optional dict from category to bitmap
+        :param search_kwargs: extra arguments of index.search, e.g. nprobe or ef
+        :param cache_size: number of results kept in the LRU cache. 0 disables it
+        :param similar: an optional precomputed SimilarItems table. Unfiltered queries by id
+        with k up to its width are answered from it with one row read. Like a live search by id,
+        the table leaves out the queried item itself
+        :param embedder: an optional QueryEmbedder, to answer queries given as images
+        :param version: the name of the index version, when it comes from a versions root
+        :param metrics: the Metrics recording the latency of every stage. Defaults to a new one
+        :param regions: an optional FeatureStore of region descriptors built by regions.py, to
+        re-rank the candidates of id queries
+        :param attributes: an optional boolean array of the attributes of every catalog id,
+        [num_ids, num_attributes], as built by filters.load_attribute_bitmaps
+        '''
+        self.state = ServingState(index, store, similar, bitmaps, version, regions, attributes)
+        self.search_kwargs = search_kwargs or {}
+        self.batcher = MicroBatcher(self.search, max_batch=max_batch, window=window)
+        self.cache = LRUCache(cache_size) if cache_size > 0 else None
+        self.embedder = embedder
+        self.embed_batcher = None if embedder is None else \
+            EmbeddingBatcher(embedder, max_batch=max_batch, window=window)
+        self.metrics = Metrics() if metrics is None else metrics
+        self.metrics.watch_cache('results', self.cache)
+        if embedder is not None:
+            self.metrics.watch_cache('embeddings', embedder.cache)
+
+    @property
+    def index(self):
+        return self.state.index
+
+    def swap(self, state):
+        '''
+        Serve a new version from now on. The switch is a single reference assignment; the old
+        state is closed, its memory maps dropped, RETIRE_DELAY seconds later, once the queries
+        holding it are done.
+        :param state: the ServingState of the new version, loaded and warmed up
+        :return: the previous ServingState
+        '''
+        old, self.state = self.state, state
+        if self.cache is not None:
+            self.cache.check_version(index_version(state.index))
+        retire = threading.Timer(RETIRE_DELAY, old.close)
+        retire.daemon = True
+        retire.start()
+        return old
+
+    def mask(self, state, filters):
+        '''
+        :param filters: the category and the sorted attribute columns of a request, or None
+        :return: the bitmap of the items passing both filters, or None when there is none
+        '''
+        category, attributes = filters
+        return combine(None if category is None else state.bitmaps[category],
+                       None if attributes is None else attribute_mask(state.attributes,
+                                                                      attributes))
+
+    def search(self, queries, k, key):
+        # The batcher groups queries by key, so one batch never mixes two versions
+        state, filters = key
+        mask = self.mask(state, filters)
+        self.metrics.count('batches')
+        self.metrics.count('batched_queries', len(queries))
+        with self.metrics.time('batch_search'):
+            return state.index.search(queries, k=k, mask=mask, **self.search_kwargs)
+
+    def parse_query(self, request):
+        '''
+        :param request: a dict with either an 'id' of a catalog item, an 'embedding', an
+        'image_path' or a base64 'image'
+        :return: the query embedding, or None for an id which is read only on a cache miss, and
+        the cache key of the query
+        '''
+        if 'image_path' in request or 'image' in request:
+            if self.embedder is None:
+                raise ValueError('Image queries need the server to run with --checkpoint')
+            image = request['image_path'] if 'image_path' in request else \
+                base64.b64decode(request['image'])
+            with self.metrics.time('embed'):
+                query = self.embed_batcher.submit(image)
+            return query, ('embedding', embedding_key(query))
+        if 'embedding' in request:
+            query = np.asarray(request['embedding'], dtype=np.float32)
+            return query, ('embedding', embedding_key(query))
+        return None, ('id', int(request['id']))
+
+    def cached(self, state, key, compute):
+        '''
+        :param state: the ServingState the request runs on
+        :param key: the cache key of the request
+        :param compute: a function computing the result on a miss
+        :return: the result, from the cache when possible
+        '''
+        if self.cache is None:
+            return compute()
+        self.cache.check_version(index_version(self.state.index))
+        # Keys carry the version they are computed on, so a query finishing on the old version
+        # after a swap never fills the cache of the new one
+        key = (index_version(state.index),) + key
+        result = self.cache.get(key)
+        if result is None:
+            result = compute()
+            self.cache.put(key, result)
+        return result
+
+    def recommend(self, request):
+        '''
+        :param request: a dict with the query as in parse_query, or an 'outfit' list of such
+        queries with the optional 'weights' and 'fusion'. Plus the optional 'k', 'category' and
+        'attributes', a list of attribute columns every result must have, and for single
+        queries the optional 'mmr' lambda and 'mmr_candidates' to diversify the results. For id
+        queries, 'regions' re-ranks the 'region_candidates' nearest items by their region
+        descriptors. A 'radius' with an optional 'max_results' cap asks for every item
+        within that distance instead of the k nearest
+        :return: a dict with the neighbor ids, distances and image paths. Queries by id never
+        return the queried item, whether answered from the similar table or by a live search; the
+        result names it as 'excluded_id'
+        '''
+        with self.metrics.time('request'):
+            return self.answer(request)
+
+    def answer(self, request):
+        state = self.state
+        k = int(request.get('k', 6))
+        # The category and attribute filters of the request, also the batcher key of its search
+        filters = (category_key(state.bitmaps, request.get('category')),
+                   attribute_key(state.attributes, request.get('attributes')))
+        if 'outfit' in request:
+            self.metrics.count('outfit_requests')
+            return self.recommend_outfit(state, request, k, filters)
+
+        query, key = self.parse_query(request)
+        if 'radius' in request:
+            self.metrics.count('range_requests')
+            return self.recommend_range(state, request, query, key, filters)
+        lambda_ = request.get('mmr')
+        use_regions = bool(request.get('regions'))
+        if use_regions:
+            if state.regions is None:
+                raise ValueError('Region re-ranking needs the server to run with --region_dir')
+            if query is not None:
+                raise ValueError('Region re-ranking needs an id query, only catalog items have '
+                                 'region descriptors')
+            if lambda_ is not None:
+                raise ValueError('Region re-ranking and mmr cannot be combined')
+        # The table is computed offline, so it is skipped once items were added or deleted
+        if query is None and filters == (None, None) and lambda_ is None and \
+                not use_regions and state.similar is not None and k <= state.similar.k and \
+                not getattr(state.index, 'version', 0):
+            self.metrics.count('similar_requests')
+            with self.metrics.time('similar_lookup'):
+                # Refuses ids unknown to the catalog, like the fetch of a live search
+                state.store.rows_for([key[1]])
+                distances, ids = state.similar.lookup([key[1]], k)
+            return self.format_result(state, distances[0], ids[0], key)
+
+        def compute():
+            q = self.fetch(state, key) if query is None else query
+            if use_regions:
+                n = max(k, int(request.get('region_candidates', NUM_CANDIDATES)))
+                with self.metrics.time('search'):
+                    distances, ids = self.search_excluding(state, q, n, key, filters)
+                with self.metrics.time('region_rerank'):
+                    distances, ids = region_rerank(state.regions.get([key[1]]), ids[None],
+                                                   state.regions.get, k)
+                return self.format_result(state, distances[0], ids[0], key)
+            if lambda_ is None:
+                with self.metrics.time('search'):
+                    distances, ids = self.search_excluding(state, q, k, key, filters)
+                return self.format_result(state, distances, ids, key)
+            n = num_mmr_candidates(k, request.get('mmr_candidates'))
+            with self.metrics.time('search'):
+                distances, ids = self.search_excluding(state, q, n, key, filters)
+            with self.metrics.time('rerank'):
+                distances, ids = mmr_rerank(q[None], distances[None], ids[None],
+                                            state.store.get, k, float(lambda_))
+            return self.format_result(state, distances[0], ids[0], key)
+        return self.cached(state, key + (k, filters, lambda_, request.get('mmr_candidates'),
+                                         use_regions, request.get('region_candidates')), compute)
+
+    def recommend_outfit(self, state, request, k, filters):
+        '''
+        All garments of the outfit are searched as one batch and fused into one ranking.
+        '''
+        parts = [self.parse_query(part) for part in request['outfit']]
+        if not parts:
+            raise ValueError('An outfit needs at least one query')
+        weights = request.get('weights')
+        fusion = request.get('fusion', 'min')
+        key = ('outfit', tuple(key for _, key in parts),
+               None if weights is None else tuple(weights), fusion, k, filters)
+
+        def compute():
+            queries = np.stack([self.fetch(state, key) if query is None else query
+                                for query, key in parts])
+            mask = self.mask(state, filters)
+            with self.metrics.time('search'):
+                distances, ids = outfit_search(state.index, queries, weights, k=k, fusion=fusion,
+                                               mask=mask, **self.search_kwargs)
+            return self.format_result(state, distances, ids)
+        return self.cached(state, key, compute)
+
+    def recommend_range(self, state, request, query, key, filters):
+        '''
+        Range queries skip the micro-batcher: their result sizes differ, so they are searched
+        one at a time.
+        '''
+        if not hasattr(state.index, 'range_search'):
+            raise ValueError('The %s index has no range search' % state.index.index_type)
+        radius = float(request['radius'])
+        max_results = request.get('max_results')
+        max_results = None if max_results is None else int(max_results)
+
+        def compute():
+            q = self.fetch(state, key) if query is None else query
+            mask = self.mask(state, filters)
+            # The item of an id query is within any radius, so it takes one more result
+            n = max_results if max_results is None or key[0] != 'id' else max_results + 1
+            with self.metrics.time('search'):
+                distances, ids = state.index.range_search(q[None], radius, max_results=n,
+                                                          mask=mask, **self.search_kwargs)
+            distances, ids = distances[0], ids[0]
+            if key[0] == 'id':
+                keep = ids != key[1]
+                distances, ids = distances[keep][:max_results], ids[keep][:max_results]
+            return self.format_result(state, distances, ids, key)
+        return self.cached(state, key + ('radius', radius, max_results, filters), compute)
+
+    def search_excluding(self, state, query, k, key, filters):
+        '''
+        :return: the k nearest items of a single query through the micro-batcher. For an id
+        query, one more is searched for and the queried item is left out
+        '''
+        if key[0] != 'id':
+            return self.batcher.submit(query, k, (state, filters))
+        distances, ids = self.batcher.submit(query, k + 1, (state, filters))
+        distances, ids = exclude_self(distances[None], ids[None], np.array([key[1]]), k)
+        return distances[0], ids[0]
+
+    def fetch(self, state, key):
+        '''
+        :return: the stored embedding of the catalog item of an id query
+        '''
+        with self.metrics.time('fetch'):
+            return state.store.get([key[1]])[0]
+
+    def format_result(self, state, distances, ids, key=None):
+        found = ids >= 0
+        distances, ids = distances[found], ids[found]
+        result = {'ids': ids.tolist(), 'distances': distances.tolist()}
+        if key is not None and key[0] == 'id':
+            result['excluded_id'] = key[1]
+        if state.version is not None:
+            result['version'] = state.version
+        if state.store.image_paths is not None:
+            with self.metrics.time('join'):
+                # Items added while serving are not in the store yet
+                rows = state.store.rows_for(ids, strict=False)
+            with self.metrics.time('image_lookup'):
+                paths = iter(state.store.image_path(rows[rows >= 0]))
+                result['image_paths'] = [next(paths) if row >= 0 else None for row in rows]
+        return result
+
+    def updatable_index(self):
+        index = self.state.index
+        if not isinstance(index, SegmentedIndex):
+            raise ValueError('The %s index cannot be updated, run the server with '
+                             '--segmented_dir' % index.index_type)
+        return index
+
+    def add_items(self, request):
+        '''
+        :param request: a dict with the new catalog 'ids' and their 'embeddings'
+        :return: a dict with the number of items served
+        '''
+        index = self.updatable_index()
+        ids = np.asarray(request['ids'], dtype=np.int64)
+        index.add(np.asarray(request['embeddings'], dtype=np.float32), ids)
+        self.metrics.count('added_items', len(ids))
+        return {'ntotal': index.ntotal}
+
+    def remove_items(self, request):
+        '''
+        :param request: a dict with the catalog 'ids' to delete
+        :return: a dict with the number of items served
+        '''
+        index = self.updatable_index()
+        ids = np.asarray(request['ids'], dtype=np.int64)
+        index.remove(ids)
+        self.metrics.count('removed_items', len(ids))
+        return {'ntotal': index.ntotal}
+
+    def save_index(self):
+        '''
+        :return: a dict with the directory the updated index is saved to
+        '''
+        index = self.updatable_index()
+        index.save()
+        return {'path': index.path, 'ntotal': index.ntotal}
+
+
+class VersionWatcher(object):
+    '''
+    Polls the CURRENT file of a versions root and hot-swaps the service when it names a new
+    version. The new version is loaded and warmed up on the watcher thread, so queries keep
+    being answered by the old one meanwhile.
+    '''
+    def __init__(self, service, root, interval=POLL_SECONDS):
+        self.service = service
+        self.root = root
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def reload(self, name=None):
+        '''
+        :param name: the version to serve. Defaults to the one in CURRENT. Another version is
+        published to CURRENT once it is swapped in, so the next poll does not swap back
+        :return: the name of the version served from now on
+        '''
+        with self.lock:
+            current = current_version(self.root)
+            name = current if name is None else name
+            if name != self.service.state.version:
+                state = load_state(self.root, name, bitmaps=self.service.state.bitmaps)
+                old = self.service.swap(state)
+                print('Swapped version %s for %s' % (old.version, name))
+            if name != current:
+                publish(self.root, name)
+            return name
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reload()
+            except Exception as e:
+                # A half-written or broken version must not take the server down; the old
+                # version keeps serving and the next poll tries again
+                print('Could not load the current version: %s' % e)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''
+    POST /search with a JSON body answers one query; GET /health checks the server is up and
+    GET /metrics returns the latency and cache metrics.
+    POST /reload swaps to the version named in the body, or to the CURRENT one, when the server
+    runs with a VersionWatcher. POST /add, /remove and /save update a segmented index.
+    '''
+    service = None
+    watcher = None
+
+    def address_string(self):
+        # Unix socket clients have no host address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.service.metrics.snapshot())
+        elif self.path == '/health':
+            state = self.service.state
+            body = {'status': 'ok', 'ntotal': int(state.index.ntotal), 'version': state.version}
+            if self.service.cache is not None:
+                body['cache'] = self.service.cache.stats()
+            self.send_json(200, body)
+        else:
+            self.send_json(404, {'error': 'Unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path not in ('/search', '/reload', '/add', '/remove', '/save'):
+            self.send_json(404, {'error': 'Unknown path %s' % self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+            check_request(request)
+            if self.path == '/search':
+                self.send_json(200, self.service.recommend(request))
+            elif self.path == '/add':
+                self.send_json(200, self.service.add_items(request))
+            elif self.path == '/remove':
+                self.send_json(200, self.service.remove_items(request))
+            elif self.path == '/save':
+                self.send_json(200, self.service.save_index())
+            elif self.watcher is None:
+                self.send_json(400, {'error': 'Reloading needs the server to run with '
+                                              '--versions_dir'})
+            else:
+                self.send_json(200, {'version': self.watcher.reload(request.get('version'))})
+        except (KeyError, ValueError, IOError) as e:
+            self.service.metrics.count('errors')
+            self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            # check_request refused malformed bodies, so anything else is a bug of the server,
+            # but the client still gets an answer
+            self.service.metrics.count('errors')
+            self.service.metrics.count('internal_errors')
+            self.send_json(500, {'error': 'Internal error: %s: %s' % (type(e).__name__, e)})
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host='127.0.0.1', port=8080, unix_socket=None, watcher=None):
+    '''
+    :param service: the RecommendationService to answer queries with
+    :param unix_socket: listen on this socket path instead of host:port
+    :param watcher: an optional VersionWatcher of the service, to answer POST /reload
+    :return: the server, ready for serve_forever()
+    '''
+    handler = type('Handler', (RequestHandler,), {'service': service, 'watcher': watcher})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recommendation query server')
+    parser.add_argument('--index_dir', default='demo/output/ivf_index')
+    parser.add_argument('--store_dir', default='demo/output/feature_store')
+    parser.add_argument('--catalog_csv', default=None,
+                        help='csv with a category column, to allow category filtered queries')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix_socket', default=None)
+    parser.add_argument('--nprobe', type=int, default=None)
+    parser.add_argument('--ef', type=int, default=None)
+    parser.add_argument('--max_batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--window_ms', type=float, default=BATCH_WINDOW * 1000)
+    parser.add_argument('--cache_size', type=int, default=CACHE_SIZE)
+    parser.add_argument('--similar_dir', default=None,
+                        help='a similar items table built by similar.py')
+    parser.add_argument('--region_dir', default=None,
+                        help='a region descriptor store built by regions.py')
+    parser.add_argument('--attributes_file', default=None,
+                        help='the DeepFashion list_attr_img.txt, to allow attribute filtered '
+                             'queries')
+    parser.add_argument('--checkpoint', default=None,
+                        help='a simple_resnet checkpoint, to embed query images on the fly')
+    parser.add_argument('--versions_dir', default=None,
+                        help='a versions root, see versions.py. Replaces --index_dir, '
+                             '--store_dir, --similar_dir and --region_dir and enables hot swaps')
+    parser.add_argument('--segmented_dir', default=None,
+                        help='serve the segmented index saved there, or a new one wrapping '
+                             '--index_dir, to allow adds and deletes. POST /save saves it there')
+    parser.add_argument('--poll_seconds', type=float, default=POLL_SECONDS)
+    parser.add_argument('--metrics_file', default=None,
+                        help='a JSON file the metrics are written to every --metrics_seconds')
+    parser.add_argument('--metrics_seconds', type=float, default=DUMP_SECONDS)
+    args = parser.parse_args()
+
+    search_kwargs = {}
+    if args.nprobe is not None:
+        search_kwargs['nprobe'] = args.nprobe
+    if args.ef is not None:
+        search_kwargs['ef'] = args.ef
+    bitmaps = None if args.catalog_csv is None else category_bitmaps(args.catalog_csv)
+    embedder = None
+    if args.checkpoint is not None:
+        # Imported here so the server does not need TensorFlow unless it embeds images
+        from embedder import QueryEmbedder
+        embedder = QueryEmbedder(args.checkpoint)
+
+    if args.versions_dir is not None:
+        state = load_state(args.versions_dir, current_version(args.versions_dir), bitmaps)
+    else:
+        if args.segmented_dir is None:
+            index = load_index(args.index_dir)
+        elif os.path.exists(os.path.join(args.segmented_dir, META_FILE)):
+            index = load_index(args.segmented_dir)
+        else:
+            index = SegmentedIndex(load_index(args.index_dir))
+            index.path = args.segmented_dir
+        store = FeatureStore(args.store_dir)
+        attributes = None if args.attributes_file is None else \
+            load_attribute_bitmaps(args.attributes_file, store.image_path(np.arange(len(store))))
+        state = ServingState(index, store,
+                             None if args.similar_dir is None else SimilarItems(args.similar_dir),
+                             bitmaps, regions=None if args.region_dir is None else
+                             FeatureStore(args.region_dir), attributes=attributes)
+    service = RecommendationService(state.index, state.store, bitmaps=state.bitmaps,
+                                    search_kwargs=search_kwargs, max_batch=args.max_batch,
+                                    window=args.window_ms / 1000.0, cache_size=args.cache_size,
+                                    similar=state.similar, embedder=embedder,
+                                    version=state.version, regions=state.regions,
+                                    attributes=state.attributes)
+    watcher = None if args.versions_dir is None else \
+        VersionWatcher(service, args.versions_dir, args.poll_seconds)
+    if args.metrics_file is not None:
+        MetricsDumper(service.metrics, args.metrics_file, args.metrics_seconds)
+    server = make_server(service, args.host, args.port, args.unix_socket, watcher)
+    print('Serving %d items on %s' % (service.index.ntotal, args.unix_socket or
+                                      '%s:%d' % (args.host, args.port)))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+'''
+This python file shards the catalog across worker processes. features.npy is split into N
+contiguous shards, every shard gets its own saved index and its own worker process pinned to a
+core, and a coordinator scatters each query batch to all workers and merges their per-shard top-k
+with a heap into the global result.
+
+Example:
+    python sharded.py --features demo/output/features.npy --output_dir demo/output/sharded_index \
+        --n_shards 4 --index_type ivf
+    python server.py --index_dir demo/output/sharded_index
+'''
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+
+from exact import ExactIndex
+from hnsw import HNSWIndex
+from index_io import load_index
+from ivf import IVFIndex, META_FILE
+from lsh import BinaryHashIndex
+from pq import IVFPQIndex, PQIndex
+
+SHARD_DIR = 'shard_%03d'
+# index_type -> function building an unfilled index for a shard of the given features
+SHARD_BUILDERS = {
+    'exact': lambda x: ExactIndex(n_jobs=1),
+    'ivf': lambda x: IVFIndex(n_lists=int(4 * np.sqrt(len(x)))),
+    'ivfpq': lambda x: IVFPQIndex(n_lists=int(4 * np.sqrt(len(x))), m=16),
+    'pq': lambda x: PQIndex(x.shape[1], m=16),
+    'hnsw': lambda x: HNSWIndex(x.shape[1]),
+    'lsh': lambda x: BinaryHashIndex(x.shape[1]),
+}
+
+
+def heap_merge(dist_list, ids_list, k):
+    '''
+    :param dist_list: one distance array per shard with dimensions [num_queries, k_i], every row
+    sorted ascending
+    :param ids_list: the matching list of id arrays
+    :param k: number of neighbors to keep
+    :return: the merged distances and ids with dimensions [num_queries, k], padded with inf and -1
+    '''
+    num_queries = len(dist_list[0])
+    distances = np.full((num_queries, k), np.inf, dtype=np.float32)
+    indices = np.full((num_queries, k), -1, dtype=np.int64)
+    for i in range(num_queries):
+        rows = [zip(dist[i].tolist(), ids[i].tolist()) for dist, ids in zip(dist_list, ids_list)]
+        merged = [(d, j) for d, j in heapq.merge(*rows) if j >= 0]
+        for n, (d, j) in enumerate(merged[:k]):
+            distances[i, n], indices[i, n] = d, j
+    return distances, indices
+
+
+def pin_to_core(core):
+    '''
+    :param core: pin the calling process to this core, modulo the number of cores. A no-op where
+    the platform has no sched_setaffinity
+    '''
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, [cores[core % len(cores)]])
+
+
+def shard_worker(path, core, conn):
+    '''
+    The loop of one worker process: load the shard, then answer (queries, k, mask, kwargs)
+    messages until it receives None.
+    '''
+    pin_to_core(core)
+    index = load_index(path)
+    if hasattr(index, 'n_jobs'):
+        # One core per worker: the parallelism comes from the shards
+        index.n_jobs = 1
+    conn.send(index.ntotal)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        queries, k, mask, search_kwargs = message
+        try:
+            conn.send(index.search(queries, k=k, mask=mask, **search_kwargs))
+        except Exception as e:
+            conn.send(e)
+    conn.close()
+
+
+def build_shards(features, path, n_shards, index_type='exact', ids=None):
+    '''
+    :param features: a numpy array or memmap with dimensions [n, dim]
+    :param path: the directory to write one sub-directory per shard into
+    :param n_shards: number of shards
+    :param index_type: a key of SHARD_BUILDERS
+    :param ids: the catalog ids of the rows. Defaults to the row number
+    '''
+    if ids is None:
+        ids = np.arange(len(features))
+    bounds = np.linspace(0, len(features), n_shards + 1).astype(np.int64)
+    shards = []
+    for s in range(n_shards):
+        shard = np.asarray(features[bounds[s]:bounds[s + 1]], dtype=np.float32)
+        index = SHARD_BUILDERS[index_type](shard).fit(shard, ids[bounds[s]:bounds[s + 1]])
+        index.save(os.path.join(path, SHARD_DIR % s))
+        shards.append(SHARD_DIR % s)
+        print('Shard %d: %d items' % (s, len(shard)))
+    meta = {'type': ShardedIndex.index_type, 'shard_type': index_type, 'shards': shards,
+            'ntotal': int(len(features))}
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+class ShardedIndex(object):
+    '''
+    The coordinator of the shard workers. It has the same search interface as a single index, so
+    the server and the benchmark can use it unchanged.
+    '''
+    index_type = 'sharded'
+
+    def __init__(self, shard_paths, first_core=0):
+        '''
+        :param shard_paths: the saved index directory of every shard
+        :param first_core: the core the first worker is pinned to; worker s uses first_core + s
+        '''
+        self.shard_paths = shard_paths
+        self.lock = threading.Lock()
+        self.workers = []
+        self.conns = []
+        for s, path in enumerate(shard_paths):
+            conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=shard_worker,
+                                             args=(path, first_core + s, child_conn))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+            self.conns.append(conn)
+        self.shard_sizes = [conn.recv() for conn in self.conns]
+
+    @property
+    def ntotal(self):
+        return int(sum(self.shard_sizes))
+
+    def search(self, queries, k=6, mask=None, **search_kwargs):
+        '''
+        :param queries: a numpy array with dimensions [num_queries, dim]
+        :param k: number of neighbors to return
+        :param mask: an optional boolean array indexed by catalog id
+        :param search_kwargs: extra arguments of the shard searches, e.g. nprobe or ef
+        :return: distances and catalog ids with dimensions [num_queries, k]
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        # One batch at a time on the pipes; the shards of a batch still run in parallel
+        with self.lock:
+            for conn in self.conns:
+                conn.send((queries, k, mask, search_kwargs))
+            results = [conn.recv() for conn in self.conns]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return heap_merge([r[0] for r in results], [r[1] for r in results], k)
+
+    def close(self):
+        with self.lock:
+            for conn, worker in zip(self.conns, self.workers):
+                conn.send(None)
+                worker.join()
+            self.conns, self.workers = [], []
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        return cls([os.path.join(path, shard) for shard in meta['shards']])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a sharded index')
+    parser.add_argument('--features', default='demo/output/features.npy')
+    parser.add_argument('--output_dir', default='demo/output/sharded_index')
+    parser.add_argument('--n_shards', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--index_type', default='exact', choices=sorted(SHARD_BUILDERS))
+    args = parser.parse_args()
+    build_shards(np.load(args.features, mmap_mode='r'), args.output_dir, args.n_shards,
+                 args.index_type)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+'''
+This python file precomputes the "similar items" table of the whole catalog: the top-k neighbors
+of every item, found by a blocked, multithreaded exact self-join over features.npy. The table is
+written as an (N, k) int32 neighbor array and an (N, k) float16 distance array that are opened
+through mmap, so a product page recommendation is a single row read. The job checkpoints after
+every block and resumes from the last finished block when it is restarted.
+
+Example:
+    python similar.py --features demo/output/features.npy --output_dir demo/output/similar --k 6
+'''
+import argparse
+import json
+import os
+
+import numpy as np
+
+from exact import BASE_BLOCK, exact_search, squared_norms
+from index_io import write_meta
+from ivf import META_FILE
+
+BLOCK_ROWS = 4096
+
+
+def exclude_self(dist, ids, rows, k):
+    '''
+    :param dist: distances with dimensions [num_rows, k + 1]
+    :param ids: neighbor ids with dimensions [num_rows, k + 1]
+    :param rows: the id of every query row
+    :return: the k first neighbors that are not the query itself
+    '''
+    is_self = ids == rows[:, None]
+    # A stable sort moves the query to the end and keeps the others in distance order
+    order = np.argsort(is_self, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(dist, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def build_similar_table(features, path, k=6, block_rows=BLOCK_ROWS, metric='l2', n_jobs=-1):
+    '''
+    :param features: a numpy array or memmap with dimensions [n, dim]. Row numbers are the ids
+    :param path: the output directory. If it holds an unfinished table with the same settings,
+    the job resumes where it stopped
+    :param k: number of neighbors per item, the item itself excluded
+    :param block_rows: number of query rows per checkpointed block
+    :param metric: 'l2' or 'ip', as in exact_search
+    :param n_jobs: number of threads of the distance blocks. -1 uses all cores
+    :return: the finished SimilarItems table
+    '''
+    n = len(features)
+    meta = {'type': 'similar_items', 'num_rows': n, 'k': k, 'block_rows': block_rows,
+            'metric': metric, 'next_row': 0}
+    meta_path = os.path.join(path, META_FILE)
+    neighbors_path = os.path.join(path, 'neighbors.npy')
+    distances_path = os.path.join(path, 'distances.npy')
+    resume = False
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            saved = json.load(f)
+        resume = all(saved.get(key) == meta[key] for key in ('num_rows', 'k', 'metric'))
+    if resume:
+        meta['next_row'] = saved['next_row']
+        neighbors = np.load(neighbors_path, mmap_mode='r+')
+        distances = np.load(distances_path, mmap_mode='r+')
+        print('Resuming from row %d of %d' % (meta['next_row'], n))
+    else:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        neighbors = np.lib.format.open_memmap(neighbors_path, mode='w+', dtype=np.int32,
+                                              shape=(n, k))
+        distances = np.lib.format.open_memmap(distances_path, mode='w+', dtype=np.float16,
+                                              shape=(n, k))
+        write_meta(path, meta)
+
+    norms = np.concatenate([squared_norms(features[start:start + BASE_BLOCK])
+                            for start in range(0, n, BASE_BLOCK)] +
+                           [np.zeros(0, dtype=np.float32)])
+    for start in range(meta['next_row'], n, block_rows):
+        rows = np.arange(start, min(start + block_rows, n))
+        dist, ids = exact_search(features[start:start + block_rows], features, k=k + 1,
+                                 base_norms=norms, n_jobs=n_jobs, metric=metric)
+        dist, ids = exclude_self(dist, ids, rows, k)
+        if metric == 'l2':
+            dist = np.sqrt(dist)
+        neighbors[start:start + len(rows)] = ids
+        distances[start:start + len(rows)] = dist
+        neighbors.flush()
+        distances.flush()
+        meta['next_row'] = int(rows[-1]) + 1
+        write_meta(path, meta)
+        print('%d / %d rows done' % (meta['next_row'], n))
+    del neighbors, distances
+    return SimilarItems(path)
+
+
+class SimilarItems(object):
+    '''
+    A read-only view of a finished similar items table.
+    '''
+    def __init__(self, path):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        if meta['next_row'] < meta['num_rows']:
+            raise ValueError('The similar items table in %s is unfinished, at row %d of %d' %
+                             (path, meta['next_row'], meta['num_rows']))
+        self.k = meta['k']
+        self.metric = meta['metric']
+        self.neighbors = np.load(os.path.join(path, 'neighbors.npy'), mmap_mode='r')
+        self.distances = np.load(os.path.join(path, 'distances.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return self.neighbors.shape[0]
+
+    def lookup(self, ids, k=None):
+        '''
+        :param ids: catalog ids, i.e. rows of features.npy
+        :param k: number of neighbors to return, at most self.k
+        :return: the float32 distances and int64 ids of their neighbors, [len(ids), k]. Raises
+        KeyError for ids outside the table
+        '''
+        k = self.k if k is None else min(k, self.k)
+        rows = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        unknown = (rows < 0) | (rows >= len(self))
+        if np.any(unknown):
+            # Negative rows would wrap around to the last items
+            raise KeyError('Unknown ids: %s' % rows[unknown])
+        return np.asarray(self.distances[rows, :k], dtype=np.float32), \
+            np.asarray(self.neighbors[rows, :k], dtype=np.int64)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the similar items table')
+    parser.add_argument('--features', default='demo/output/features.npy')
+    parser.add_argument('--output_dir', default='demo/output/similar')
+    parser.add_argument('--k', type=int, default=6)
+    parser.add_argument('--block_rows', type=int, default=BLOCK_ROWS)
+    parser.add_argument('--metric', default='l2', choices=['l2', 'ip'])
+    args = parser.parse_args()
+    build_similar_table(np.load(args.features, mmap_mode='r'), args.output_dir, k=args.k,
+                        block_rows=args.block_rows, metric=args.metric)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+'''
+This python file tests that a SegmentedIndex over a wrapped main index ranks its delta like the
+main index, and compacts into a main index with the same wrappers.
+
+Example:
+    cd knn && python -m pytest -q test_segments.py
+'''
+import numpy as np
+import pytest
+
+from exact import ExactIndex
+from index_io import load_index
+from ivf import IVFIndex
+from metric import InnerProductIndex, cosine_index, normalize
+from pca import PCA, PCAIndex
+from segments import SegmentedIndex
+
+
+def make_main(kind):
+    if kind == 'cosine_exact':
+        return cosine_index()
+    if kind == 'cosine_ivf':
+        return cosine_index(IVFIndex(n_lists=8, nprobe=8))
+    if kind == 'ip_ivf':
+        return InnerProductIndex(IVFIndex(n_lists=8, nprobe=8), 'ip')
+    return PCAIndex(ExactIndex(), PCA(8))
+
+
+def reference(kind, main, features):
+    '''
+    :return: the exact distances the main index approximates, for every query and item
+    '''
+    if kind.startswith('cosine'):
+        return 1 - np.dot(normalize(features), normalize(features).T)
+    if kind == 'ip_ivf':
+        return 1 - np.dot(features, features.T)
+    projected = main.pca.transform(features)
+    return np.sqrt(((projected[:, None] - projected[None]) ** 2).sum(-1))
+
+
+@pytest.mark.parametrize('kind', ['cosine_exact', 'cosine_ivf', 'ip_ivf', 'pca'])
+def test_compaction_keeps_the_metric(kind, tmpdir):
+    rng = np.random.RandomState(0)
+    features = rng.randn(400, 16).astype(np.float32)
+    # Unit norms at most, so the delta stays within the max_norm of the MIPS main index
+    features /= 2 * np.sqrt((features ** 2).sum(1)).max()
+    main = make_main(kind).fit(features[:300], np.arange(300))
+    index = SegmentedIndex(main, max_delta=10 ** 6)
+    for start in range(300, 400, 10):
+        index.add(features[start:start + 10], np.arange(start, start + 10))
+    index.remove([0, 350])
+
+    distances = reference(kind, main, features)
+    distances[:, [0, 350]] = np.inf
+    expected = np.argsort(distances, axis=1, kind='stable')[:, :5]
+    queries = features[:50]
+    dist, ids = index.search(queries, k=5)
+    np.testing.assert_array_equal(ids, expected[:50])
+    np.testing.assert_allclose(dist, np.sort(distances, axis=1)[:50, :5], atol=1e-3)
+
+    path = str(tmpdir.join('segmented'))
+    index.save(path)
+    index.compact(background=False)
+    assert type(index.main) is type(main) and index.delta.ntotal == 0
+    assert index.main.ntotal == 398
+    np.testing.assert_array_equal(index.search(queries, k=5)[1], ids)
+    np.testing.assert_array_equal(load_index(path).search(queries, k=5)[1], ids)
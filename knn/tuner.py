@@ -0,0 +1,175 @@
+'''
+This python file tunes the search-time knob of a saved index: nprobe for IVF indexes, ef for
+HNSW and the re-rank depth for the binary hash index. It computes the exact neighbors of a
+held-out query set, sweeps the knob from cheap to expensive, and writes the cheapest value that
+reaches the target recall@k into the index meta.json. Indexes load that value as their default,
+so the server picks it up on the next load.
+
+Example:
+    python tuner.py --index_dir demo/output/ivf_index --features demo/output/features.npy \
+        --queries demo/output/features_wenxin.npy --k 6 --target_recall 0.95
+'''
+import argparse
+import os
+
+import numpy as np
+
+from benchmark import time_queries
+from exact import ExactIndex, recall_at_k
+from index_io import load_index, read_meta, write_meta
+from metric import InnerProductIndex
+from similar import exclude_self
+
+# index type -> the search argument trading recall for latency
+KNOBS = {'ivf': 'nprobe', 'ivfpq': 'nprobe', 'hnsw': 'ef', 'lsh': 'rerank'}
+MAX_EF = 1024
+MAX_RERANK = 16384
+
+
+def knob_dirs(path):
+    '''
+    :param path: a saved index directory
+    :return: the directories whose meta.json holds the knob: the index itself, the wrapped index
+    of a PCA or inner product index, or every shard of a sharded index
+    '''
+    meta = read_meta(path)
+    if meta['type'] in ('pca', 'inner_product'):
+        return knob_dirs(os.path.join(path, 'base'))
+    if meta['type'] == 'sharded':
+        return [d for shard in meta['shards'] for d in knob_dirs(os.path.join(path, shard))]
+    return [path]
+
+
+def knob_values(meta, k):
+    '''
+    :param meta: the meta.json of the index holding the knob
+    :param k: number of neighbors searched for
+    :return: the knob name and its candidate values, from the cheapest to the most expensive
+    '''
+    if meta['type'] not in KNOBS:
+        raise ValueError('The %s index has no search-time knob to tune' % meta['type'])
+    knob = KNOBS[meta['type']]
+    if knob == 'nprobe':
+        limit = meta['n_lists']
+        values = [v for v in 2 ** np.arange(20) if v < limit] + [limit]
+    elif knob == 'ef':
+        values = [k] + [v for v in 2 ** np.arange(4, 20) if k < v <= MAX_EF]
+    else:
+        limit = min(meta['ntotal'], MAX_RERANK)
+        values = [v for v in k * 2 ** np.arange(20) if v < limit] + [limit]
+    return knob, [int(v) for v in values]
+
+
+def exact_reference(index):
+    '''
+    :return: an exact index ranking like the given one: by inner product for inner product and
+    cosine indexes, by euclidean distance otherwise. A PCA index is compared with the exact
+    neighbors in the full dimension
+    '''
+    if isinstance(index, InnerProductIndex):
+        return InnerProductIndex(ExactIndex(metric='ip'), index.metric)
+    return ExactIndex()
+
+
+def tune(path, features, queries, k=10, target_recall=0.95, batch_size=1, ids=None,
+         query_ids=None):
+    '''
+    :param path: a saved index directory
+    :param features: the catalog embeddings the index was built from, e.g. features.npy
+    :param queries: the held-out query embeddings with dimensions [num_queries, dim]
+    :param k: the recall@k cut-off
+    :param target_recall: the recall@k to reach
+    :param batch_size: the query batch size the latency is measured at
+    :param ids: the catalog ids of the features rows. Defaults to the row number
+    :param query_ids: the catalog ids of the queries when they are catalog rows. Every query is
+    then left out of its own neighbors, in the truth and in the results, since it finds itself
+    at distance 0 and would inflate the recall
+    :return: a dict with the chosen setting and the whole sweep
+    '''
+    knob, values = knob_values(read_meta(knob_dirs(path)[0]), k)
+    index = load_index(path)
+    # One more neighbor is searched for when the query itself is dropped from the results
+    n = k if query_ids is None else k + 1
+    dist, truth = exact_reference(index).fit(features, ids).search(queries, k=n)
+    if query_ids is not None:
+        query_ids = np.asarray(query_ids)
+        _, truth = exclude_self(dist, truth, query_ids, k)
+    results = []
+    chosen = None
+    for value in values:
+        search_kwargs = {knob: value}
+        dist, found = index.search(queries, k=n, **search_kwargs)
+        if query_ids is not None:
+            _, found = exclude_self(dist, found, query_ids, k)
+        qps, p50, p99 = time_queries(index, queries, k, batch_size, search_kwargs)
+        result = {knob: value, 'recall': recall_at_k(found, truth, k), 'qps': qps,
+                  'p50_ms': p50, 'p99_ms': p99}
+        results.append(result)
+        print('%s %6d  recall@%d %.4f  %8.0f qps  p50 %.2fms  p99 %.2fms' % (
+            knob, value, k, result['recall'], qps, p50, p99))
+        # Recall and cost both grow with the knob, so the first setting reaching the target is
+        # the cheapest one
+        if result['recall'] >= target_recall:
+            chosen = result
+            break
+    if hasattr(index, 'close'):
+        index.close()
+
+    target_met = chosen is not None
+    if not target_met:
+        chosen = max(results, key=lambda r: r['recall'])
+        print('Target recall %.4f not reached, keeping the best recall %.4f' %
+              (target_recall, chosen['recall']))
+    return {'knob': knob, 'value': chosen[knob], 'k': k, 'target_recall': target_recall,
+            'target_met': target_met, 'recall': chosen['recall'], 'p50_ms': chosen['p50_ms'],
+            'batch_size': batch_size, 'num_queries': len(queries),
+            'self_excluded': query_ids is not None, 'sweep': results}
+
+
+def write_tuning(path, tuning):
+    '''
+    Store the chosen value as the default of the index and the tuning report next to it.
+    :param path: the saved index directory
+    :param tuning: the dict returned by tune()
+    '''
+    for knob_dir in knob_dirs(path):
+        meta = read_meta(knob_dir)
+        meta[tuning['knob']] = tuning['value']
+        write_meta(knob_dir, meta)
+    meta = read_meta(path)
+    meta['tuning'] = tuning
+    write_meta(path, meta)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune the search knob of a saved index')
+    parser.add_argument('--index_dir', default='demo/output/ivf_index')
+    parser.add_argument('--features', default='demo/output/features.npy',
+                        help='the catalog embeddings the index was built from')
+    parser.add_argument('--queries', default=None,
+                        help='a held-out query .npy file. Defaults to --num_queries catalog '
+                             'rows, each left out of its own neighbors')
+    parser.add_argument('--num_queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=6)
+    parser.add_argument('--target_recall', type=float, default=0.95)
+    parser.add_argument('--batch_size', type=int, default=1)
+    args = parser.parse_args()
+
+    features = np.load(args.features, mmap_mode='r')
+    rows = None
+    if args.queries is not None:
+        queries = np.load(args.queries).astype(np.float32)
+    else:
+        rng = np.random.RandomState(0)
+        rows = np.sort(rng.choice(len(features), min(args.num_queries, len(features)),
+                                  replace=False))
+        queries = np.asarray(features[rows], dtype=np.float32)
+    # The catalog ids are the row numbers, so the sampled rows are the ids of the queries
+    tuning = tune(args.index_dir, features, queries, k=args.k,
+                  target_recall=args.target_recall, batch_size=args.batch_size, query_ids=rows)
+    write_tuning(args.index_dir, tuning)
+    print('%s = %d written to %s' % (tuning['knob'], tuning['value'], args.index_dir))
+
+
+if __name__ == '__main__':
+    main()
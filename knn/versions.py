@@ -0,0 +1,215 @@
+'''
+This python file manages versioned index directories, so a retrained model and its re-extracted
+features can replace the served index without downtime. Every version is a directory under one
+root holding everything a server needs:
+    root/v0002/index        a saved index, any type load_index knows
+    root/v0002/store        the FeatureStore of the catalog
+    root/v0002/similar      optional, a similar items table
+    root/v0002/regions      optional, the region descriptor store of regions.py
+    root/v0002/attributes.npy  optional, the catalog attribute flags of filters.py
+    root/v0002/catalog.csv  optional, the catalog with a category column for the bitmaps
+and root/CURRENT names the version to serve. Publishing rewrites CURRENT atomically; a server
+watching the root loads and warms the new version in the background, then swaps it in.
+
+Example:
+    python versions.py --root demo/output/versions --publish v0002
+'''
+import argparse
+import os
+
+import numpy as np
+
+from feature_store import FeatureStore
+from filters import category_bitmaps
+from index_io import load_index
+from similar import SimilarItems
+
+CURRENT_FILE = 'CURRENT'
+VERSION_FORMAT = 'v%04d'
+PAGE_SIZE = 4096
+WARM_UP_QUERIES = 64
+
+
+def list_versions(root):
+    '''
+    :return: the names of the version directories under root, oldest first
+    '''
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root)
+                  if name.startswith('v') and os.path.isdir(os.path.join(root, name)))
+
+
+def new_version(root):
+    '''
+    :return: the path of a new, empty version directory to write the index and store into
+    '''
+    versions = list_versions(root)
+    number = int(versions[-1][1:]) + 1 if versions else 1
+    path = os.path.join(root, VERSION_FORMAT % number)
+    os.makedirs(path)
+    return path
+
+
+def current_version(root):
+    '''
+    :return: the name of the version to serve: the one in CURRENT, else the newest one
+    '''
+    current = os.path.join(root, CURRENT_FILE)
+    if os.path.exists(current):
+        with open(current) as f:
+            return f.read().strip()
+    versions = list_versions(root)
+    if not versions:
+        raise ValueError('No index version in %s' % root)
+    return versions[-1]
+
+
+def publish(root, name):
+    '''
+    Point CURRENT at a version. The file is replaced in one rename, so readers never see a
+    partial name.
+    :param root: the versions root directory
+    :param name: a version directory name, e.g. v0002
+    '''
+    if not os.path.isdir(os.path.join(root, name, 'index')):
+        raise ValueError('%s has no index directory' % os.path.join(root, name))
+    tmp = os.path.join(root, CURRENT_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(name + '\n')
+    os.replace(tmp, os.path.join(root, CURRENT_FILE))
+
+
+def touch_pages(array):
+    '''
+    Read one byte of every page of a memory-mapped array, so the first queries on a new version
+    do not stall on page faults.
+    :return: the number of bytes touched
+    '''
+    if not isinstance(array, np.memmap) or not array.flags.c_contiguous or array.size == 0:
+        return 0
+    flat = array.reshape(-1).view(np.uint8)
+    flat[::PAGE_SIZE].sum()
+    return flat.nbytes
+
+
+def touch_index(index, seen=None):
+    '''
+    :param index: a loaded index, feature store or similar items table
+    :param seen: ids of the objects already touched
+    :return: the bytes of memory-mapped arrays touched, following wrapped indexes
+    '''
+    seen = set() if seen is None else seen
+    if id(index) in seen:
+        return 0
+    seen.add(id(index))
+    total = 0
+    for value in vars(index).values():
+        if isinstance(value, np.ndarray):
+            total += touch_pages(value)
+        elif hasattr(value, 'index_type'):
+            total += touch_index(value, seen)
+    return total
+
+
+def release_index(index, seen=None):
+    '''
+    Drop the memory-mapped arrays of a retired index, feature store or similar items table, so
+    their files are unmapped once the last view of them is gone. The object is unusable after.
+    :param index: a loaded index, feature store or similar items table
+    :param seen: ids of the objects already released
+    :return: the bytes of memory-mapped arrays dropped, following wrapped indexes
+    '''
+    seen = set() if seen is None else seen
+    if id(index) in seen:
+        return 0
+    seen.add(id(index))
+    total = 0
+    for name, value in list(vars(index).items()):
+        if isinstance(value, np.memmap):
+            total += value.nbytes
+            setattr(index, name, None)
+        elif hasattr(value, 'index_type'):
+            total += release_index(value, seen)
+    return total
+
+
+class ServingState(object):
+    '''
+    Everything a query reads, for one version. Requests take a reference to the state once and
+    use it to the end, so swapping the service to a new state never mixes versions in a query.
+    '''
+    def __init__(self, index, store, similar=None, bitmaps=None, version=None, regions=None,
+                 attributes=None):
+        self.index = index
+        self.store = store
+        self.similar = similar
+        self.bitmaps = bitmaps or {}
+        self.version = version
+        self.regions = regions
+        self.attributes = attributes
+
+    def close(self):
+        '''
+        Release the version: stop the shard workers of a sharded index and drop the memory maps
+        of the index, the feature store, the similar items table and the region store.
+        '''
+        if hasattr(self.index, 'close'):
+            self.index.close()
+        seen = set()
+        released = sum(release_index(part, seen) for part in
+                       (self.index, self.store, self.similar, self.regions) if part is not None)
+        if isinstance(self.attributes, np.memmap):
+            released += self.attributes.nbytes
+            self.attributes = None
+        print('Version %s closed: %.1fMB unmapped' % (self.version, released / 2.0 ** 20))
+
+
+def load_state(root, name, bitmaps=None, warm_up=True):
+    '''
+    :param root: the versions root directory
+    :param name: the version to load
+    :param bitmaps: category bitmaps to use when the version has no catalog.csv
+    :param warm_up: touch the mmap pages and run a few queries before returning
+    :return: the ServingState of the version
+    '''
+    path = os.path.join(root, name)
+    index = load_index(os.path.join(path, 'index'))
+    store = FeatureStore(os.path.join(path, 'store'))
+    similar_dir = os.path.join(path, 'similar')
+    similar = SimilarItems(similar_dir) if os.path.isdir(similar_dir) else None
+    regions_dir = os.path.join(path, 'regions')
+    regions = FeatureStore(regions_dir) if os.path.isdir(regions_dir) else None
+    attributes_file = os.path.join(path, 'attributes.npy')
+    attributes = np.load(attributes_file, mmap_mode='r') if os.path.exists(attributes_file) \
+        else None
+    catalog_csv = os.path.join(path, 'catalog.csv')
+    if os.path.exists(catalog_csv):
+        bitmaps = category_bitmaps(catalog_csv)
+    state = ServingState(index, store, similar, bitmaps, version=name, regions=regions,
+                         attributes=attributes)
+    if warm_up:
+        seen = set()
+        touched = sum(touch_index(part, seen) for part in (index, store, similar, regions)
+                      if part is not None)
+        rng = np.random.RandomState(0)
+        rows = rng.choice(len(store), min(WARM_UP_QUERIES, len(store)), replace=False)
+        index.search(np.asarray(store.features[np.sort(rows)], dtype=np.float32), k=6)
+        print('Version %s warmed up: %.1fMB touched' % (name, touched / 2.0 ** 20))
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List or publish index versions')
+    parser.add_argument('--root', default='demo/output/versions')
+    parser.add_argument('--publish', default=None, help='the version to serve from now on')
+    args = parser.parse_args()
+    if args.publish is not None:
+        publish(args.root, args.publish)
+    current = current_version(args.root)
+    for name in list_versions(args.root):
+        print('%s %s' % ('*' if name == current else ' ', name))
+
+
+if __name__ == '__main__':
+    main()